@@ -0,0 +1,128 @@
+"""
+
+Script for caching the features of a frozen, pretrained encoder next to the training shards
+
+With --fix_feats and --early_feats, the UNet encoder of fcn_crnn and mi_clstm gives
+the same features for a timestep of a grid every epoch, so it is run once over every
+frame of the shards written by compile_dataset.py. Its features are written time
+first, in float16, to one [timestamps x channels x rows x cols] .npy file per sensor
+and feature, <sat>_center.npy, <sat>_enc4.npy and <sat>_enc3.npy, indexed by the
+offsets and lengths of index.npz. With --feature_cache, ShardDataset reads them
+instead of the shards and the model skips its encoder, so training only runs the
+CRNN, attention and decoder.
+
+Only the encoder is cached: it normalizes by group norm and all its weights come
+from --pretrained_model_path. Without --early_feats the features also go through
+the UNet decoder, whose batch norms and projection to --fcn_out_feats are trained
+along with the CRNN, so they can't be cached.
+Features are of unrotated grids, so --apply_transforms can't be used with the cache.
+fcn_crnn encodes its sensors concatenated, in pairs of timesteps that are sampled
+anew each epoch, so it can only be cached with one sensor.
+
+Run with the same data and model flags used for training:
+
+    python cache_features.py --country ghana --use_s2 True --shard_dir ~/shards/ghana \
+        --model_name mi_clstm --early_feats True --pretrained_model_path ~/models/unet_best
+
+"""
+import os
+import json
+import numpy as np
+import torch
+import models
+import util
+
+from constants import *
+from tqdm import tqdm
+
+def encode(model, model_name, sat, frames, num_feats):
+    """ Returns the list of the cached features of a [frames x bands x rows x cols] batch.
+    """
+    with torch.no_grad():
+        if model_name == 'mi_clstm':
+            return model.encode(sat, frames)
+        return model.encode(frames)[:num_feats]
+
+def load_encoder(model, args):
+    """ Loads the encoder weights of model from args.pretrained_model_path, fails if any is missing.
+    """
+    if args.model_name == 'mi_clstm':
+        prefixes = [f'{sat}_enc.' for sat in ['s1', 's2', 'planet'] if getattr(args, f'use_{sat}')]
+    else:
+        prefixes = ['fcn_enc.']
+    updated_keys = models.load_pretrained_weights(model, args.pretrained_model_path)
+    missing = [key for key in model.state_dict() if key.startswith(tuple(prefixes)) and key not in updated_keys]
+    if missing:
+        raise ValueError(f'{args.pretrained_model_path} has no weights for {len(missing)} encoder parameters, like {missing[0]}')
+
+def cache_split(model, args, split):
+    """ Writes the encoder features of one split to args.shard_dir/split.
+
+    Args:
+      model - (nn.Module) fcn_crnn or mi_clstm model with the pretrained encoder
+      args - (argparse object) training args, the ones in FEATURE_CACHE_ARGS are saved with the features
+      split - (str) 'train', 'val' or 'test'
+    """
+    shard_dir = os.path.join(args.shard_dir, split)
+    index = np.load(os.path.join(shard_dir, 'index.npz'))
+    config = json.loads(str(index['config']))
+    mismatched = [arg for arg in SHARD_ARGS if config[arg] != getattr(args, arg)]
+    if mismatched:
+        raise ValueError(f'Shards in {shard_dir} were compiled with different {mismatched}, rerun compile_dataset.py')
+
+    # features.json is written last and marks the features as complete
+    if os.path.exists(os.path.join(shard_dir, 'features.json')):
+        os.remove(os.path.join(shard_dir, 'features.json'))
+
+    frames_per_batch = args.batch_size * args.num_timesteps
+    sats = [sat for sat in ['s1', 's2', 'planet'] if getattr(args, f'use_{sat}')]
+    for sat in sats:
+        shard = np.load(os.path.join(shard_dir, f'{sat}.npy'), mmap_mode='r')
+        feat_shards = None
+        for start in tqdm(range(0, shard.shape[0], frames_per_batch), desc=f'{split} {sat}'):
+            frames = torch.tensor(shard[start:start+frames_per_batch], dtype=torch.float32, device=args.device)
+            feats = encode(model, args.model_name, sat, frames, len(CACHED_FEATS))
+
+            # feature shapes are only known once the first frames went through the encoder
+            if feat_shards is None:
+                feat_shards = [np.lib.format.open_memmap(os.path.join(shard_dir, f'{sat}_{name}.npy'), mode='w+',
+                                                         dtype=np.float16, shape=(shard.shape[0],) + tuple(feat.shape[1:]))
+                               for name, feat in zip(CACHED_FEATS, feats)]
+            for feat_shard, feat in zip(feat_shards, feats):
+                feat_shard[start:start+frames.shape[0]] = feat.cpu().numpy()
+
+        for feat_shard in feat_shards:
+            feat_shard.flush()
+
+    with open(os.path.join(shard_dir, 'features.json'), 'w') as f:
+        json.dump({ arg: getattr(args, arg) for arg in FEATURE_CACHE_ARGS }, f)
+
+
+if __name__ == "__main__":
+    parser = util.get_train_parser()
+    args = parser.parse_args()
+    args.device = util.get_device(args.device)
+    if args.shard_dir is None:
+        raise ValueError('--shard_dir must be set')
+    if args.pretrained_model_path is None:
+        raise ValueError('--pretrained_model_path must be set')
+    if args.model_name not in ['fcn_crnn', 'mi_clstm']:
+        raise ValueError(f'Features of {args.model_name} can not be cached, only of fcn_crnn and mi_clstm')
+    if not args.early_feats:
+        raise ValueError('Only the encoder features of --early_feats can be cached')
+    if args.model_name == 'fcn_crnn':
+        if sum(getattr(args, f'use_{sat}') for sat in ['s1', 's2', 'planet']) != 1:
+            raise ValueError('Features of fcn_crnn can only be cached with one sensor')
+        if args.use_planet and not args.resize_planet:
+            raise ValueError('Features of fcn_crnn can only be cached with --resize_planet')
+
+    # the encoder is run on the grids, not on cached features
+    args.feature_cache = False
+    model = models.get_model(**vars(args))
+    load_encoder(model, args)
+    model.to(args.device)
+    model.eval()
+
+    for split in SPLITS:
+        cache_split(model, args, split)
+    print(f'Features written to {args.shard_dir}')
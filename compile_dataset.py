@@ -0,0 +1,99 @@
+"""
+
+Script for compiling the deterministic part of the CropTypeDS pipeline into training shards
+
+Band selection, aggregation, normalization and the index, cloud and doy bands are
+applied once to every timestep of every grid, and each sensor is written time first
+to one contiguous [timestamps x bands x rows x cols] .npy shard per split. The
+index.npz next to the shards holds each grid's offset and length into the shards,
+its labels and per timestep cloud scores. ShardDataset memory-maps the shards, so
+that loading a sample only samples timesteps and rotates.
+
+Run with the same data flags used for training, plus --shard_dir:
+
+    python compile_dataset.py --country ghana --use_s2 True --shard_dir ~/shards/ghana
+
+"""
+import os
+import json
+import numpy as np
+import datasets
+import util
+
+from constants import *
+from tqdm import tqdm
+
+def get_shard_length(metadata, grid, sat, args):
+    """ Number of timesteps a grid adds to a sensor's shard
+    """
+    if getattr(args, f'{sat}_agg'):
+        return datasets.get_time_bins([], args.agg_days)[1]
+    return metadata.length(sat, grid)
+
+def compile_split(args, split):
+    """ Writes the shards and index of one split to args.shard_dir/split.
+
+    Args:
+      args - (argparse object) training args, the ones in SHARD_ARGS are baked into the shards
+      split - (str) 'train', 'val' or 'test'
+    """
+    grid_path = datasets.get_grid_path(args.country, args.dataset, split)
+    ds = datasets.CropTypeDS(args, grid_path, split)
+    ds.sample_timesteps = False
+    data = ds.get_data()
+
+    out_dir = os.path.join(args.shard_dir, split)
+    os.makedirs(out_dir, exist_ok=True)
+    # index.npz is written last and marks the split as complete
+    if os.path.exists(os.path.join(out_dir, 'index.npz')):
+        os.remove(os.path.join(out_dir, 'index.npz'))
+
+    sats = [sat for sat in ['s1', 's2', 'planet'] if getattr(args, f'use_{sat}')]
+    index = { 'grids': np.array(ds.grid_list),
+              'config': json.dumps({ arg: getattr(args, arg) for arg in SHARD_ARGS }) }
+    shards = {}
+    for sat in sats:
+        lengths = np.array([get_shard_length(ds.metadata, grid, sat, args) for grid in ds.grid_list])
+        index[f'{sat}_lengths'] = lengths
+        index[f'{sat}_offsets'] = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(int)
+        # only s2 has cloud scores, uniform scores give uniform timestep sampling
+        index[f'{sat}_scores'] = np.ones(lengths.sum(), dtype=np.float32)
+        shards[sat] = None
+
+    labels = []
+    for idx, grid in enumerate(tqdm(ds.grid_list, desc=split)):
+        sat_properties = ds.get_sat_properties()
+        for sat in sats:
+            sat_properties = ds.setup_data(data, idx, sat, sat_properties)
+            arr = np.transpose(np.asarray(sat_properties[sat]['data']), [3, 0, 1, 2])
+            start, length = index[f'{sat}_offsets'][idx], index[f'{sat}_lengths'][idx]
+            if arr.shape[0] != length:
+                raise ValueError(f'{sat} of grid {grid} has {arr.shape[0]} timesteps, expected {length}')
+
+            # shard shapes are only known once the first grid went through the pipeline
+            if shards[sat] is None:
+                shards[sat] = np.lib.format.open_memmap(os.path.join(out_dir, f'{sat}.npy'), mode='w+',
+                                                        dtype=args.shard_dtype,
+                                                        shape=(int(index[f'{sat}_lengths'].sum()),) + arr.shape[1:])
+            shards[sat][start:start+length] = arr
+
+            if sat in ['s2'] and not sat_properties[sat]['agg']:
+                index[f'{sat}_scores'][start:start+length] = ds.read_cloud_scores(data, idx)
+
+        labels.append(data.read('labels', grid))
+
+    for sat in sats:
+        shards[sat].flush()
+    index['labels'] = np.stack(labels)
+    np.savez(os.path.join(out_dir, 'index.npz'), **index)
+
+
+if __name__ == "__main__":
+    parser = util.get_train_parser()
+    args = parser.parse_args()
+    if args.shard_dir is None:
+        raise ValueError('--shard_dir must be set')
+
+    for split in SPLITS:
+        compile_split(args, split)
+    print(f'Shards written to {args.shard_dir}')
@@ -15,6 +15,23 @@ MULTI_RES_MODELS = ['fcn_crnn']
 S1_NUM_BANDS = 3
 PLANET_NUM_BANDS = 4
 
+# Reduction used to composite each sensor's timeseries when aggregating
+AGG_REDUCTION = { 's1': 'avg', 's2': 'min', 'planet': 'median' }
+
+# Rows of the per-grid cloud_scores datasets: the mean remapped cloud class of each
+#  timestamp (see preprocess.remap_cloud_stack), then the fraction of pixels in each class
+CLOUD_SCORE_COLUMNS = ['score', 'clear', 'clouds', 'shadows', 'haze']
+
+# Args baked into the training shards written by compile_dataset.py
+SHARD_ARGS = ['country', 'dataset', 'use_s1', 'use_s2', 'use_planet', 's1_agg', 's2_agg', 'planet_agg', 'agg_days',
+              'resize_planet', 's2_num_bands', 'normalize', 'include_clouds', 'include_doy', 'include_indices']
+
+# Encoder outputs cache_features.py writes next to the shards with --early_feats;
+#  the first one is the input of the CRNN
+CACHED_FEATS = ['center', 'enc4', 'enc3']
+# Args the encoder features were cached with
+FEATURE_CACHE_ARGS = ['model_name', 'early_feats', 'fcn_out_feats', 'pretrained_model_path']
+
 LABEL_DIR = "raster_npy"
 S1_DIR = "s1_npy"
 S2_DIR = "s2_npy"
@@ -67,17 +84,14 @@ INT_CHOICE_HP = ['num_timesteps', 's2_num_bands']
 HPS = [INT_POWER_EXP, REAL_POWER_EXP, INT_HP, FLOAT_HP, STRING_HP, BOOL_HP, INT_CHOICE_HP]
 
 # LOSS WEIGHTS
+# kept in numpy, loss_fns.get_loss_weight puts them on the device of the loss
 GHANA_LOSS_WEIGHT = 1 - np.array([.17, .56, .16, .11])
-GHANA_LOSS_WEIGHT = torch.tensor(GHANA_LOSS_WEIGHT, dtype=torch.float32).cuda()
 
 SSUDAN_LOSS_WEIGHT = 1 - np.array([.72, .11, .10, .07])
-SSUDAN_LOSS_WEIGHT = torch.tensor(SSUDAN_LOSS_WEIGHT, dtype=torch.float32).cuda()
 
 TANZ_LOSS_WEIGHT = 1 - np.array([.64, .14, .12, .05, .05])
-TANZ_LOSS_WEIGHT = torch.tensor(TANZ_LOSS_WEIGHT, dtype=torch.float32).cuda()
           
 GERMANY_LOSS_WEIGHT = 1 - np.array([.02, .01, .07, .05, .03, .01, .02, .01, .01, .04, .01, .01, .27, .10, .01, .03, .32])
-GERMANY_LOSS_WEIGHT = torch.tensor(GERMANY_LOSS_WEIGHT, dtype=torch.float32).cuda()
 
 LOSS_WEIGHT = { 'ghana': GHANA_LOSS_WEIGHT, 
                 'southsudan': SSUDAN_LOSS_WEIGHT,
@@ -130,6 +144,9 @@ GRID_SIZE = { 'ghana': 32,
               'tanzania': 32, 
               'germany': 48 }
 
+# target of unlabeled pixels with --int_labels, ignored by the losses
+LABEL_IGNORE_INDEX = -1
+
 CM_LABELS = { 'ghana': [0, 1, 2, 3], 
               'southsudan': [0, 1, 2, 3], 
               'tanzania': [0, 1, 2, 3, 4],
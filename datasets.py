@@ -5,15 +5,22 @@ File that houses the dataset wrappers we have.
 """
 
 import torch
+import torch.utils.data.dataloader
 from torch.utils.data import Dataset, DataLoader, Sampler
 import pickle
 import h5py
 import numpy as np
 import os
+import json
+import queue
+import threading
+import warnings
 
 from skimage.transform import resize as imresize
 
 import preprocess
+import storage
+from modelling.util import get_length_mask
 from constants import *
 from random import shuffle
 from pprint import pprint
@@ -63,11 +70,14 @@ def get_Xy_batch(inputs, targets, X, y, country):
     function takes one case of inputs, targets each time it is called
     and builds up X, y as the dataloader goes through all batches 
     """
+    # integer labels hold class crop_idx + 1 where one-hot labels have a 1 in channel crop_idx
+    int_labels = targets.dim() == 3
     # For each input example and corresponding target,
     for ex_idx in range(inputs.shape[0]):
-        for crop_idx in range(targets.shape[1]):
+        for crop_idx in range(NUM_CLASSES[country] if int_labels else targets.shape[1]):
             cur_inputs = np.transpose(np.reshape(inputs[ex_idx, :, :, :, :], (-1, GRID_SIZE[country]*GRID_SIZE[country])), (1, 0))
-            cur_targets = np.squeeze(np.reshape(targets[ex_idx, crop_idx, :, :], (-1, GRID_SIZE[country]*GRID_SIZE[country])))
+            cur_targets = (targets[ex_idx] == crop_idx + 1).float() if int_labels else targets[ex_idx, crop_idx, :, :]
+            cur_targets = np.squeeze(np.reshape(cur_targets, (-1, GRID_SIZE[country]*GRID_SIZE[country])))
             # Index pixels of desired crop
             valid_inputs = cur_inputs[cur_targets == 1, :]
             if valid_inputs.shape[0] == 0:
@@ -80,59 +90,166 @@ def get_Xy_batch(inputs, targets, X, y, country):
                 y.append(labels)
     return X, y 
 
+AGG_REDUCTIONS = ['avg', 'min', 'max', 'median', 'nanavg', 'nanmin', 'nanmax', 'nanmedian']
+
+NAN_REDUCTIONS = { 'nanavg': np.nanmean,
+                   'nanmin': np.nanmin,
+                   'nanmax': np.nanmax,
+                   'nanmedian': np.nanmedian }
+
+REDUCEAT_UFUNCS = { 'avg': np.add,
+                    'min': np.minimum,
+                    'max': np.maximum }
+
+def get_time_bins(doys, ndays, total_days=364):
+    """
+    Assigns each observation to the time bin it is composited into
+
+    Args:
+      doys - vector / list of days of year associated with the observations
+      ndays - number of days to aggregate together
+      total_days - number of days covered by the bins
+
+    Returns:
+      bin_idxs - (np array) bin index of each observation, from 0 to num_bins - 1.
+                 Observations past the last full bin fall into the last bin
+      num_bins - (int) number of bins, total_days // ndays
+    """
+    num_bins = int(total_days // ndays)
+    bin_edges = np.arange(1, num_bins) * ndays
+    bin_idxs = np.digitize(np.asarray(doys).astype(int), bin_edges)
+    return bin_idxs, num_bins
+
+def composite(arr, bin_idxs, num_bins, reduction='avg'):
+    """
+    Reduces the last axis of arr into num_bins composites in one pass
+
+    Args:
+      arr - (np array) [... x timestamps] array to composite
+      bin_idxs - (np array) [timestamps] bin index of each timestamp, need not be sorted
+      num_bins - (int) number of composites to produce
+      reduction - (str) one of AGG_REDUCTIONS. 'nan' variants ignore nan observations
+
+    Returns:
+      out - (np array) [... x num_bins] composites as float64. Bins with no
+             (non-nan, for the 'nan' variants) observations are filled with 0
+    """
+    if reduction not in AGG_REDUCTIONS:
+        raise ValueError(f"Reduction {reduction} unsupported, must be one of {AGG_REDUCTIONS}")
+
+    arr = np.asarray(arr, dtype=np.float64)
+    lead_shape = arr.shape[:-1]
+    flat = arr.reshape(-1, arr.shape[-1])
+    bin_idxs = np.asarray(bin_idxs)
+
+    # Group observations of the same bin next to each other
+    order = np.argsort(bin_idxs, kind='stable')
+    flat = flat[:, order]
+    counts = np.bincount(bin_idxs, minlength=num_bins)
+    starts = np.cumsum(counts) - counts
+    present = np.flatnonzero(counts)
+
+    out = np.zeros((flat.shape[0], num_bins))
+    if len(present) == 0:
+        return out.reshape(lead_shape + (num_bins,))
+
+    if reduction in REDUCEAT_UFUNCS:
+        # segment reduction over each run of observations sharing a bin
+        out[:, present] = REDUCEAT_UFUNCS[reduction].reduceat(flat, starts[present], axis=1)
+        if reduction == 'avg':
+            out[:, present] /= counts[present]
+    else:
+        # Scatter observations into a nan padded [..., num_bins, max_count] array
+        ranks = np.arange(len(bin_idxs)) - starts[bin_idxs[order]]
+        padded = np.full((flat.shape[0], num_bins, counts.max()), np.nan)
+        padded[:, bin_idxs[order], ranks] = flat
+        with warnings.catch_warnings():
+            # all-nan bins are filled with 0 below
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            if reduction == 'median':
+                out = np.nanmedian(padded, axis=2)
+                # np.median propagates nans, unlike np.nanmedian
+                has_nan = np.add.reduceat(np.isnan(flat), starts[present], axis=1) > 0
+                out[:, present] = np.where(has_nan, np.nan, out[:, present])
+                out[:, counts == 0] = 0
+            else:
+                out = NAN_REDUCTIONS[reduction](padded, axis=2)
+                out[np.isnan(out)] = 0
+
+    return out.reshape(lead_shape + (num_bins,))
+
 def split_and_aggregate(arr, doys, ndays, reduction='avg'):
     """
     Aggregates an array along the time dimension, grouping by every ndays
     
     Args: 
-      arr - array of images of dimensions
+      arr - array of images of dimensions [bands x rows x cols x timestamps]
       doys - vector / list of days of year associated with images stored in arr
       ndays - number of days to aggregate together
+      reduction - (str) one of AGG_REDUCTIONS, how observations in a bin are combined
+
+    Returns:
+      new_arr - (np array) [bands x rows x cols x 364 // ndays] composites, empty bins are 0
+      new_doys - (np array) first day of year of each bin
     """
     total_days = 364
-    
-    # Get index of observations corresponding to time bins
-    # // ndays gives index from 0 to total_days // ndays
-    obs_idxs = list(doys.astype(int) // ndays)
-    split_idxs = []
-    # Get the locations within the obs_idxs vector that change
-    # to a new time bin (will be used for splitting)
-    for idx in range(1, int(total_days//ndays)):
-        if idx in obs_idxs:
-            split_idxs.append(obs_idxs.index(idx))
-        # if no observations are in bin 1, append the 0 index
-        # to indicate that the bin is empty
-        elif idx == 1:
-            split_idxs.append(0)
-        # if observations are not in the bin, use the same index 
-        #  as the previous bin, to indicate the bin is empty
-        else:
-            split_idxs.append(prev_split_idx)
-        prev_split_idx = split_idxs[-1]
-        
-    # split the array according to the indices of the time bins
-    split_arr = np.split(arr, split_idxs, axis=3)
- 
-    # For each bin, create a composite according to a "reduction"
-    #  and append for concatenation into a new reduced array
-    composites = []
-    for a in split_arr:
-        if a.shape[3] == 0:
-            a = np.zeros((a.shape[0], a.shape[1], a.shape[2], 1))
-        if reduction == 'avg':
-            cur_agg = np.mean(a, axis=3)
-        elif reduction == 'min':
-            cur_agg = np.min(a, axis=3)
-        elif reduction == 'max':
-            cur_agg = np.max(a, axis=3)
-        elif reduction == 'median':
-            cur_agg = np.median(a, axis=3)
-        composites.append(np.expand_dims(cur_agg, axis=3))
-
-    new_arr = np.concatenate(composites, axis=3)
+    bin_idxs, num_bins = get_time_bins(doys, ndays, total_days)
+    new_arr = composite(arr, bin_idxs, num_bins, reduction)
     new_doys = np.asarray(list(range(0, total_days-ndays+1, ndays)))
     return new_arr, new_doys
 
+def split_and_aggregate_batch(arrs, doys, ndays, reduction='avg'):
+    """
+    Aggregates a batch of grids along the time dimension in a single pass
+
+    Args:
+      arrs - (list of np arrays) [bands x rows x cols x timestamps] grids, timestamps may differ per grid
+      doys - (list of vectors) days of year associated with each grid in arrs
+      ndays - number of days to aggregate together
+      reduction - (str) one of AGG_REDUCTIONS
+
+    Returns:
+      new_arrs - (np array) [grids x bands x rows x cols x 364 // ndays] composites
+      new_doys - (np array) first day of year of each bin
+    """
+    total_days = 364
+    all_bin_idxs = []
+    for grid_idx, grid_doys in enumerate(doys):
+        bin_idxs, num_bins = get_time_bins(grid_doys, ndays, total_days)
+        # offset the bins so that every grid gets its own set
+        all_bin_idxs.append(bin_idxs + grid_idx * num_bins)
+
+    stacked = np.concatenate([np.asarray(arr, dtype=np.float64) for arr in arrs], axis=-1)
+    new_arrs = composite(stacked, np.concatenate(all_bin_idxs), num_bins * len(arrs), reduction)
+    new_arrs = new_arrs.reshape(new_arrs.shape[:-1] + (len(arrs), num_bins))
+    new_arrs = np.moveaxis(new_arrs, -2, 0)
+    new_doys = np.asarray(list(range(0, total_days-ndays+1, ndays)))
+    return new_arrs, new_doys
+
+def get_s2_bands(num_bands):
+    """ Returns the Sentinel-2 bands used as input, to index the bands axis with.
+
+    Args:
+      num_bands - (int) 4 for B, G, R, NIR or 10 for all bands
+    """
+    if num_bands == 4:
+        return [BANDS['s2']['10']['BLUE'], 
+                BANDS['s2']['10']['GREEN'], 
+                BANDS['s2']['10']['RED'],
+                BANDS['s2']['10']['NIR']] #B, G, R, NIR
+    elif num_bands == 10:
+        return slice(0, 10)
+    raise ValueError('s2_num_bands must be 4 or 10')
+
+def set_s1_ratio(arr):
+    """ Recomputes the VH/VV band of [bands x rows x cols x timestamps] Sentinel-1 data in place, 0 where VV is 0
+    """
+    # Replace the VH/VV band with a cleaner band after aggregation??
+    with np.errstate(divide='ignore', invalid='ignore'):
+        arr[BANDS['s1']['RATIO'],:,:,:] = arr[BANDS['s1']['VH'],:,:,:] / arr[BANDS['s1']['VV'],:,:,:]
+        arr[BANDS['s1']['RATIO'],:,:,:][arr[BANDS['s1']['VV'],:,:,:] == 0] = 0
+    return arr
+
 class CropTypeDS(Dataset):
 
     def __init__(self, args, grid_path, split):
@@ -165,7 +282,9 @@ class CropTypeDS(Dataset):
         
         self.num_classes = NUM_CLASSES[args.country]
         self.split = split
-        self.apply_transforms = args.apply_transforms
+        # with batch_transforms the train loop augments whole batches instead
+        self.apply_transforms = args.apply_transforms and not args.batch_transforms
+        self.int_labels = args.int_labels
         self.normalize = args.normalize
         self.sample_w_clouds = args.sample_w_clouds
         self.include_clouds = args.include_clouds
@@ -178,59 +297,141 @@ class CropTypeDS(Dataset):
         self.timeslice = args.time_slice
         self.least_cloudy = args.least_cloudy
         self.s2_num_bands = args.s2_num_bands
+        # compile_dataset turns this off to keep every timestep
+        self.sample_timesteps = True
         
-        with h5py.File(self.hdf5_filepath, 'r') as data:
-            self.combined_lengths = []
-            for grid in self.grid_list:
-                total_len = 0
-                if self.use_s1:
-                    total_len += data['s1_length'][grid][()]
-                if self.use_s2:
-                    total_len += data['s2_length'][grid][()]
-                if self.use_planet:
-                    total_len += data['planet_length'][grid][()]
-                self.combined_lengths.append(total_len)                    
+        # size of the h5py raw chunk cache for each pooled handle
+        self.hdf5_rdcc_nbytes = None
+        if args.hdf5_chunk_cache_mb is not None:
+            self.hdf5_rdcc_nbytes = int(args.hdf5_chunk_cache_mb * 1024 ** 2)
+
+        # per-grid lengths, dates, label counts and cloud scores, read once per process
+        self.metadata = storage.get_grid_metadata(self.hdf5_filepath, self.get_data())
+        self.combined_lengths = []
+        for grid in self.grid_list:
+            total_len = 0
+            if self.use_s1:
+                total_len += self.metadata.length('s1', grid)
+            if self.use_s2:
+                total_len += self.metadata.length('s2', grid)
+            if self.use_planet:
+                total_len += self.metadata.length('planet', grid)
+            self.combined_lengths.append(total_len)                    
+
+        # aggregated timeseries are deterministic, optionally read them precomputed
+        self.composite_stores = {}
+        if args.composite_cache:
+            self.setup_composite_stores()
+
+    def setup_composite_stores(self):
+        """ Opens the composite file of each aggregated sensor, building it first if missing or stale.
+        """
+        data = self.get_data()
+        num_bands = { 's1': S1_NUM_BANDS, 's2': self.s2_num_bands, 'planet': PLANET_NUM_BANDS }
+        for sat, use, agg in [('s1', self.use_s1, self.s1_agg), 
+                              ('s2', self.use_s2, self.s2_agg), 
+                              ('planet', self.use_planet, self.planet_agg)]:
+            if not (use and agg):
+                continue
+            suffix = f'_resize{self.grid_size}' if sat == 'planet' and self.resize_planet else ''
+            store = storage.CompositeStore(self.hdf5_filepath, sat, self.agg_days, AGG_REDUCTION[sat], num_bands[sat], suffix)
+            if store.is_stale():
+                print(f'Building composite file {store.filepath}')
+                store.build(sorted(data.grids(sat)), lambda grids, sat=sat: self.compute_composites(sat, grids))
+            store.load_index()
+            self.composite_stores[sat] = store
+
+    def compute_composites(self, sat, grids):
+        """ Aggregates the full timeseries of sat for a list of grids.
+
+        Args:
+          sat - (str) 's1', 's2' or 'planet'
+          grids - (list of str) grid ids
+
+        Returns:
+          composites - (np array) [grids x bands x rows x cols x bins] composites
+          doys - (np array) first day of year of each bin
+        """
+        data = self.get_data()
+        arrs, doys = [], []
+        for grid in grids:
+            bands = get_s2_bands(self.s2_num_bands) if sat in ['s2'] else None
+            arr = data.read(sat, grid, bands)
+            if sat in ['planet']:
+                arr = self.resize_planet_grid(arr.astype(np.double))
+            arrs.append(arr)
+            doys.append(data.read(f'{sat}_dates', grid))
+        composites, new_doys = split_and_aggregate_batch(arrs, doys, self.agg_days, reduction=AGG_REDUCTION[sat])
+        if sat in ['s1']:
+            for grid_composite in composites:
+                set_s1_ratio(grid_composite)
+        return composites, new_doys
+
+    def get_data(self):
+        """ Returns a reader over this process' pooled handle to the dataset's hdf5 file.
+        """
+        return storage.get_grid_reader(self.hdf5_filepath, self.hdf5_rdcc_nbytes)
 
     def __len__(self):
         return self.num_grids
 
+    def get_sampled_lengths(self):
+        """ Returns the [grids x used sensors] number of timesteps of each grid once sampled or aggregated.
+        """
+        lengths = []
+        for sat, use, agg in [('s1', self.use_s1, self.s1_agg), 
+                              ('s2', self.use_s2, self.s2_agg), 
+                              ('planet', self.use_planet, self.planet_agg)]:
+            if not use: continue
+            if agg:
+                sat_lengths = np.full(self.num_grids, get_time_bins([], self.agg_days)[1])
+            else:
+                sat_lengths = np.array([self.metadata.length(sat, grid) for grid in self.grid_list])
+                if not self.all_samples:
+                    sat_lengths = np.minimum(sat_lengths, self.num_timesteps)
+            lengths.append(sat_lengths)
+        return np.stack(lengths, axis=1)
+
+    def get_sat_properties(self):
+        return { 's1': {'data': None, 'doy': None, 'use': self.use_s1, 'agg': self.s1_agg,
+                        'agg_reduction': AGG_REDUCTION['s1'], 'cloudmasks': None },
+                 's2': {'data': None, 'doy': None, 'use': self.use_s2, 'agg': self.s2_agg,
+                        'agg_reduction': AGG_REDUCTION['s2'], 'cloudmasks': None, 'num_bands': self.s2_num_bands },
+                 'planet': {'data': None, 'doy': None, 'use': self.use_planet, 'agg': self.planet_agg,
+                            'agg_reduction': AGG_REDUCTION['planet'], 'cloudmasks': None, 'num_bands': PLANET_NUM_BANDS } }
+
     def __getitem__(self, idx):
-        with h5py.File(self.hdf5_filepath, 'r') as data:
-            sat_properties = { 's1': {'data': None, 'doy': None, 'use': self.use_s1, 'agg': self.s1_agg,
-                                      'agg_reduction': 'avg', 'cloudmasks': None },
-                               's2': {'data': None, 'doy': None, 'use': self.use_s2, 'agg': self.s2_agg,
-                                      'agg_reduction': 'min', 'cloudmasks': None, 'num_bands': self.s2_num_bands },
-                               'planet': {'data': None, 'doy': None, 'use': self.use_planet, 'agg': self.planet_agg,
-                                          'agg_reduction': 'median', 'cloudmasks': None, 'num_bands': PLANET_NUM_BANDS } }
-
-            for sat in ['s1', 's2', 'planet']:
-                sat_properties = self.setup_data(data, idx, sat, sat_properties)
+        data = self.get_data()
+        sat_properties = self.get_sat_properties()
+
+        for sat in ['s1', 's2', 'planet']:
+            sat_properties = self.setup_data(data, idx, sat, sat_properties)
  
-            transform = self.apply_transforms and np.random.random() < .5 and self.split == 'train'
-            rot = np.random.randint(0, 4)
+        transform = self.apply_transforms and np.random.random() < .5 and self.split == 'train'
+        rot = np.random.randint(0, 4)
 
-            label = data['labels'][self.grid_list[idx]][()]
-            label = preprocess.preprocess_label(label, self.model_name, self.num_classes, transform, rot) 
+        label = data.read('labels', self.grid_list[idx])
+        label = preprocess.preprocess_label(label, self.model_name, self.num_classes, transform, rot, not self.int_labels) 
         
-            if not self.var_length:
-                grid, highres_grid = preprocess.concat_s1_s2_planet(sat_properties['s1']['data'],
-                                                      sat_properties['s2']['data'], 
-                                                      sat_properties['planet']['data'], self.resize_planet)
-                grid = preprocess.preprocess_grid(grid, self.model_name, self.timeslice, transform, rot)
-                if highres_grid is not None: 
-                    highres_grid = preprocess.preprocess_grid(highres_grid, self.model_name, self.timeslice, transform, rot)           
-            else:
-                inputs = {}
-                if self.use_s1:
-                    s1 = preprocess.preprocess_grid(sat_properties['s1']['data'], self.model_name, self.timeslice, transform, rot)
-                    inputs['s1'] = s1
-                if self.use_s2:
-                    s2 = preprocess.preprocess_grid(sat_properties['s2']['data'], self.model_name, self.timeslice, transform, rot)
-                    inputs['s2'] = s2
-                if self.use_planet:
-                    planet = preprocess.preprocess_grid(sat_properties['planet']['data'], self.model_name, self.timeslice, transform, rot)
-                    inputs['planet'] = planet
-                highres_grid = None      
+        if not self.var_length:
+            grid, highres_grid = preprocess.concat_s1_s2_planet(sat_properties['s1']['data'],
+                                                  sat_properties['s2']['data'], 
+                                                  sat_properties['planet']['data'], self.resize_planet)
+            grid = preprocess.preprocess_grid(grid, self.model_name, self.timeslice, transform, rot)
+            if highres_grid is not None: 
+                highres_grid = preprocess.preprocess_grid(highres_grid, self.model_name, self.timeslice, transform, rot)           
+        else:
+            inputs = {}
+            if self.use_s1:
+                s1 = preprocess.preprocess_grid(sat_properties['s1']['data'], self.model_name, self.timeslice, transform, rot)
+                inputs['s1'] = s1
+            if self.use_s2:
+                s2 = preprocess.preprocess_grid(sat_properties['s2']['data'], self.model_name, self.timeslice, transform, rot)
+                inputs['s2'] = s2
+            if self.use_planet:
+                planet = preprocess.preprocess_grid(sat_properties['planet']['data'], self.model_name, self.timeslice, transform, rot)
+                inputs['planet'] = planet
+            highres_grid = None      
           
         if sat_properties['s2']['cloudmasks'] is None:
             cloudmasks = False
@@ -244,62 +445,72 @@ class CropTypeDS(Dataset):
         else:
             return grid, label, cloudmasks, highres_grid
     
+    def resize_planet_grid(self, arr):
+        """ Resizes [bands x rows x cols x timestamps] planet data to the country's grid size if resize_planet is set
+        """
+        if not self.resize_planet or arr.shape[1:3] == (self.grid_size, self.grid_size):
+            return arr
+        return imresize(arr, (arr.shape[0], self.grid_size, self.grid_size, arr.shape[3]), 
+                        anti_aliasing=True, mode='reflect')
+
     def setup_planet(self, data, sat, sat_properties): 
-        sat_properties[sat]['data'] = sat_properties[sat]['data'][:, :, :, :].astype(np.double)  
-        if self.resize_planet:
-            sat_properties[sat]['data'] = imresize(sat_properties[sat]['data'], 
-                                                  (sat_properties[sat]['data'].shape[0], self.grid_size, self.grid_size, sat_properties[sat]['data'].shape[3]), 
-                                                   anti_aliasing=True, mode='reflect')
+        sat_properties[sat]['data'] = sat_properties[sat]['data'].astype(np.double)  
+        sat_properties[sat]['data'] = self.resize_planet_grid(sat_properties[sat]['data'])
                 
-    def setup_s2(self, data, idx, sat, sat_properties):
-        if sat_properties[sat]['num_bands'] == 4:
-            sat_properties[sat]['data'] = sat_properties[sat]['data'][[BANDS[sat]['10']['BLUE'], 
-                                                                       BANDS[sat]['10']['GREEN'], 
-                                                                       BANDS[sat]['10']['RED'],
-                                                                       BANDS[sat]['10']['NIR']], 
-                                                                       :, :, :] #B, G, R, NIR
-        elif sat_properties[sat]['num_bands'] == 10:
-            sat_properties[sat]['data'] = sat_properties[sat]['data'][:10, :, :, :]
-        elif sat_properties[sat]['num_bands'] != 10:
-            raise ValueError('s2_num_bands must be 4 or 10')
-
+    def setup_s2(self, data, idx, sat, sat_properties, times=None):
         if self.include_clouds:
-            sat_properties[sat]['cloudmasks'] = data['cloudmasks'][self.grid_list[idx]][()]
+            sat_properties[sat]['cloudmasks'] = preprocess.remap_cloud_stack(data.read('cloudmasks', self.grid_list[idx], times=times))
+
+    def read_cloud_scores(self, data, idx):
+        """ Returns the cloud score of each s2 timestep, without reading the cloudmasks if the file has cloud_scores.
+        """
+        scores = self.metadata.cloud_scores(self.grid_list[idx])
+        if scores is not None:
+            return scores
+        return preprocess.get_cloud_scores(data.read('cloudmasks', self.grid_list[idx]))
+
+    def select_timesteps(self, data, idx, sat, sat_properties):
+        """ Samples which timesteps of a sensor to read, before reading any of its data.
+
+        Returns:
+          times - (np array) sorted indices of the timesteps to read, None to read all of them
+        """
+        if sat_properties[sat]['agg'] or not self.sample_timesteps:
+            return None
+        scores = None
+        if sat in ['s2'] and self.sample_w_clouds:
+            scores = self.read_cloud_scores(data, idx)
+        return preprocess.sample_timestep_idxs(self.metadata.length(sat, self.grid_list[idx]), self.num_timesteps, scores,
+                                               least_cloudy=self.least_cloudy, all_samples=self.all_samples)
     
     def setup_data(self, data, idx, sat, sat_properties):
         if sat_properties[sat]['use']:
-            sat_properties[sat]['data'] = data[sat][self.grid_list[idx]] 
+            if sat_properties[sat]['agg'] and sat in self.composite_stores:
+                store = self.composite_stores[sat]
+                sat_properties[sat]['data'] = store.read(self.grid_list[idx], self.hdf5_rdcc_nbytes).astype(np.double)
+                sat_properties[sat]['doy'] = store.doys
+                times = None
+            else:
+                # only the sampled timesteps and, for s2, the used bands are read
+                times = self.select_timesteps(data, idx, sat, sat_properties)
+                bands = get_s2_bands(sat_properties[sat]['num_bands']) if sat in ['s2'] else None
+                sat_properties[sat]['data'] = data.read(sat, self.grid_list[idx], bands, times)
             
-            if sat in ['planet']:
-                self.setup_planet(data, sat, sat_properties)
+                if sat in ['planet']:
+                    self.setup_planet(data, sat, sat_properties)
+                # aggregation needs the dates to bin observations, even without include_doy
+                if self.include_doy or sat_properties[sat]['agg']:
+                    sat_properties[sat]['doy'] = data.read(f'{sat}_dates', self.grid_list[idx], times=times)
+                if sat_properties[sat]['agg']:
+                    sat_properties[sat]['data'], sat_properties[sat]['doy'] = split_and_aggregate(sat_properties[sat]['data'], 
+                                                                                              sat_properties[sat]['doy'],
+                                                                                              self.agg_days, 
+                                                                                              reduction=sat_properties[sat]['agg_reduction'])
+                    if sat in ['s1']:
+                        set_s1_ratio(sat_properties[sat]['data'])
+
             if sat in ['s2']:
-                self.setup_s2(data, idx, sat, sat_properties)
-            if self.include_doy:
-                sat_properties[sat]['doy'] = data[f'{sat}_dates'][self.grid_list[idx]][()]
-            if sat_properties[sat]['agg']:
-                sat_properties[sat]['data'], sat_properties[sat]['doy'] = split_and_aggregate(sat_properties[sat]['data'], 
-                                                                                          sat_properties[sat]['doy'],
-                                                                                          self.agg_days, 
-                                                                                          reduction=sat_properties[sat]['agg_reduction'])
-                
-                # Replace the VH/VV band with a cleaner band after aggregation??
-                if sat in ['s1']:
-                    with np.errstate(divide='ignore', invalid='ignore'):
-                        sat_properties[sat]['data'][BANDS[sat]['RATIO'],:,:,:] = sat_properties[sat]['data'][BANDS[sat]['VH'],:,:,:] / sat_properties[sat]['data'][BANDS[sat]['VV'],:,:,:]
-                        sat_properties[sat]['data'][BANDS[sat]['RATIO'],:,:,:][sat_properties[sat]['data'][BANDS[sat]['VV'],:,:,:] == 0] = 0
-            
-            else:
-                sat_properties[sat]['data'], sat_properties[sat]['doy'], sat_properties[sat]['cloudmasks'] = preprocess.sample_timeseries(sat_properties[sat]['data'],
-                                                                                                               self.num_timesteps, sat_properties[sat]['doy'],
-                                                                                                               cloud_stack = sat_properties[sat]['cloudmasks'],
-                                                                                                               least_cloudy=self.least_cloudy,
-                                                                                                               sample_w_clouds=self.sample_w_clouds, 
-                                                                                                               all_samples=self.all_samples)
-
-            if sat in ['planet'] and self.resize_planet:
-                sat_properties[sat]['data'] = imresize(sat_properties[sat]['data'], 
-                                                       (sat_properties[sat]['data'].shape[0], self.grid_size, self.grid_size, sat_properties[sat]['data'].shape[3]), 
-                                                       anti_aliasing=True, mode='reflect')
+                self.setup_s2(data, idx, sat, sat_properties, times)
 
             # Include NDVI and GCVI for s2 and planet, calculate before normalization and numband selection but AFTER AGGREGATION
             if self.include_indices and sat in ['planet', 's2']:
@@ -334,61 +545,264 @@ class CropTypeDS(Dataset):
         return sat_properties
 
 
+class ShardDataset(Dataset):
+    """
+        Reads the training shards written by compile_dataset.py.
+
+        Everything deterministic in CropTypeDS was applied when compiling, so a sample
+        is only sampled in time and rotated, reading from memory-mapped shards.
+
+        With --feature_cache, the float16 encoder features cache_features.py wrote next
+        to the shards are read instead of the shards. Inputs are then always a dict with
+        the first of CACHED_FEATS under <sat> and the others under <sat>_<feat>.
+    """
+    def __init__(self, args, shard_dir, split):
+        index = np.load(os.path.join(shard_dir, 'index.npz'))
+        config = json.loads(str(index['config']))
+        mismatched = [arg for arg in SHARD_ARGS if config[arg] != getattr(args, arg)]
+        if mismatched:
+            raise ValueError(f'Shards in {shard_dir} were compiled with different {mismatched}, rerun compile_dataset.py')
+
+        self.model_name = args.model_name
+        self.grid_list = list(index['grids'])
+        self.num_grids = len(self.grid_list)
+        self.labels = index['labels']
+        self.num_classes = NUM_CLASSES[args.country]
+        self.split = split
+        self.resize_planet = args.resize_planet
+        # with batch_transforms the train loop augments whole batches instead
+        self.apply_transforms = args.apply_transforms and not args.batch_transforms
+        self.int_labels = args.int_labels
+        self.sample_w_clouds = args.sample_w_clouds
+        self.include_clouds = args.include_clouds
+        self.num_timesteps = args.num_timesteps
+        self.all_samples = args.all_samples
+        self.var_length = args.var_length
+        self.timeslice = args.time_slice
+        self.least_cloudy = args.least_cloudy
+        # cloudmasks are stacked after the s2 bands and vegetation indices
+        self.cloud_channel = args.s2_num_bands + (2 if args.include_indices else 0)
+
+        self.sats = [sat for sat in ['s1', 's2', 'planet'] if getattr(args, f'use_{sat}')]
+        self.agg = { 's1': args.s1_agg, 's2': args.s2_agg, 'planet': args.planet_agg }
+        self.feature_cache = args.feature_cache
+        if self.feature_cache:
+            self.feat_names = self.check_feature_cache(args, shard_dir)
+        self.shards, self.offsets, self.lengths, self.scores = {}, {}, {}, {}
+        for sat in self.sats:
+            if self.feature_cache:
+                self.shards[sat] = { name: np.load(os.path.join(shard_dir, f'{sat}_{name}.npy'), mmap_mode='r') 
+                                     for name in self.feat_names }
+            else:
+                self.shards[sat] = np.load(os.path.join(shard_dir, f'{sat}.npy'), mmap_mode='r')
+            self.offsets[sat] = index[f'{sat}_offsets']
+            self.lengths[sat] = index[f'{sat}_lengths']
+            self.scores[sat] = index[f'{sat}_scores']
+        self.combined_lengths = [sum(self.lengths[sat][i] for sat in self.sats) for i in range(self.num_grids)]
+
+    def check_feature_cache(self, args, shard_dir):
+        """ Checks that the features cached in shard_dir fit args, returns the names of the cached features.
+        """
+        if not args.early_feats:
+            raise ValueError('--feature_cache needs --early_feats, only encoder features are cached')
+        if not os.path.exists(os.path.join(shard_dir, 'features.json')):
+            raise ValueError(f'No cached features in {shard_dir}, run cache_features.py')
+        with open(os.path.join(shard_dir, 'features.json')) as f:
+            config = json.load(f)
+        mismatched = [arg for arg in FEATURE_CACHE_ARGS if config[arg] != getattr(args, arg)]
+        if mismatched:
+            raise ValueError(f'Features in {shard_dir} were cached with different {mismatched}, rerun cache_features.py')
+        # the encoder saw unrotated grids, and rotating its features is not the same as encoding rotated grids
+        if args.apply_transforms:
+            raise ValueError('--feature_cache cannot be used with --apply_transforms')
+        if not self.var_length and len(self.sats) > 1:
+            raise ValueError('--feature_cache needs --var_length with more than one sensor')
+        return CACHED_FEATS
+
+    def get_sampled_lengths(self):
+        """ Returns the [grids x used sensors] number of timesteps of each grid once sampled.
+        """
+        lengths = []
+        for sat in self.sats:
+            sat_lengths = np.asarray(self.lengths[sat])
+            if not self.agg[sat] and not self.all_samples:
+                sat_lengths = np.minimum(sat_lengths, self.num_timesteps)
+            lengths.append(sat_lengths)
+        return np.stack(lengths, axis=1)
+
+    def __len__(self):
+        return self.num_grids
+
+    def __getitem__(self, idx):
+        transform = self.apply_transforms and np.random.random() < .5 and self.split == 'train'
+        rot = np.random.randint(0, 4)
+
+        label = preprocess.preprocess_label(self.labels[idx], self.model_name, self.num_classes, transform, rot, not self.int_labels) 
+
+        sat_grids = { 's1': None, 's2': None, 'planet': None }
+        cloudmasks = False
+        inputs = {}
+        for sat in self.sats:
+            start, length = self.offsets[sat][idx], self.lengths[sat][idx]
+            samples = None
+            if not self.agg[sat]:
+                scores = self.scores[sat][start:start+length] if sat in ['s2'] and self.sample_w_clouds else None
+                samples = preprocess.sample_timestep_idxs(length, self.num_timesteps, scores, 
+                                                          least_cloudy=self.least_cloudy, all_samples=self.all_samples)
+            rows = slice(start, start+length) if samples is None else start + samples
+            if self.feature_cache:
+                # [timestamps x ...] float16 features, upcast by the model on the device
+                for i, name in enumerate(self.feat_names):
+                    inputs[sat if i == 0 else f'{sat}_{name}'] = torch.from_numpy(np.ascontiguousarray(self.shards[sat][name][rows]))
+                continue
+            grid = self.shards[sat][rows]
+            # back to [bands x rows x cols x timestamps] as a view
+            sat_grids[sat] = np.transpose(grid, [1, 2, 3, 0])
+            if sat in ['s2'] and self.include_clouds:
+                cloudmasks = sat_grids[sat][self.cloud_channel:self.cloud_channel+1].astype(np.double)
+
+        if self.feature_cache:
+            return inputs, label, cloudmasks, False
+
+        if not self.var_length:
+            grid, highres_grid = preprocess.concat_s1_s2_planet(sat_grids['s1'], sat_grids['s2'], 
+                                                                sat_grids['planet'], self.resize_planet)
+            grid = preprocess.preprocess_grid(grid, self.model_name, self.timeslice, transform, rot)
+            if highres_grid is not None: 
+                highres_grid = preprocess.preprocess_grid(highres_grid, self.model_name, self.timeslice, transform, rot)           
+            else:
+                highres_grid = False
+            return grid, label, cloudmasks, highres_grid
+        
+        inputs = { sat: preprocess.preprocess_grid(sat_grids[sat], self.model_name, self.timeslice, transform, rot) 
+                   for sat in self.sats }
+        return inputs, label, cloudmasks, False
+
+
 class CropTypeBatchSampler(Sampler):
     """
         Groups sequences of similiar length into the same batch to prevent unnecessary computation.
+
+        Batches are rebuilt every epoch. Grids are shuffled and split into pools, each
+        pool is sorted by length and packed into batches that hold at most max_batch_size
+        grids and, if set, at most max_batch_timesteps timesteps once padded to the
+        longest grid of the batch in each sensor. Batch order is shuffled as well.
     """
-    def __init__(self, dataset, max_batch_size, max_seq_length):
+    def __init__(self, dataset, max_batch_size, max_batch_timesteps=None, pool_batches=50):
+        """
+        Args:
+          dataset - (CropTypeDS or ShardDataset) dataset to batch
+          max_batch_size - (int) maximum number of grids in a batch
+          max_batch_timesteps - (int) maximum padded timesteps in a batch, summed over sensors; no limit if None
+          pool_batches - (int) number of max_batch_size batches per pool sorted by length
+        """
         super(CropTypeBatchSampler, self).__init__(dataset)
+        # [grids x sensors] timesteps of each grid once sampled
+        self.lengths = dataset.get_sampled_lengths()
+        self.max_batch_size = max_batch_size
+        self.max_batch_timesteps = max_batch_timesteps
+        self.pool_size = pool_batches * max_batch_size
+        self.batches = None
+        # fraction of the timesteps in the last epoch's batches that are padding
+        self.padded_fraction = None
+
+    def make_batches(self):
+        """ Shuffles and packs the grids into batches for one epoch.
+
+        Returns:
+          batches - (list of lists) grid indices of each batch
+        """
+        idxs = np.random.permutation(len(self.lengths))
         batches = []
-        idxs = list(range(len(dataset)))
-        
-        # shuffle the dataset
-        shuffle(idxs)
-        lengths = [min(dataset.combined_lengths[i], 2 * max_seq_length) for i in idxs] # 2x since we're measure combined s1 / s2
-        
-        buckets = defaultdict(list)
-        
-        for i in idxs:
-            buckets[lengths[i] // 10].append(i)
-        
-        for bucket_length, bucket in buckets.items():
+        for start in range(0, len(idxs), self.pool_size):
+            pool = idxs[start:start+self.pool_size]
+            # stable sort keeps the shuffled order among grids of equal length
+            pool = pool[np.argsort(self.lengths[pool].sum(axis=1), kind='stable')]
+
             batch = []
-            # TODO: why are grids of length ~60 being grouped with grids of length 100+?
-            while len(bucket) > 0:
-                grid = bucket.pop()
-                batch.append(grid)
-                if len(batch) == max_batch_size:
+            batch_max = np.zeros(self.lengths.shape[1], dtype=int)
+            for i in pool:
+                new_max = np.maximum(batch_max, self.lengths[i])
+                full = len(batch) == self.max_batch_size
+                over_budget = (self.max_batch_timesteps is not None and 
+                               (len(batch) + 1) * new_max.sum() > self.max_batch_timesteps)
+                if batch and (full or over_budget):
                     batches.append(batch)
                     batch = []
-            
+                    new_max = self.lengths[i]
+                batch.append(int(i))
+                batch_max = new_max
             if len(batch) > 0:
                 batches.append(batch)
-        
-        self.batches = batches
+
+        return [batches[i] for i in np.random.permutation(len(batches))]
+
+    def get_padded_fraction(self, batches):
+        """ Fraction of the timesteps of batches that pad_to_equal_length fills with zeros.
+        """
+        padded = sum(len(batch) * self.lengths[batch].max(axis=0).sum() for batch in batches)
+        return 1 - self.lengths.sum() / padded
         
     def __iter__(self):
-        for b in self.batches:
+        if self.batches is None:
+            self.batches = self.make_batches()
+        # hand out this epoch's batches, the next epoch gets new ones
+        batches, self.batches = self.batches, None
+        self.padded_fraction = self.get_padded_fraction(batches)
+        for b in batches:
             yield(b)
         
     def __len__(self):
+        if self.batches is None:
+            self.batches = self.make_batches()
         return len(self.batches)
 
 
-def pad_to_equal_length(grids):
-    # time first
-    _, c, h, w = grids[0].shape
-    lengths = [grid.shape[0] for grid in grids]
-    max_len = np.max(lengths)
-    min_len = np.min(lengths)
-    
+def in_dataloader_worker():
+    """ Whether the caller runs in a DataLoader worker process.
+    """
+    get_worker_info = getattr(torch.utils.data, 'get_worker_info', None)
+    if get_worker_info is not None:
+        return get_worker_info() is not None
+    # older torch flags collation in workers with a module global instead
+    return getattr(torch.utils.data.dataloader, '_use_shared_memory', False)
+
+def new_batch_tensor(shape, dtype=torch.float32):
+    """ Allocates an uninitialized batch tensor, float32 by default, in shared memory inside a
+        DataLoader worker so that it reaches the main process without another copy.
+    """
+    batch = torch.empty(shape, dtype=dtype)
+    if in_dataloader_worker():
+        batch.share_memory_()
+    return batch
+
+def pad_to_equal_length(grids, time_axis=0, dtype=torch.float32):
+    """ Pads grids with zeros along time into one preallocated batch.
+
+    Every grid is written straight into the batch, so each sample is copied once.
+
+    Args:
+      grids - (list of tensors / np arrays) grids of a batch, equal in all but the time axis
+      time_axis - (int) time axis of each grid
+      dtype - (torch dtype) dtype of the batch
+
+    Returns:
+      batch - (tensor) [batch x ...] grids padded to the longest one
+      lengths - (LongTensor) [batch] timesteps of each grid
+    """
+    time_axis = time_axis % len(grids[0].shape)
+    lengths = torch.tensor([grid.shape[time_axis] for grid in grids], dtype=torch.long)
+    max_len = int(lengths.max())
+    shape = list(grids[0].shape)
+    shape[time_axis] = max_len
+
+    batch = new_batch_tensor([len(grids)] + shape, dtype)
     for i, grid in enumerate(grids):
-        t, _, _, _ = grid.shape
-        if t < max_len:
-            padded = np.zeros((max_len, c, h, w))
-            padded[:lengths[i], :, :, :] = grid
-            grids[i] = torch.tensor(padded, dtype=torch.float32)
-    return grids, lengths
+        length = grid.shape[time_axis]
+        batch[i].narrow(time_axis, 0, length).copy_(torch.as_tensor(grid))
+        if length < max_len:
+            batch[i].narrow(time_axis, length, max_len - length).zero_()
+    return batch, lengths
     
     
 def collate_var_length(batch):
@@ -401,23 +815,30 @@ def collate_var_length(batch):
         where s1 has all same length (padded to max len)
               s2 has all same length (padded to max len)
               planet has all same length (paddedd to max len)
+        and inputs also holds, for each sensor, <sat>_lengths, the LongTensor of 
+        timesteps of each grid, and <sat>_mask, the [batch x max len] mask of non-padded timesteps.
+        Cached <sat>_<feat> features are padded like their sensor and stay float16.
     """
     batch_size = len(batch)
-    labels = [batch[i][1] for i in range(batch_size)]
-    labels = torch.stack(labels)
+    labels = new_batch_tensor((batch_size,) + tuple(batch[0][1].shape), batch[0][1].dtype)
+    for i in range(batch_size):
+        labels[i].copy_(batch[i][1])
     inputs = {}
-    sats = batch[0][0].keys()
+    sats = [sat for sat in ['s1', 's2', 'planet'] if sat in batch[0][0]]
     for sat in sats:
-        grids = [batch[i][0][sat] for i in range(batch_size)]
-        grids, lengths = pad_to_equal_length(grids)
-        grids = torch.stack(grids)
+        # cached features are upcast by the model on the device
+        dtype = torch.float16 if batch[0][0][sat].dtype == torch.float16 else torch.float32
+        grids, lengths = pad_to_equal_length([batch[i][0][sat] for i in range(batch_size)], dtype=dtype)
         inputs[sat] = grids
         inputs[sat + "_lengths"] = lengths
+        inputs[sat + "_mask"] = get_length_mask(lengths, grids.shape[1])
+        for key in batch[0][0]:
+            if key.startswith(sat + "_"):
+                inputs[key], _ = pad_to_equal_length([batch[i][0][key] for i in range(batch_size)], dtype=dtype)
   
     if 's2' in sats and not isinstance(batch[0][2], bool): # batch[0][2] checks if cloudmasks exist
-        cloudmasks = [batch[i][2].transpose(3, 0, 1, 2) for i in range(batch_size)]
-        cloudmasks, lengths = pad_to_equal_length(cloudmasks)
-        cloudmasks = torch.tensor(np.stack(cloudmasks).transpose(0, 2, 3, 4, 1))
+        # [batch x 1 x rows x cols x max len], time stays last
+        cloudmasks, _ = pad_to_equal_length([batch[i][2] for i in range(batch_size)], time_axis=-1)
     else:
         cloudmasks = None
         
@@ -427,29 +848,147 @@ def collate_var_length(batch):
 class GridDataLoader(DataLoader):
 
     def __init__(self, args, grid_path, split):
-        dataset = CropTypeDS(args, grid_path, split)
+        if args.shard_dir is not None:
+            dataset = ShardDataset(args, os.path.join(args.shard_dir, split), split)
+        else:
+            dataset = CropTypeDS(args, grid_path, split)
         if args.var_length:
-            sampler = CropTypeBatchSampler(dataset, max_batch_size=args.batch_size, max_seq_length=args.num_timesteps)
+            sampler = CropTypeBatchSampler(dataset, max_batch_size=args.batch_size, max_batch_timesteps=args.max_batch_timesteps)
             super(GridDataLoader, self).__init__(dataset,
                                                  batch_sampler=sampler,
                                                  num_workers=args.num_workers,
                                                  collate_fn=collate_var_length,
+                                                 worker_init_fn=storage.hdf5_worker_init,
                                                  pin_memory=True)
         else:
             super(GridDataLoader, self).__init__(dataset,
                                                  batch_size=args.batch_size,
                                                  shuffle=args.shuffle,
                                                  num_workers=args.num_workers,
+                                                 worker_init_fn=storage.hdf5_worker_init,
                                                  pin_memory=True)
 
+
+def batch_to_device(batch, device, non_blocking=False):
+    """ Moves the tensors of a batch to device.
+
+    Tuples, lists and the var_length input dicts are moved entry by entry, except
+    the <sat>_lengths, which stay on the cpu since they are read on the host.
+    Anything else, like the False placeholders of missing inputs, is returned as is.
+    """
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, dict):
+        return { key: value if key.endswith('_lengths') else batch_to_device(value, device, non_blocking)
+                 for key, value in batch.items() }
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(batch_to_device(value, device, non_blocking) for value in batch)
+    return batch
+
+def batch_tensors(batch):
+    """ Yields every tensor of a batch structured as in batch_to_device
+    """
+    if torch.is_tensor(batch):
+        yield batch
+    elif isinstance(batch, dict):
+        for value in batch.values():
+            yield from batch_tensors(value)
+    elif isinstance(batch, (list, tuple)):
+        for value in batch:
+            yield from batch_tensors(value)
+
+
+class DevicePrefetcher(object):
+    """ Iterates over a DataLoader with every batch already on the device.
+
+    A background thread pulls batches from the loader and moves them to the device
+    while the caller computes on the previous batch. On cuda the copies are
+    non-blocking from the pinned batches of GridDataLoader, on a side stream that
+    the compute stream waits on only when the batch is handed out. On the cpu the
+    thread still overlaps loading and collation with compute.
+
+    Args:
+      loader - (iterable) DataLoader of (inputs, label, cloudmasks, highres) batches
+      device - (str) device to move the batches to
+      num_batches - (int) number of batches to prepare ahead of the caller
+    """
+
+    def __init__(self, loader, device, num_batches=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_batches = num_batches
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _prefetch(self, batches, stop, stream):
+        try:
+            if stream is not None:
+                # the current cuda device is per thread, copy on the device of the stream
+                torch.cuda.set_device(stream.device)
+            for batch in self.loader:
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = batch_to_device(batch, self.device, non_blocking=True)
+                        ready = torch.cuda.Event()
+                        ready.record(stream)
+                else:
+                    batch = batch_to_device(batch, self.device)
+                    ready = None
+                batches.put((batch, ready))
+                if stop.is_set():
+                    return
+        except Exception as e:
+            batches.put(e)
+            return
+        batches.put(None)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+        stream = None
+        if self.device.type == 'cuda':
+            # streams are created on the current device, which need not be self.device
+            with torch.cuda.device(self.device):
+                stream = torch.cuda.Stream()
+        thread = threading.Thread(target=self._prefetch, args=(batches, stop, stream), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, ready = item
+                if ready is not None:
+                    with torch.cuda.device(self.device):
+                        compute_stream = torch.cuda.current_stream()
+                    compute_stream.wait_event(ready)
+                    # the batch memory belongs to the side stream, keep it alive for the compute stream
+                    for tensor in batch_tensors(batch):
+                        tensor.record_stream(compute_stream)
+                yield batch
+        finally:
+            # let a producer blocked on a full queue see the stop
+            stop.set()
+            while thread.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
             
+def get_grid_path(country, dataset, split):
+    if country in ['southsudan', 'ghana']:
+        return os.path.join(GRID_DIR[country], f"{country}_{dataset}_final_{split}_32")
+    return os.path.join(GRID_DIR[country], f"{country}_{dataset}_final_{split}")
+
 def get_dataloaders(country, dataset, args):
     dataloaders = {}
     for split in SPLITS:
-        if country in ['southsudan', 'ghana']:
-            grid_path = os.path.join(GRID_DIR[country], f"{country}_{dataset}_final_{split}_32")
-        else:
-            grid_path = os.path.join(GRID_DIR[country], f"{country}_{dataset}_final_{split}")
+        grid_path = get_grid_path(country, dataset, split)
         dataloaders[split] = GridDataLoader(args, grid_path, split)
 
     return dataloaders
@@ -12,6 +12,17 @@ import preprocess
 
 from constants import *
 
+# loss weights per (country, device, weight_scale), created on first use
+_LOSS_WEIGHTS = {}
+
+def get_loss_weight(country, device, weight_scale=1):
+    """ Returns the LOSS_WEIGHT of a country raised to weight_scale as a tensor on device.
+    """
+    key = (country, str(device), weight_scale)
+    if key not in _LOSS_WEIGHTS:
+        _LOSS_WEIGHTS[key] = torch.tensor(LOSS_WEIGHT[country] ** weight_scale, dtype=torch.float32, device=device)
+    return _LOSS_WEIGHTS[key]
+
 def get_loss_fn(model_name):
     """
         Allows for changing the loss function depending on the model.
@@ -24,7 +35,8 @@ def focal_loss(y_true, y_pred, reduction, country, loss_weight=False, weight_sca
 
     Args:
       y_true - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width]) 
-                tensor of ground truth crop classes
+                tensor of ground truth crop classes, or torch.Size([batch_size, img_height, img_width])
+                uint8 class maps with 0 for unlabeled pixels
       y_pred - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width])
                 tensor of predicted crop classes
       reduction - (str) "sum" specified to return loss and number examples in order to accumulate 
@@ -38,26 +50,34 @@ def focal_loss(y_true, y_pred, reduction, country, loss_weight=False, weight_sca
       num_examples - (int) returned when reduction == "sum" so that loss
                       can be calculated over many batches
     """ 
-    y_true = preprocess.reshapeForLoss(y_true)
-    num_examples = torch.sum(y_true, dtype=torch.float32).cuda()
-    
     bs, classes, rows, cols = y_pred.shape
     
     y_pred = preprocess.reshapeForLoss(y_pred)
-    y_pred, y_true = preprocess.maskForLoss(y_pred, y_true)
+    int_labels = y_true.dim() == 3
+    if int_labels:
+        # integer labels, the loss ignores unlabeled pixels
+        y_true = preprocess.indexLabelsForLoss(y_true).to(y_pred.device)
+        num_examples = torch.sum(y_true != LABEL_IGNORE_INDEX, dtype=torch.float32)
+    else:
+        y_true = preprocess.reshapeForLoss(y_true)
+        num_examples = torch.sum(y_true, dtype=torch.float32)
+        y_pred, y_true = preprocess.maskForLoss(y_pred, y_true)
+        y_true = y_true.to(y_pred.device)
     y_confidence, _ = torch.sort(y_pred, dim=1, descending=True)
     y_confidence = y_confidence[:, 0] - y_confidence[:, 1]
+    if int_labels:
+        y_confidence = y_confidence * (y_true != LABEL_IGNORE_INDEX).type_as(y_confidence)
     y_confidence = y_confidence.view([bs, rows, cols]).detach().cpu().numpy() * 255
-    y_true = y_true.type(torch.LongTensor).cuda()
     
     if loss_weight:
-        loss_fn = nn.NLLLoss(weight = LOSS_WEIGHT[country] ** weight_scale,reduction="none")
+        loss_fn = nn.NLLLoss(weight=get_loss_weight(country, y_pred.device, weight_scale), ignore_index=LABEL_IGNORE_INDEX, reduction="none")
     else:
-        loss_fn = nn.NLLLoss(reduction="none")
+        loss_fn = nn.NLLLoss(ignore_index=LABEL_IGNORE_INDEX, reduction="none")
     
     # get the predictions for each true class
     nll_loss = loss_fn(y_pred, y_true)
-    x = torch.gather(y_pred, dim=1, index=y_true.view(-1, 1))
+    # ignored pixels have no nll loss, any class index does for them
+    x = torch.gather(y_pred, dim=1, index=y_true.clamp(min=0).view(-1, 1))
     # tricky line, essentially gathers the predictions for the correct class and takes e^{pred} to undo 
     # log operation 
     # .view(-1) necessary to get correct shape
@@ -85,7 +105,8 @@ def mask_ce_loss(y_true, y_pred, reduction, country, loss_weight=False, weight_s
     """
     Args:
       y_true - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width]) 
-                tensor of ground truth crop classes
+                tensor of ground truth crop classes, or torch.Size([batch_size, img_height, img_width])
+                uint8 class maps with 0 for unlabeled pixels
       y_pred - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width])
                 tensor of predicted crop classes
       reduction - (str) "sum" specified to return loss and number examples in order to accumulate 
@@ -95,20 +116,26 @@ def mask_ce_loss(y_true, y_pred, reduction, country, loss_weight=False, weight_s
     As input, y_pred and y_true have shapes [batch x classes x rows x cols] 
 
     Finally, to get y_true from [N x classes] to [N x 1], we take the argmax along
-      the first dimension to get the largest class values from the one-hot encoding
+      the first dimension to get the largest class values from the one-hot encoding.
+      Integer labels are only flattened, their unlabeled pixels are ignored by the loss.
 
     """
-    y_true = preprocess.reshapeForLoss(y_true)
-    num_examples = torch.sum(y_true, dtype=torch.float32).cuda()
     y_pred = preprocess.reshapeForLoss(y_pred)
-    y_pred, y_true = preprocess.maskForLoss(y_pred, y_true)
+    if y_true.dim() == 3:
+        y_true = preprocess.indexLabelsForLoss(y_true).to(y_pred.device)
+        num_examples = torch.sum(y_true != LABEL_IGNORE_INDEX, dtype=torch.float32)
+    else:
+        y_true = preprocess.reshapeForLoss(y_true)
+        num_examples = torch.sum(y_true, dtype=torch.float32)
+        y_pred, y_true = preprocess.maskForLoss(y_pred, y_true)
+        y_true = y_true.to(y_pred.device)
    
     if loss_weight:
-        loss_fn = nn.NLLLoss(weight=LOSS_WEIGHT[country] ** weight_scale, reduction="none")
+        loss_fn = nn.NLLLoss(weight=get_loss_weight(country, y_pred.device, weight_scale), ignore_index=LABEL_IGNORE_INDEX, reduction="none")
     else:
-        loss_fn = nn.NLLLoss(reduction="none") 
+        loss_fn = nn.NLLLoss(ignore_index=LABEL_IGNORE_INDEX, reduction="none") 
 
-    total_loss = torch.sum(loss_fn(y_pred, y_true.cuda()))
+    total_loss = torch.sum(loss_fn(y_pred, y_true))
    
     if num_examples == 0:
         print("WARNING: NUMBER OF EXAMPLES IS 0")
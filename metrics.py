@@ -26,17 +26,21 @@ def get_accuracy(model_name, y_pred, y_true, reduction='avg'):
     """
         
     if model_name in DL_MODELS:
-        # Reshape truth labels into [N, num_classes]
-        y_true = preprocess.reshapeForLoss(y_true)
+        if y_true.dim() == 3:
+            # Integer labels, get rid of invalid pixels and take argmax of predictions
+            y_pred, y_true = preprocess.maskIndexForMetric(y_pred, y_true)
+        else:
+            # Reshape truth labels into [N, num_classes]
+            y_true = preprocess.reshapeForLoss(y_true)
 
-        # Reshape predictions into [N, num_classes]
-        y_pred = preprocess.reshapeForLoss(y_pred)
+            # Reshape predictions into [N, num_classes]
+            y_pred = preprocess.reshapeForLoss(y_pred)
 
-        # Get rid of invalid pixels and take argmax
-        y_pred, y_true = preprocess.maskForMetric(y_pred, y_true)
+            # Get rid of invalid pixels and take argmax
+            y_pred, y_true = preprocess.maskForMetric(y_pred, y_true)
     
         # Get metrics for accuracy
-        total_correct = np.sum([y_true.numpy() == y_pred.cpu().numpy()])
+        total_correct = np.sum([y_true.cpu().numpy() == y_pred.cpu().numpy()])
     elif model_name in NON_DL_MODELS:
         total_correct = np.sum(y_true == y_pred)
 
@@ -71,7 +75,7 @@ def get_cm(y_pred, y_true, country, model_name):
 
     Args: 
       y_true - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width]) 
-                tensor of ground truth crop classes
+                tensor of ground truth crop classes, or [batch_size, img_height, img_width] class maps
       y_pred - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width])
                 tensor of predicted crop classes
     
@@ -81,12 +85,88 @@ def get_cm(y_pred, y_true, country, model_name):
     if model_name in NON_DL_MODELS:
         return confusion_matrix(y_true, y_pred, labels=CM_LABELS[country])
     elif model_name in DL_MODELS:
-        # Reshape truth labels into [N, num_classes]
-        y_true = preprocess.reshapeForLoss(y_true)
-        # Reshape predictions into [N, num_classes]
-        y_pred = preprocess.reshapeForLoss(y_pred)
-        y_pred, y_true = preprocess.maskForMetric(y_pred, y_true)
+        if y_true.dim() == 3:
+            y_pred, y_true = preprocess.maskIndexForMetric(y_pred, y_true)
+        else:
+            # Reshape truth labels into [N, num_classes]
+            y_true = preprocess.reshapeForLoss(y_true)
+            # Reshape predictions into [N, num_classes]
+            y_pred = preprocess.reshapeForLoss(y_pred)
+            y_pred, y_true = preprocess.maskForMetric(y_pred, y_true)
         if y_true.shape[0] == 0:
             return None
         else: 
             return confusion_matrix(y_true.cpu(), y_pred.cpu(), labels=CM_LABELS[country])
+
+def get_valid_classes(y_pred, y_true):
+    """
+    Predicted and true classes of the labeled pixels, on the device of y_pred
+
+    Args:
+      y_true - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width])
+                one-hot ground truth crop classes, or torch.Size([batch_size, img_height, img_width])
+                uint8 class maps with 0 for unlabeled pixels
+      y_pred - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width])
+                tensor of predicted crop classes
+
+    Returns:
+      y_pred - (LongTensor) [valid_pixel_locations] predicted classes, argmaxed
+      y_true - (LongTensor) [valid_pixel_locations] ground truth classes
+    """
+    y_true = y_true.to(y_pred.device)
+    if y_true.dim() == 3:
+        return preprocess.maskIndexForMetric(y_pred, y_true)
+    valid = torch.sum(y_true, dim=1) == 1
+    _, y_true = torch.max(y_true, dim=1)
+    _, y_pred = torch.max(y_pred, dim=1)
+    return y_pred[valid], y_true[valid]
+
+class StreamingConfusionMatrix:
+    """ Confusion matrix accumulated over batches on the device of the predictions.
+
+    Each update is a single bincount of num_classes * true + pred over the labeled
+    pixels, nothing is copied to the host until the matrix or a metric is asked for.
+    Rows are true classes and columns predicted classes, as in get_cm.
+    """
+
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        # allocated on the device of the first predictions
+        self.counts = None
+
+    def update(self, y_pred, y_true):
+        """ Adds a batch of predictions and labels to the matrix.
+
+        Args:
+          y_pred - (torch tensor) [batch_size x num_classes x img_height x img_width] predictions
+          y_true - (torch tensor) one-hot or integer labels, see get_valid_classes
+        """
+        y_pred, y_true = get_valid_classes(y_pred.detach(), y_true)
+        counts = torch.bincount(self.num_classes * y_true + y_pred, minlength=self.num_classes ** 2)
+        if self.counts is None:
+            self.counts = counts
+        else:
+            self.counts += counts
+
+    def confusion_matrix(self):
+        """ Returns the [num_classes x num_classes] confusion matrix as an np array
+        """
+        if self.counts is None:
+            return np.zeros((self.num_classes, self.num_classes)).astype(int)
+        return self.counts.cpu().numpy().reshape(self.num_classes, self.num_classes)
+
+    def num_pixels(self):
+        return int(np.sum(self.confusion_matrix()))
+
+    def num_correct(self):
+        return int(np.trace(self.confusion_matrix()))
+
+    def accuracy(self):
+        cm = self.confusion_matrix()
+        return np.trace(cm) / np.sum(cm)
+
+    def f1score(self, avg=True):
+        return get_f1score(self.confusion_matrix(), avg=avg)
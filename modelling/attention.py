@@ -1,29 +1,64 @@
 import torch
 import torch.nn as nn
+from modelling.util import get_length_mask
 
 def attn_or_avg(attention, avg_hidden_states, layer_outputs, rev_layer_outputs, bidirectional, lengths=None):
-    if (attention is None) or (attention(layer_outputs) is None):
-        if not avg_hidden_states:
-            # TODO: want to take the last non-zero padded output here instead!
-            last_fwd_feat = layer_outputs[:, -1, :, :, :]
-            last_rev_feat = rev_layer_outputs[:, -1, :, :, :] if bidirectional else None
-            reweighted = torch.concat([last_fwd_feat, last_rev_feat], dim=1) if bidirectional else last_fwd_feat
-            reweighted = torch.mean(reweighted, dim=1)
-        else:
-            if lengths is not None:
-                layer_outputs = [torch.mean(layer_outputs[i, :length], dim=0) for i, length in enumerate(lengths)]
-                # TODO: sequences are padded, so you need to reverse only the non-padded inputs
-                if rev_layer_outputs is not None: rev_layer_outputs = [torch.mean(rev_layer_outputs[i, :length], dim=0) for i, length in enumerate(lengths)] 
-                outputs = torch.stack(layer_outputs + rev_layer_outputs) if rev_layer_outputs is not None else torch.stack(layer_outputs)
-                reweighted = outputs #?
-            else:
-                outputs = torch.cat([layer_outputs, rev_layer_outputs], dim=1) if rev_layer_outputs is not None else layer_outputs
-                reweighted = torch.mean(outputs, dim=1)
-    else:
-        outputs = torch.cat([layer_outputs, rev_layer_outputs], dim=1) if rev_layer_outputs is not None else layer_outputs
-        reweighted = attention(outputs, lengths)
-        reweighted = torch.sum(reweighted, dim=1)
-    return reweighted
+    """ Reduces the CRNN outputs over time, by attention, by averaging or by taking the last output.
+
+    Args:
+      attention - (ApplyAtt) attention to apply, averages or takes the last output if None or of type 'None'
+      avg_hidden_states - (bool) without attention, average the outputs over time if True, else take the last one
+      layer_outputs - (tensor) [batch x time x channels x rows x cols] forward outputs, padded at the end
+      rev_layer_outputs - (tensor) reverse outputs, in reversed time and padded at the end, or None
+      bidirectional - (bool) whether rev_layer_outputs is used
+      lengths - (tensor) [batch] non-padded timesteps of each sequence, all timesteps if None
+    Returns:
+      (tensor) [batch x channels x rows x cols]
+    """
+    rev_layer_outputs = rev_layer_outputs if bidirectional else None
+    if (attention is None or attention.attention is None) and not avg_hidden_states:
+        # reverse outputs are in reversed time, so their last step is the first input timestep
+        last_feats = [select_last(outputs, lengths) for outputs in [layer_outputs, rev_layer_outputs] if outputs is not None]
+        return torch.mean(torch.stack(last_feats), dim=0)
+
+    # both directions are reduced together, as one sequence of twice the length
+    outputs = torch.cat([layer_outputs, rev_layer_outputs], dim=1) if rev_layer_outputs is not None else layer_outputs
+    mask = None
+    if lengths is not None:
+        mask = get_length_mask(lengths, layer_outputs.shape[1], layer_outputs.device)
+        if rev_layer_outputs is not None:
+            mask = torch.cat([mask, mask], dim=1)
+
+    if attention is None or attention.attention is None:
+        if mask is None:
+            return torch.mean(outputs, dim=1)
+        weights = mask.to(outputs.dtype).view(mask.shape + (1, 1, 1))
+        return torch.sum(outputs * weights, dim=1) / torch.sum(weights, dim=1)
+    # attention outputs are zero at padded timesteps
+    return torch.sum(attention(outputs, mask), dim=1)
+
+def select_last(outputs, lengths=None):
+    """ Returns the [batch x ...] outputs of the last non-padded timestep of each sequence.
+
+    Args:
+      outputs - (tensor) [batch x time x ...], padded at the end
+      lengths - (tensor) [batch] non-padded timesteps of each sequence, all timesteps if None
+    """
+    if lengths is None:
+        return outputs[:, -1]
+    last = (torch.as_tensor(lengths, dtype=torch.long) - 1).to(outputs.device)
+    return outputs[torch.arange(outputs.shape[0], dtype=torch.long, device=outputs.device), last]
+
+def mask_scores(scores, mask):
+    """ Sets the attention scores of padded timesteps to -inf, so they get no weight in a softmax over time.
+
+    Args:
+      scores - (tensor) [batch x time x ...]
+      mask - (tensor) [batch x time], 0 for padded timesteps, None if nothing is padded
+    """
+    if mask is None:
+        return scores
+    return scores.masked_fill(mask.view(mask.shape + (1,) * (scores.dim() - 2)) == 0, float('-inf'))
 
 class VectorAtt(nn.Module):
 
@@ -37,13 +72,9 @@ class VectorAtt(nn.Module):
         nn.init.constant_(self.linear.weight, 1)
         self.softmax = nn.Softmax(dim=1)
 
-    def forward(self, hidden_states, lengths=None):
+    def forward(self, hidden_states, mask=None):
         hidden_states = hidden_states.permute(0, 1, 3, 4, 2).contiguous() # puts channels last
-        weights = self.softmax(self.linear(hidden_states))
-        b, t, c, h, w = weights.shape
-        if lengths is not None: #TODO: gives backprop bug
-            for i, length in enumerate(lengths):
-                weights[i, t:] *= 0
+        weights = self.softmax(mask_scores(self.linear(hidden_states), mask))
         reweighted = weights * hidden_states
         return reweighted.permute(0, 1, 4, 2, 3).contiguous()
 
@@ -65,44 +96,62 @@ class TemporalAtt(nn.Module):
         self.tanh = nn.Tanh()
         self.softmax = nn.Softmax(dim=1)
 
-    def forward(self, hidden_states):
+    def forward(self, hidden_states, mask=None):
         hidden_states = hidden_states.permute(0, 1, 3, 4, 2).contiguous()
         z1 = self.tanh(self.w_s1(hidden_states))
-        attn_weights = self.softmax(self.w_s2(z1))
+        attn_weights = self.softmax(mask_scores(self.w_s2(z1), mask))
         reweighted = attn_weights * hidden_states
         reweighted = reweighted.permute(0, 1, 4, 2, 3).contiguous()
         return reweighted
 
 class SelfAtt(nn.Module):
-    def __init__(self, hidden_dim_size, dk, dv):
+    def __init__(self, hidden_dim_size, dk, dv, chunk=4096):
         """
-            Self attention.
+            Self attention over time, separately for every pixel.
             Assumes input will be in the form (batch, time_steps, hidden_dim_size, height, width) 
 
+            Pixels are attended in chunks of chunk pixels, so at most chunk x time_steps x time_steps
+            scores are held at once.
+
             Implementation based on self attention in the following paper: 
             https://papers.nips.cc/paper/7181-attention-is-all-you-need.pdf
         """
         super(SelfAtt, self).__init__()
         self.dk = dk
         self.dv = dv
+        self.chunk = chunk
 
         self.w_q = nn.Linear(in_features=hidden_dim_size, out_features=dk, bias=False)
         self.w_k = nn.Linear(in_features=hidden_dim_size, out_features=dk, bias=False)
         self.w_v = nn.Linear(in_features=hidden_dim_size, out_features=dv, bias=False)
-        self.softmax = nn.Softmax(dim=1)
-
-    def forward(self, hidden_states):
-        hidden_states = hidden_states.permute(0, 1, 3, 4, 2).contiguous()
-        nb, nt, nr, nc, nh = hidden_states.shape
-
-        hidden_states = hidden_states.view(-1, hidden_states.shape[-1])
-        queries = self.w_q(hidden_states)
-        keys = self.w_k(hidden_states)
-        values = self.w_v(hidden_states)
-        
-        attn = torch.mm(self.softmax(torch.mm(queries, torch.transpose(keys, 0, 1)) / torch.sqrt(torch.tensor(self.dk, dtype=torch.float).cuda())), values)      
-        attn = attn.view(nb, nt, nr, nc, -1)
-        attn = attn.permute(0, 1, 4, 2, 3).contiguous() 
+        self.softmax = nn.Softmax(dim=-1)
+
+    def forward(self, hidden_states, mask=None):
+        nb, nt, nh, nr, nc = hidden_states.shape
+        # one time series per pixel, [pixels x time x channels]
+        pixels = hidden_states.permute(0, 3, 4, 1, 2).contiguous().view(-1, nt, nh)
+        if mask is not None:
+            mask = mask.view(nb, 1, 1, nt).expand(nb, nr, nc, nt).contiguous().view(-1, nt)
+
+        attn = []
+        for start in range(0, pixels.shape[0], self.chunk):
+            chunk = pixels[start:start+self.chunk]
+            queries = self.w_q(chunk)
+            keys = self.w_k(chunk)
+            values = self.w_v(chunk)
+
+            scores = torch.bmm(queries, keys.transpose(1, 2)) / (self.dk ** 0.5)
+            if mask is not None:
+                # no attention to the keys of padded timesteps
+                scores = scores.masked_fill(mask[start:start+self.chunk].unsqueeze(1) == 0, float('-inf'))
+            chunk_attn = torch.bmm(self.softmax(scores), values)
+            if mask is not None:
+                # and no output at padded timesteps, so padding adds nothing when summed over time
+                chunk_attn = chunk_attn * mask[start:start+self.chunk].unsqueeze(-1).to(chunk_attn.dtype)
+            attn.append(chunk_attn)
+
+        attn = torch.cat(attn, dim=0).view(nb, nr, nc, nt, -1)
+        attn = attn.permute(0, 3, 4, 1, 2).contiguous() 
         return attn
 
 class ApplyAtt(nn.Module):
@@ -113,13 +162,13 @@ class ApplyAtt(nn.Module):
         elif attn_type == 'temporal':
             self.attention = TemporalAtt(hidden_dim_size, attn_dims['d'], attn_dims['r'])
         elif attn_type == 'self':
-            self.attention = SelfAtt(hidden_dim_size, attn_dims['dk'], attn_dims['dv'])
+            self.attention = SelfAtt(hidden_dim_size, attn_dims['dk'], attn_dims['dv'], attn_dims.get('chunk') or 4096)
         elif attn_type == 'None':
             self.attention = None
         else:
             raise ValueError('Specified attention type is not compatible')
 
-    def forward(self, hidden_states):
-        attn_weighted = self.attention(hidden_states) if self.attention is not None else None
+    def forward(self, hidden_states, mask=None):
+        attn_weighted = self.attention(hidden_states, mask) if self.attention is not None else None
         return attn_weighted
 
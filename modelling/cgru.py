@@ -1,19 +1,21 @@
+import functools
 import torch
 import torch.nn as nn
 
 from modelling.recurrent_norm import RecurrentNorm2d
 from modelling.cgru_cell import ConvGRUCell
-from modelling.util import initialize_weights
+from modelling.util import initialize_weights, get_time_segments, checkpoint_module
 
 class CGRU(nn.Module):
 
-    def __init__(self, input_size, hidden_dims, kernel_sizes, gru_num_layers, batch_first=True, bias=True, return_all_layers=False):
+    def __init__(self, input_size, hidden_dims, kernel_sizes, gru_num_layers, batch_first=True, bias=True, return_all_layers=False, crnn_opts=None):
         """
            Args:
                 input_size - (tuple) should be (time_steps, channels, height, width)
                 hidden_dims - (list of ints) number of filters to use per layer
                 kernel_sizes - lstm kernel sizes
                 gru_num_layers - (int) number of stacks of ConvLSTM units per step
+                crnn_opts - (dict) options of the recurrence, see modelling.util.get_crnn_opts
         """
 
         super(CGRU, self).__init__()
@@ -21,6 +23,10 @@ class CGRU(nn.Module):
 
         self.gru_num_layers = gru_num_layers
         self.bias = bias
+        crnn_opts = crnn_opts if crnn_opts is not None else {}
+        self.precompute_inputs = crnn_opts.get('precompute_inputs', True)
+        self.checkpoint_segment = crnn_opts.get('checkpoint_segment', 0)
+        self.tbptt_steps = crnn_opts.get('tbptt_steps', 0)
         
         if isinstance(kernel_sizes, list):
             if len(kernel_sizes) != gru_num_layers and len(kernel_sizes) == 1:
@@ -49,7 +55,9 @@ class CGRU(nn.Module):
                                          hidden_dim = self.hidden_dims[i],
                                          num_timesteps = self.num_timesteps,
                                          kernel_size = self.kernel_sizes[i],
-                                         bias=self.bias))
+                                         bias=self.bias,
+                                         norm_type=crnn_opts.get('norm_type', 'batch'),
+                                         norm_groups=crnn_opts.get('norm_groups', 1)))
 
         self.cell_list = nn.ModuleList(cell_list)
         initialize_weights(self)
@@ -65,16 +73,29 @@ class CGRU(nn.Module):
         for layer_idx in range(self.gru_num_layers):
             # double check that this is right? i.e not resetting every time to 0?
             h = self.init_hidden_state[layer_idx]
-            h = h.expand(input_tensor.size(0), h.shape[1], h.shape[2], h.shape[3]).cuda()
+            h = h.expand(input_tensor.size(0), h.shape[1], h.shape[2], h.shape[3])
             output_inner_layers = []
+            cell = self.cell_list[layer_idx]
+            # the input convs of all timesteps in one call, only the state convs stay in the loop
+            input_convs = cell.input_convs(cur_layer_input) if self.precompute_inputs else None
+            checkpointed = self.checkpoint_segment > 0 and self.training and torch.is_grad_enabled()
             
-            for t in range(seq_len):
-                h = self.cell_list[layer_idx](input_tensor=cur_layer_input[:, t, :, :, :],
-                                                 cur_state=h, timestep=t)
+            for start, end, truncate in get_time_segments(seq_len, self.checkpoint_segment, self.tbptt_steps):
+                if truncate:
+                    # checkpointed segments only backprop into the weights if an input requires grad
+                    h = h.detach().requires_grad_(checkpointed)
+                segment_inputs = [cur_layer_input[:, start:end], h]
+                if input_convs is not None:
+                    segment_inputs.append(input_convs[:, start:end])
+                run_segment = functools.partial(self._run_segment, layer_idx, start)
+                if checkpointed:
+                    segment_output, h = checkpoint_module(run_segment, cell, *segment_inputs)
+                else:
+                    segment_output, h = run_segment(*segment_inputs)
 
-                output_inner_layers.append(h)
+                output_inner_layers.append(segment_output)
 
-            layer_output = torch.stack(output_inner_layers, dim=1)
+            layer_output = torch.cat(output_inner_layers, dim=1)
             cur_layer_input = layer_output
             
             layer_output_list.append(layer_output)
@@ -87,6 +108,18 @@ class CGRU(nn.Module):
 
         return layer_output_list, last_state_list
 
+    def _run_segment(self, layer_idx, start, layer_input, h, input_convs=None):
+        """ Runs the cell of a layer over the timesteps of layer_input, the first one being timestep start.
+        """
+        cell = self.cell_list[layer_idx]
+        outputs = []
+        for t in range(layer_input.size(1)):
+            h = cell(input_tensor=layer_input[:, t, :, :, :],
+                     cur_state=h, timestep=start + t,
+                     input_conv=input_convs[:, t] if input_convs is not None else None)
+            outputs.append(h)
+        return torch.stack(outputs, dim=1), h
+
     def _init_hidden(self):
         init_states = []
         for i in range(self.gru_num_layers):
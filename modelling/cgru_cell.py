@@ -13,7 +13,7 @@ class ConvGRUCell(nn.Module):
     """
         
     """
-    def __init__(self, input_size, input_dim, hidden_dim, num_timesteps, kernel_size, bias):
+    def __init__(self, input_size, input_dim, hidden_dim, num_timesteps, kernel_size, bias, norm_type='batch', norm_groups=1):
         """
         Initialize ConvGRU cell.
         
@@ -29,6 +29,10 @@ class ConvGRUCell(nn.Module):
             Size of the convolutional kernel.
         bias: bool
             Whether or not to add the bias.
+        norm_type: str
+            Normalization of the RecurrentNorm2d layers, 'batch', 'layer' or 'group'.
+        norm_groups: int
+            Number of groups used by group norm.
         """
 
         super(ConvGRUCell, self).__init__()
@@ -65,22 +69,45 @@ class ConvGRUCell(nn.Module):
                              padding=self.padding,
                              bias=self.bias)
         
-        self.h_norm = RecurrentNorm2d(2 * self.hidden_dim, self.num_timesteps)
-        self.input_norm = RecurrentNorm2d(2 * self.hidden_dim, self.num_timesteps)
+        self.h_norm = RecurrentNorm2d(2 * self.hidden_dim, self.num_timesteps, norm_type=norm_type, num_groups=norm_groups)
+        self.input_norm = RecurrentNorm2d(2 * self.hidden_dim, self.num_timesteps, norm_type=norm_type, num_groups=norm_groups)
         
         initialize_weights(self)
 
-    def forward(self, input_tensor, cur_state, timestep):
-        # TODO: should not have to call cuda here, figure out where this belongs
-        input_tensor.cuda()
+    def input_convs(self, inputs):
+        """ Runs input_conv and U_h over every timestep at once, as a single conv
+            with their stacked weights since neither depends on the state.
+
+        Args:
+          inputs - (tensor) [batch x timesteps x input_dim x rows x cols]
+        Returns:
+          (tensor) [batch x timesteps x 3*hidden_dim x rows x cols] normalized input_conv outputs
+                   followed by the U_h outputs
+        """
+        batch, timesteps = inputs.shape[:2]
+        weight = torch.cat([self.input_conv.weight, self.U_h.weight], dim=0)
+        bias = torch.cat([self.input_conv.bias, self.U_h.bias], dim=0) if self.bias else None
+        convs = F.conv2d(inputs.contiguous().view(batch * timesteps, *inputs.shape[2:]), weight, bias, padding=self.padding)
+        gates_conv, u_h = torch.split(convs.view(batch, timesteps, *convs.shape[1:]), [2 * self.hidden_dim, self.hidden_dim], dim=2)
+        return torch.cat([self.input_norm.forward_all(gates_conv), u_h], dim=2)
+
+    def forward(self, input_tensor, cur_state, timestep, input_conv=None):
+        """
+        Args:
+          input_conv - (tensor) this timestep of input_convs, computed from input_tensor if None
+        """
+        if input_conv is None:
+            gates_conv, u_h = self.input_norm(self.input_conv(input_tensor), timestep), self.U_h(input_tensor)
+        else:
+            gates_conv, u_h = torch.split(input_conv, [2 * self.hidden_dim, self.hidden_dim], dim=1)
         # BN over the outputs of these convs
         
-        combined_conv = self.h_norm(self.h_conv(cur_state), timestep) + self.input_norm(self.input_conv(input_tensor), timestep)
+        combined_conv = self.h_norm(self.h_conv(cur_state), timestep) + gates_conv
         
         u_t, r_t = torch.split(combined_conv, self.hidden_dim, dim=1) 
         u_t = torch.sigmoid(u_t)
         r_t = torch.sigmoid(r_t)
-        h_tilde = torch.tanh(self.W_h(r_t * cur_state) + self.U_h(input_tensor))
+        h_tilde = torch.tanh(self.W_h(r_t * cur_state) + u_h)
         h_next = (1 - u_t) * h_tilde + u_t * h_tilde
         
         return h_next
@@ -1,9 +1,11 @@
+import functools
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from modelling.recurrent_norm import RecurrentNorm2d
 from modelling.clstm_cell import ConvLSTMCell
-from modelling.util import initialize_weights
+from modelling.util import initialize_weights, get_time_segments, checkpoint_module, sort_by_length
 
 class CLSTM(nn.Module):
 
@@ -15,13 +17,15 @@ class CLSTM(nn.Module):
                  batch_first=True, 
                  bias=True, 
                  return_all_layers=False,
-                 var_length=False):
+                 var_length=False,
+                 crnn_opts=None):
         """
            Args:
                 input_size - (tuple) should be (time_steps, channels, height, width)
                 hidden_dims - (list of ints) number of filters to use per layer
                 kernel_sizes - lstm kernel sizes
                 lstm_num_layers - (int) number of stacks of ConvLSTM units per step
+                crnn_opts - (dict) options of the recurrence, see modelling.util.get_crnn_opts
         """
 
         super(CLSTM, self).__init__()
@@ -29,6 +33,10 @@ class CLSTM(nn.Module):
         self.lstm_num_layers = lstm_num_layers
         self.bias = bias
         self.var_length = var_length
+        crnn_opts = crnn_opts if crnn_opts is not None else {}
+        self.precompute_inputs = crnn_opts.get('precompute_inputs', True)
+        self.checkpoint_segment = crnn_opts.get('checkpoint_segment', 0)
+        self.tbptt_steps = crnn_opts.get('tbptt_steps', 0)
         
         if isinstance(kernel_sizes, list):
             if len(kernel_sizes) != lstm_num_layers and len(kernel_sizes) == 1:
@@ -56,33 +64,57 @@ class CLSTM(nn.Module):
                                           hidden_dim = self.hidden_dims[i],
                                           num_timesteps = self.num_timesteps,
                                           kernel_size = self.kernel_sizes[i],
-                                          bias=self.bias))
+                                          bias=self.bias,
+                                          norm_type=crnn_opts.get('norm_type', 'batch'),
+                                          norm_groups=crnn_opts.get('norm_groups', 1)))
 
         self.cell_list = nn.ModuleList(cell_list)
         initialize_weights(self)
 
-    def forward(self, input_tensor, hidden_state=None):
-
+    def forward(self, input_tensor, hidden_state=None, lengths=None):
+        """
+        Args:
+          input_tensor - (tensor) [batch x timesteps x channels x rows x cols], padded at the end
+          lengths - (tensor) [batch] non-padded timesteps of each sequence. If not None, sequences
+                    that ended keep their last state and output zeros, and are left out of the
+                    remaining steps
+        """
         layer_output_list = []
         last_state_list = []
         
         seq_len = input_tensor.size(1)
         cur_layer_input = input_tensor
+        batch_sizes = None
+        if lengths is not None:
+            order, restore, batch_sizes = sort_by_length(lengths, seq_len)
+            cur_layer_input = input_tensor.index_select(0, order.to(input_tensor.device))
         
         for layer_idx in range(self.lstm_num_layers):
             # double check that this is right? i.e not resetting every time to 0?
-            h, c = self.init_hidden_state[layer_idx], self.init_cell_state[layer_idx]
-            h = h.expand(input_tensor.size(0), h.shape[1], h.shape[2], h.shape[3]).cuda()
-            c = c.expand(input_tensor.size(0), c.shape[1], c.shape[2], c.shape[3]).cuda()
+            h, c = self.init_states(layer_idx, input_tensor.size(0))
             output_inner_layers = []
+            cell = self.cell_list[layer_idx]
+            # the input convs of all timesteps in one call, only the state convs stay in the loop
+            input_convs = cell.input_convs(cur_layer_input, batch_sizes) if self.precompute_inputs else None
+            checkpointed = self.checkpoint_segment > 0 and self.training and torch.is_grad_enabled()
             
-            for t in range(seq_len):
-                h, c = self.cell_list[layer_idx](input_tensor=cur_layer_input[:, t, :, :, :],
-                                                 cur_state=[h, c], timestep=t)
+            for start, end, truncate in get_time_segments(seq_len, self.checkpoint_segment, self.tbptt_steps):
+                if truncate:
+                    # checkpointed segments only backprop into the weights if an input requires grad
+                    h, c = h.detach().requires_grad_(checkpointed), c.detach().requires_grad_(checkpointed)
+                segment_inputs = [cur_layer_input[:, start:end], h, c]
+                if input_convs is not None:
+                    segment_inputs.append(input_convs[:, start:end])
+                run_segment = functools.partial(self._run_segment, layer_idx, start,
+                                                batch_sizes[start:end] if batch_sizes is not None else None)
+                if checkpointed:
+                    segment_output, h, c = checkpoint_module(run_segment, cell, *segment_inputs)
+                else:
+                    segment_output, h, c = run_segment(*segment_inputs)
 
-                output_inner_layers.append(h)
+                output_inner_layers.append(segment_output)
 
-            layer_output = torch.stack(output_inner_layers, dim=1)
+            layer_output = torch.cat(output_inner_layers, dim=1)
             cur_layer_input = layer_output
             
             layer_output_list.append(layer_output)
@@ -92,11 +124,108 @@ class CLSTM(nn.Module):
         # Just take last output for prediction
         layer_outputs = layer_output_list[-1]
         last_states = last_state_list[-1:]
+        if lengths is not None:
+            restore = restore.to(input_tensor.device)
+            layer_outputs = layer_outputs.index_select(0, restore)
+            last_states = [[state.index_select(0, restore) for state in states] for states in last_states]
         
         return layer_outputs, last_states
 
+    def _run_segment(self, layer_idx, start, batch_sizes, layer_input, h, c, input_convs=None):
+        """ Runs the cell of a layer over the timesteps of layer_input, the first one being timestep start.
+            With batch_sizes, only the first batch_sizes[t] samples are run at step t.
+        """
+        cell = self.cell_list[layer_idx]
+        batch = layer_input.size(0)
+        outputs = []
+        for t in range(layer_input.size(1)):
+            n = batch_sizes[t] if batch_sizes is not None else batch
+            if n == 0:
+                outputs.append(h.new_zeros(h.shape))
+                continue
+            h_run, c_run = cell(input_tensor=layer_input[:n, t, :, :, :],
+                                cur_state=[h[:n], c[:n]], timestep=start + t,
+                                input_conv=input_convs[:n, t] if input_convs is not None else None)
+            outputs.append(pad_batch(h_run, batch))
+            h, c = keep_finished(h_run, h), keep_finished(c_run, c)
+        return torch.stack(outputs, dim=1), h, c
+
+    def init_states(self, layer_idx, batch_size):
+        h, c = self.init_hidden_state[layer_idx], self.init_cell_state[layer_idx]
+        return h.expand(batch_size, *h.shape[1:]), c.expand(batch_size, *c.shape[1:])
+
     def _init_hidden(self):
         init_states = []
         for i in range(self.lstm_num_layers):
             init_states.append(nn.Parameter(torch.zeros(1, self.hidden_dims[i], self.width, self.height)))
         return nn.ParameterList(init_states)
+
+def pad_batch(running, batch):
+    """ Pads the outputs of the running prefix of a batch with zeros for the finished sequences.
+    """
+    if running.size(0) == batch:
+        return running
+    return torch.cat([running, running.new_zeros((batch - running.size(0),) + running.shape[1:])])
+
+def keep_finished(running, state):
+    """ Updates the running prefix of a batch's state, finished sequences keep their last state.
+    """
+    if running.size(0) == state.size(0):
+        return running
+    return torch.cat([running, state[running.size(0):]])
+
+def fused_bidirectional(clstm, clstm_rev, input_tensor, rev_input_tensor, lengths=None):
+    """ Runs a forward and a reverse CLSTM in one time loop.
+
+    At every step the hidden state convs of both directions run as one grouped conv,
+    so a bidirectional layer takes seq_len serial steps instead of 2 * seq_len.
+    Outputs match calling clstm and clstm_rev one after the other.
+
+    Args:
+      clstm, clstm_rev - (CLSTM) forward and reverse models, with the same hidden dims and kernel sizes
+      input_tensor - (tensor) [batch x timesteps x channels x rows x cols] forward inputs
+      rev_input_tensor - (tensor) input_tensor reversed in time, within lengths if given
+      lengths - (tensor) [batch] non-padded timesteps of each sequence, see CLSTM.forward
+    Returns:
+      layer_outputs, rev_layer_outputs - (tensors) last layer outputs of each direction
+    """
+    batch, seq_len = input_tensor.shape[:2]
+    cur_inputs = [input_tensor, rev_input_tensor]
+    batch_sizes = [batch] * seq_len
+    if lengths is not None:
+        # both directions share the lengths, so the same prefix of the batch runs in both
+        order, restore, batch_sizes = sort_by_length(lengths, seq_len)
+        cur_inputs = [cur_input.index_select(0, order.to(input_tensor.device)) for cur_input in cur_inputs]
+
+    for layer_idx in range(clstm.lstm_num_layers):
+        cells = [clstm.cell_list[layer_idx], clstm_rev.cell_list[layer_idx]]
+        states = [clstm.init_states(layer_idx, batch), clstm_rev.init_states(layer_idx, batch)]
+        input_convs = [cell.input_convs(cur_input, batch_sizes if lengths is not None else None) if model.precompute_inputs else None
+                       for cell, cur_input, model in zip(cells, cur_inputs, [clstm, clstm_rev])]
+        h_weight = torch.cat([cell.h_conv.weight for cell in cells], dim=0)
+        h_bias = torch.cat([cell.h_conv.bias for cell in cells], dim=0) if cells[0].bias else None
+
+        outputs = [[], []]
+        for t, n in enumerate(batch_sizes):
+            if n == 0:
+                for d in range(2):
+                    outputs[d].append(states[d][0].new_zeros(states[d][0].shape))
+                continue
+            h_convs = F.conv2d(torch.cat([h[:n] for h, _ in states], dim=1), h_weight, h_bias,
+                               padding=cells[0].padding, groups=2)
+            h_convs = torch.split(h_convs, 4 * cells[0].hidden_dim, dim=1)
+            for d, cell in enumerate(cells):
+                if input_convs[d] is not None:
+                    input_conv = input_convs[d][:n, t]
+                else:
+                    input_conv = cell.input_norm(cell.input_conv(cur_inputs[d][:n, t]), t)
+                h, c = states[d]
+                h_run, c_run = cell.state_update(h_convs[d], input_conv, c[:n], t)
+                states[d] = (keep_finished(h_run, h), keep_finished(c_run, c))
+                outputs[d].append(pad_batch(h_run, batch))
+
+        cur_inputs = [torch.stack(outputs[d], dim=1) for d in range(2)]
+
+    if lengths is not None:
+        cur_inputs = [cur_input.index_select(0, restore.to(input_tensor.device)) for cur_input in cur_inputs]
+    return cur_inputs[0], cur_inputs[1]
@@ -7,7 +7,7 @@ from torchvision import models
 import numpy as np
 from constants import *
 from modelling.recurrent_norm import RecurrentNorm2d
-from modelling.util import initialize_weights
+from modelling.util import initialize_weights, apply_running
 
 class ConvLSTMCell(nn.Module):
     """
@@ -16,7 +16,7 @@ class ConvLSTMCell(nn.Module):
 
         Implementation based on stefanopini's at https://github.com/ndrplz/ConvLSTM_pytorch/blob/master/convlstm.py
     """
-    def __init__(self, input_dim, hidden_dim, num_timesteps, kernel_size, bias):
+    def __init__(self, input_dim, hidden_dim, num_timesteps, kernel_size, bias, norm_type='batch', norm_groups=1):
         """
         Initialize ConvLSTM cell.
         
@@ -30,6 +30,10 @@ class ConvLSTMCell(nn.Module):
             Size of the convolutional kernel.
         bias: bool
             Whether or not to add the bias.
+        norm_type: str
+            Normalization of the RecurrentNorm2d layers, 'batch', 'layer' or 'group'.
+        norm_groups: int
+            Number of groups used by group norm.
         """
 
         super(ConvLSTMCell, self).__init__()
@@ -55,17 +59,43 @@ class ConvLSTMCell(nn.Module):
                               bias=self.bias)
         
 
-        self.h_norm = RecurrentNorm2d(4 * self.hidden_dim, self.num_timesteps)
-        self.input_norm = RecurrentNorm2d(4 * self.hidden_dim, self.num_timesteps)
-        self.cell_norm = RecurrentNorm2d(self.hidden_dim, self.num_timesteps)
+        self.h_norm = RecurrentNorm2d(4 * self.hidden_dim, self.num_timesteps, norm_type=norm_type, num_groups=norm_groups)
+        self.input_norm = RecurrentNorm2d(4 * self.hidden_dim, self.num_timesteps, norm_type=norm_type, num_groups=norm_groups)
+        self.cell_norm = RecurrentNorm2d(self.hidden_dim, self.num_timesteps, norm_type=norm_type, num_groups=norm_groups)
         
         initialize_weights(self)
 
-    def forward(self, input_tensor, cur_state, timestep):
-        
+    def input_convs(self, inputs, batch_sizes=None):
+        """ Runs and normalizes input_conv over every timestep at once, it does not depend on the state.
+
+        Args:
+          inputs - (tensor) [batch x timesteps x input_dim x rows x cols]
+          batch_sizes - (list of ints) if not None, only the first batch_sizes[t] samples of timestep t
+                        are computed and the rest is zero, see modelling.util.sort_by_length
+        Returns:
+          (tensor) [batch x timesteps x 4*hidden_dim x rows x cols] normalized input_conv outputs
+        """
+        batch, timesteps = inputs.shape[:2]
+        if batch_sizes is not None:
+            return self.input_norm.forward_all(apply_running(self.input_conv, inputs, batch_sizes), batch_sizes)
+        convs = self.input_conv(inputs.contiguous().view(batch * timesteps, *inputs.shape[2:]))
+        return self.input_norm.forward_all(convs.view(batch, timesteps, *convs.shape[1:]))
+
+    def forward(self, input_tensor, cur_state, timestep, input_conv=None):
+        """
+        Args:
+          input_conv - (tensor) this timestep of input_convs, computed from input_tensor if None
+        """
         h_cur, c_cur = cur_state
+        if input_conv is None:
+            input_conv = self.input_norm(self.input_conv(input_tensor), timestep)
+        return self.state_update(self.h_conv(h_cur), input_conv, c_cur, timestep)
+
+    def state_update(self, h_conv, input_conv, c_cur, timestep):
+        """ Gates of one step, from the unnormalized h_conv output and the normalized input_conv output.
+        """
         # BN over the outputs of these convs
-        combined_conv = self.h_norm(self.h_conv(h_cur), timestep) + self.input_norm(self.input_conv(input_tensor.cuda()), timestep)
+        combined_conv = self.h_norm(h_conv, timestep) + input_conv
  
         cc_i, cc_f, cc_o, cc_g = torch.split(combined_conv, self.hidden_dim, dim=1) 
         i = torch.sigmoid(cc_i)
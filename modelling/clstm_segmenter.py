@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
-from modelling.util import initialize_weights
-from modelling.clstm import CLSTM
+from modelling.util import initialize_weights, reverse_padded
+from modelling.clstm import CLSTM, fused_bidirectional
 from modelling.attention import ApplyAtt, attn_or_avg
 
 class CLSTMSegmenter(nn.Module):
@@ -10,7 +10,7 @@ class CLSTMSegmenter(nn.Module):
 
     def __init__(self, input_size, hidden_dims, lstm_kernel_sizes, conv_kernel_size, 
                  lstm_num_layers, num_outputs, bidirectional, with_pred=False, 
-                 avg_hidden_states=None, attn_type=None, d=None, r=None, dk=None, dv=None): 
+                 avg_hidden_states=None, attn_type=None, attn_dims=None, crnn_opts=None): 
 
         super(CLSTMSegmenter, self).__init__()
         self.input_size = input_size
@@ -19,7 +19,7 @@ class CLSTMSegmenter(nn.Module):
 
         if self.with_pred:
             self.avg_hidden_states = avg_hidden_states
-            self.attention = ApplyAtt(attn_type, hidden_dims, d=d, r=r, dk=dk, dv=dv) 
+            self.attention = ApplyAtt(attn_type, hidden_dims, attn_dims) 
             self.final_conv = nn.Conv2d(in_channels=hidden_dims, 
                                         out_channels=num_outputs, 
                                         kernel_size=conv_kernel_size, 
@@ -29,27 +29,43 @@ class CLSTMSegmenter(nn.Module):
         if not isinstance(hidden_dims, list):
             hidden_dims = [hidden_dims]        
 
-        self.clstm = CLSTM(input_size, hidden_dims, lstm_kernel_sizes, lstm_num_layers)
+        self.clstm = CLSTM(input_size, hidden_dims, lstm_kernel_sizes, lstm_num_layers, crnn_opts=crnn_opts)
         
         self.bidirectional = bidirectional
         if self.bidirectional:
-            self.clstm_rev = CLSTM(input_size, hidden_dims, lstm_kernel_sizes, lstm_num_layers, bidirectional)
+            self.clstm_rev = CLSTM(input_size, hidden_dims, lstm_kernel_sizes, lstm_num_layers, crnn_opts=crnn_opts)
+        crnn_opts = crnn_opts if crnn_opts is not None else {}
+        # the fused loop does not split time into checkpointed or truncated segments
+        self.fused_bidirectional = (crnn_opts.get('fused_bidirectional', True) and
+                                    not crnn_opts.get('checkpoint_segment') and not crnn_opts.get('tbptt_steps'))
         
         in_channels = hidden_dims[-1] if not self.bidirectional else hidden_dims[-1] * 2
         initialize_weights(self)
        
-    def forward(self, inputs):
-
-        layer_outputs, last_states = self.clstm(inputs)
-    
+    def forward(self, inputs, lengths=None):
+        """
+        Args:
+          inputs - (tensor) [batch x timesteps x channels x rows x cols], padded at the end
+          lengths - (tensor) [batch] non-padded timesteps of each sequence, only the
+                    non-padded timesteps are run, and reversed for the reverse direction
+        Returns:
+          layer_outputs, rev_layer_outputs - the reverse outputs are in reversed time,
+                                             with the padding at the end like layer_outputs
+        """
         rev_layer_outputs = None
         if self.bidirectional:
-            rev_inputs = torch.flip(inputs, dims=[1])
-            rev_layer_outputs, rev_last_states = self.clstm_rev(rev_inputs)
+            rev_inputs = reverse_padded(inputs, lengths)
+            if self.fused_bidirectional:
+                layer_outputs, rev_layer_outputs = fused_bidirectional(self.clstm, self.clstm_rev, inputs, rev_inputs, lengths)
+            else:
+                layer_outputs, last_states = self.clstm(inputs, lengths=lengths)
+                rev_layer_outputs, rev_last_states = self.clstm_rev(rev_inputs, lengths=lengths)
+        else:
+            layer_outputs, last_states = self.clstm(inputs, lengths=lengths)
 
         if self.with_pred:
             # Apply attention
-            reweighted = attn_or_avg(self.attention, self.avg_hidden_states, layer_outputs, rev_layer_ouputs, self.bidirectional)
+            reweighted = attn_or_avg(self.attention, self.avg_hidden_states, layer_outputs, rev_layer_outputs, self.bidirectional, lengths)
 
             # Apply final conv
             scores = self.final_conv(reweighted)
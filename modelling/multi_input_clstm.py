@@ -1,11 +1,14 @@
 import torch
 import torch.nn as nn
-from modelling.util import initialize_weights
+from modelling.util import initialize_weights, run_in_chunks
+from functools import partial
 from modelling.clstm import CLSTM
 from modelling.clstm_segmenter import CLSTMSegmenter
 from modelling.unet import UNet, UNet_Encode, UNet_Decode
 from modelling.attention import ApplyAtt, attn_or_avg
+from constants import CACHED_FEATS
 from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
 
 import time
 
@@ -29,9 +32,20 @@ class MI_CLSTM(nn.Module):
                  resize_planet,
                  grid_size,
                  main_attn_type,
-                 attn_dims):
+                 attn_dims,
+                 crnn_opts=None,
+                 cached_feats=False,
+                 encoder_opts=None,
+                 parallel_branches=False,
+                 time_branches=False):
         """
             input_size - (tuple) should be (time_steps, channels, height, width)
+            crnn_opts - (dict) options of the recurrence, see modelling.util.get_crnn_opts
+            cached_feats - (bool) inputs hold the encoder features written by cache_features.py
+                            instead of the grids, so the encoders are skipped
+            encoder_opts - (dict) chunking of the frames, see modelling.util.get_encoder_opts
+            parallel_branches - (bool) run the branches of the sensors at the same time, see forward_parallel
+            time_branches - (bool) record the seconds each branch takes in branch_times
         """
         super(MI_CLSTM, self).__init__()
 
@@ -45,6 +59,15 @@ class MI_CLSTM(nn.Module):
         self.num_bands = num_bands
         self.num_bands_empty = { 's1': 0, 's2': 0, 'planet': 0, 'all': 0 }
         self.resize_planet = resize_planet
+        self.cached_feats = cached_feats
+        if cached_feats and not early_feats:
+            raise ValueError('Only the encoder features of --early_feats can be cached')
+        self.encoder_opts = encoder_opts if encoder_opts is not None else {}
+        self.parallel_branches = parallel_branches
+        self.time_branches = time_branches
+        self.branch_times = { sat: [] for sat in satellites if satellites[sat] }
+        self.branch_pool = None
+        self.branch_streams = {}
         
         if early_feats:
             self.encs = {}
@@ -74,9 +97,10 @@ class MI_CLSTM(nn.Module):
                                                       conv_kernel_size=conv_kernel_size, 
                                                       lstm_num_layers=lstm_num_layers, 
                                                       num_outputs=num_classes, 
-                                                      bidirectional=bidirectional) 
+                                                      bidirectional=bidirectional,
+                                                      crnn_opts=crnn_opts) 
 
-                    self.attention[sat] = ApplyAtt(main_attn_type, hidden_dims, attn_dims)
+                    self.attention[sat] = ApplyAtt(main_attn_type, hidden_dims[-1], attn_dims)
 
                     self.finalconv[sat] = nn.Conv2d(in_channels=hidden_dims[-1], 
                                                      out_channels=num_classes, 
@@ -96,9 +120,10 @@ class MI_CLSTM(nn.Module):
                                                       conv_kernel_size=conv_kernel_size, 
                                                       lstm_num_layers=lstm_num_layers, 
                                                       num_outputs=crnn_input_size[1], 
-                                                      bidirectional=bidirectional)
+                                                      bidirectional=bidirectional,
+                                                      crnn_opts=crnn_opts)
 
-                    self.attention[sat] = ApplyAtt(main_attn_type, hidden_dims, attn_dims)
+                    self.attention[sat] = ApplyAtt(main_attn_type, hidden_dims[-1], attn_dims)
                     
                     self.finalconv[sat] = nn.Conv2d(in_channels=hidden_dims[-1], 
                                                     out_channels=crnn_input_size[1], 
@@ -123,59 +148,175 @@ class MI_CLSTM(nn.Module):
         self.softmax = nn.Softmax2d()
         self.logsoftmax = nn.LogSoftmax(dim=1)
                 
-    def forward(self, inputs):
-        preds = []
-        for sat in self.satellites:
-            if self.satellites[sat]:
-                sat_data = inputs[sat]
-                lengths = inputs[sat + "_lengths"]
-                batch, timestamps, bands, rows, cols = sat_data.size()
-                fcn_input = sat_data.view(batch * timestamps, bands, rows, cols)
-                
-                if self.early_feats:
-                    # Encode features
-                    center1_feats, enc4_feats, enc3_feats, _, _ = self.encs[sat](fcn_input, hres=None)
-                    # Reshape tensors to separate batch and timestamps
-                    crnn_input = center1_feats.view(batch, timestamps, -1, center1_feats.shape[-2], center1_feats.shape[-1])
-                    enc4_feats = enc4_feats.view(batch, timestamps, -1, enc4_feats.shape[-2], enc4_feats.shape[-1])
-                    enc3_feats = enc3_feats.view(batch, timestamps, -1, enc3_feats.shape[-2], enc3_feats.shape[-1])
-
-                    enc3_feats = torch.mean(enc3_feats, dim=1, keepdim=False)
-                    enc4_feats = torch.mean(enc4_feats, dim=1, keepdim=False)
-                    
-                    # Apply CRNN
-                    if self.clstms[sat] is not None:
-                        crnn_output_fwd, crnn_output_rev = self.clstms[sat](crnn_input) 
-                    else:
-                        crnn_output_fwd = crnn_input 
-                        crnn_output_rev = None
- 
-                    # Apply attention
-                    reweighted = attn_or_avg(self.attention[sat], self.avg_hidden_states, crnn_output_fwd, crnn_output_rev, self.bidirectional, lengths)
-                 
-                    # Apply final conv
-                    reweighted = reweighted.cuda()
-                    pred_enc = self.finalconv[sat](reweighted) if self.finalconv[sat] is not None else reweighted
-                    preds.append(self.decs[sat](pred_enc, enc4_feats, enc3_feats))
+    def encode(self, sat, frames):
+        """ Runs the encoder of a sensor on single timestep frames.
 
-                else:
-                    fcn_output = self.unets[sat](fcn_input, hres=None)
-                    # Apply CRNN
-                    crnn_input = fcn_output.view(batch, timestamps, -1, fcn_output.shape[-2], fcn_output.shape[-1])
-                    if self.clstms[sat] is not None:
-                        crnn_output_fwd, crnn_output_rev = self.clstms[sat](crnn_input) #, lengths)
-                    else:
-                        crnn_output_fwd = crnn_input
-                        crnn_output_rev = None
-
-                    # Apply attention
-                    reweighted = attn_or_avg(self.attention[sat], self.avg_hidden_states, crnn_output_fwd, crnn_output_rev, self.bidirectional, lengths)
-
-                    # Apply final conv
-                    scores = self.finalconv[sat](reweighted)
-                    sat_preds = self.logsoftmax(scores)
-                    preds.append(sat_preds)
+        Args:
+          sat - (str) sensor of the frames
+          frames - (tensor) [frames x bands x rows x cols]
+        Returns:
+          (list of tensors) [frames x ...] features, in the order of CACHED_FEATS with early_feats,
+                            else the UNet output
+        """
+        chunk_frames = self.encoder_opts.get('chunk_frames', 0)
+        checkpointed = self.encoder_opts.get('checkpoint', False) and self.training and torch.is_grad_enabled()
+        if self.early_feats:
+            return run_in_chunks(partial(self.encs[sat], hres=None), [frames], chunk_frames, checkpointed)[:len(CACHED_FEATS)]
+
+        enc_feats = run_in_chunks(partial(self.unets[sat].unet_encode, hres=None), [frames], chunk_frames, checkpointed)
+        # the batch norms of the decoder use the statistics of all frames while training
+        return run_in_chunks(lambda *feats: [self.unets[sat].unet_decode(*feats)], enc_feats, 
+                             0 if self.training else chunk_frames)
+
+    def forward_branch(self, sat, inputs):
+        """ Runs the branch of one sensor, from its inputs to its class scores before fusion.
+
+        Args:
+          sat - (str) sensor of the branch
+          inputs - (dict) batch as from collate_var_length
+        Returns:
+          (tensor) [batch x classes x rows x cols] log probabilities of the sensor
+        """
+        sat_data = inputs[sat]
+        lengths = inputs[sat + "_lengths"]
+        if self.cached_feats:
+            # [batch x timestamps x ...] features, the first one in place of the grids
+            feats = [sat_data.float()] + [inputs[sat + '_' + name].float() for name in CACHED_FEATS[1:]]
+        else:
+            batch, timestamps, bands, rows, cols = sat_data.size()
+            fcn_input = sat_data.view(batch * timestamps, bands, rows, cols)
+            # Encode features and separate batch and timestamps
+            feats = [cur_feats.view(batch, timestamps, *cur_feats.shape[1:]) for cur_feats in self.encode(sat, fcn_input)]
         
+        if self.early_feats:
+            crnn_input, enc4_feats, enc3_feats = feats
+
+            enc3_feats = torch.mean(enc3_feats, dim=1, keepdim=False)
+            enc4_feats = torch.mean(enc4_feats, dim=1, keepdim=False)
+            
+            # Apply CRNN
+            if self.clstms[sat] is not None:
+                crnn_output_fwd, crnn_output_rev = self.clstms[sat](crnn_input, lengths)
+            else:
+                crnn_output_fwd = crnn_input 
+                crnn_output_rev = None
+
+            # Apply attention
+            reweighted = attn_or_avg(self.attention[sat], self.avg_hidden_states, crnn_output_fwd, crnn_output_rev, self.bidirectional, lengths)
+         
+            # Apply final conv
+            pred_enc = self.finalconv[sat](reweighted) if self.finalconv[sat] is not None else reweighted
+            return self.decs[sat](pred_enc, enc4_feats, enc3_feats)
+
+        else:
+            # Apply CRNN
+            crnn_input = feats[0]
+            if self.clstms[sat] is not None:
+                crnn_output_fwd, crnn_output_rev = self.clstms[sat](crnn_input, lengths)
+            else:
+                crnn_output_fwd = crnn_input
+                crnn_output_rev = None
+
+            # Apply attention
+            reweighted = attn_or_avg(self.attention[sat], self.avg_hidden_states, crnn_output_fwd, crnn_output_rev, self.bidirectional, lengths)
+
+            # Apply final conv
+            scores = self.finalconv[sat](reweighted)
+            return self.logsoftmax(scores)
+
+    def timed_branch(self, sat, inputs, stream=None):
+        """ Runs forward_branch and, with time_branches, records its duration in branch_times.
+
+        On the gpu the branch is timed by a pair of cuda events around it on stream, the
+        current stream if None, so nothing is synchronized and the time a stream spends
+        waiting on other streams before the branch starts is not counted.
+        """
+        if not self.time_branches:
+            return self.forward_branch(sat, inputs)
+        if not inputs[sat].is_cuda:
+            start = time.time()
+            sat_preds = self.forward_branch(sat, inputs)
+            self.branch_times[sat].append(time.time() - start)
+            return sat_preds
+
+        stream = stream if stream is not None else torch.cuda.current_stream()
+        start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+        start.record(stream)
+        sat_preds = self.forward_branch(sat, inputs)
+        end.record(stream)
+        self.branch_times[sat].append((start, end))
+        return sat_preds
+
+    def pop_branch_times(self):
+        """ Returns the mean seconds per batch of each sensor branch since the last call and clears them.
+        """
+        mean_times = {}
+        for sat, times in self.branch_times.items():
+            if not times:
+                continue
+            seconds = []
+            for branch_time in times:
+                if isinstance(branch_time, tuple):
+                    start, end = branch_time
+                    end.synchronize()
+                    branch_time = start.elapsed_time(end) / 1000
+                seconds.append(branch_time)
+            mean_times[sat] = sum(seconds) / len(seconds)
+        self.branch_times = { sat: [] for sat in self.branch_times }
+        return mean_times
+
+    def get_branch_stream(self, sat, device):
+        """ Returns the cuda stream the branch of sat runs on on device, created on first use.
+        """
+        if (sat, device) not in self.branch_streams:
+            with torch.cuda.device(device):
+                self.branch_streams[(sat, device)] = torch.cuda.Stream()
+        return self.branch_streams[(sat, device)]
+
+    def forward_parallel(self, sats, inputs):
+        """ Runs the sensor branches at the same time, one thread each, and on the gpu
+            each on its own cuda stream. Returns their predictions in the order of sats.
+        """
+        grad_enabled = torch.is_grad_enabled()
+        device = inputs[sats[0]].device
+        main_stream = None
+        if device.type == 'cuda':
+            with torch.cuda.device(device):
+                main_stream = torch.cuda.current_stream()
+        # threads are kept across batches, created on first use
+        if self.branch_pool is None:
+            self.branch_pool = ThreadPoolExecutor(max_workers=len(sats))
+
+        def run(sat):
+            # grad mode and the cuda device and stream are thread local
+            with torch.set_grad_enabled(grad_enabled):
+                if main_stream is None:
+                    return self.timed_branch(sat, inputs), None
+                stream = self.get_branch_stream(sat, device)
+                with torch.cuda.device(device):
+                    # inputs were written on the main stream
+                    stream.wait_stream(main_stream)
+                    with torch.cuda.stream(stream):
+                        return self.timed_branch(sat, inputs, stream), stream
+
+        results = list(self.branch_pool.map(run, sats))
+
+        preds = []
+        for sat_preds, stream in results:
+            if stream is not None:
+                main_stream.wait_stream(stream)
+                # keeps the caching allocator from reusing the memory before the main stream is done with it
+                sat_preds.record_stream(main_stream)
+            preds.append(sat_preds)
+        return preds
+
+    def forward(self, inputs):
+        sats = [sat for sat in self.satellites if self.satellites[sat]]
+        if self.parallel_branches and len(sats) > 1:
+            preds = self.forward_parallel(sats, inputs)
+        else:
+            preds = [self.timed_branch(sat, inputs) for sat in sats]
+
         all_preds = torch.cat(preds, dim=1).permute(0, 2, 3, 1).contiguous()
         preds = self.out_linear(all_preds).permute(0, 3, 1, 2).contiguous()
         preds = self.logsoftmax(preds)
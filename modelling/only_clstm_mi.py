@@ -22,9 +22,11 @@ class ONLY_CLSTM_MI(nn.Module):
                  max_timesteps,
                  satellites,
                  main_attn_type,
-                 attn_dims):
+                 attn_dims,
+                 crnn_opts=None):
         """
             input_size - (tuple) should be (time_steps, channels, height, width)
+            crnn_opts - (dict) options of the recurrence, see modelling.util.get_crnn_opts
         """
         super(ONLY_CLSTM_MI, self).__init__()
 
@@ -54,9 +56,10 @@ class ONLY_CLSTM_MI(nn.Module):
                                                   conv_kernel_size=conv_kernel_size, 
                                                   lstm_num_layers=lstm_num_layers, 
                                                   num_outputs=crnn_out_feats, 
-                                                  bidirectional=bidirectional) 
+                                                  bidirectional=bidirectional,
+                                                  crnn_opts=crnn_opts) 
 
-                self.attention[sat] = ApplyAtt(main_attn_type, hidden_dims, attn_dims)
+                self.attention[sat] = ApplyAtt(main_attn_type, hidden_dims[-1], attn_dims)
 
                 self.finalconv[sat] = nn.Conv2d(in_channels=hidden_dims[-1], 
                                                 out_channels=num_classes, 
@@ -84,7 +87,7 @@ class ONLY_CLSTM_MI(nn.Module):
                 
                 # Apply CRNN
                 if self.clstms[sat] is not None:
-                    crnn_output_fwd, crnn_output_rev = self.clstms[sat](sat_data) #, lengths)
+                    crnn_output_fwd, crnn_output_rev = self.clstms[sat](sat_data, lengths)
                 else:
                     crnn_output_fwd = crnn_input
                     crnn_output_rev = None
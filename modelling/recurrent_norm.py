@@ -2,35 +2,49 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 from torch.nn import functional, init
+from modelling.util import apply_running
+
+NORM_TYPES = ['batch', 'layer', 'group']
 
 class RecurrentNorm2d(nn.Module):
     """
     Normalization Module which keeps track of separate statistics for each timestep as described in
     https://arxiv.org/pdf/1603.09025.pdf
     
-    Currently only configured to use BN
-    
-    TODO:
-    - Add support for Layer Norm
-    - Add support for Group Norm
+    norm_type selects the normalization:
+    - 'batch': BN with a row of [max_length x num_features] running statistics per timestep
+    - 'layer': LN over the channels and pixels of each sample, no running statistics
+    - 'group': GN over num_groups groups of channels of each sample, no running statistics
+
+    Layer and group norm do not depend on the other samples of a batch, so they also
+    work for batch size 1 streaming inference.
 
     based on the work from https://github.com/jihunchoi/recurrent-batch-normalization-pytorch/blob/master/bnlstm.py
 
     """
 
     def __init__(self, num_features, max_length, eps=1e-5, momentum=0.1,
-                 affine=True):
+                 affine=True, norm_type='batch', num_groups=1):
         """
         Most parts are copied from
         torch.nn.modules.batchnorm._BatchNorm.
         """
 
         super(RecurrentNorm2d, self).__init__()
+        if norm_type not in NORM_TYPES:
+            raise ValueError('norm_type {} unsupported, expected one of {}'.format(norm_type, NORM_TYPES))
+        if norm_type == 'layer':
+            num_groups = 1
+        if norm_type != 'batch' and num_features % num_groups != 0:
+            raise ValueError('{} features can not be split into {} groups'.format(num_features, num_groups))
+
         self.num_features = num_features
         self.max_length = max_length
         self.affine = affine
         self.eps = eps
         self.momentum = momentum
+        self.norm_type = norm_type
+        self.num_groups = num_groups
         if self.affine:
             self.weight = nn.Parameter(torch.FloatTensor(num_features))
             # no bias term as described in the paper
@@ -39,43 +53,87 @@ class RecurrentNorm2d(nn.Module):
             self.register_parameter('weight', None)
             self.register_parameter('bias', None)
 
-        for i in range(max_length):
-            self.register_buffer(
-                'running_mean_{}'.format(i), torch.zeros(num_features))
-            self.register_buffer(
-                'running_var_{}'.format(i), torch.ones(num_features))
+        if self.norm_type == 'batch':
+            self.register_buffer('running_mean', torch.zeros(max_length, num_features))
+            self.register_buffer('running_var', torch.ones(max_length, num_features))
         
         self.reset_parameters()
 
     def reset_parameters(self):
-        for i in range(self.max_length):
-            running_mean_i = getattr(self, 'running_mean_{}'.format(i))
-            running_var_i = getattr(self, 'running_var_{}'.format(i))
-            running_mean_i.zero_()
-            running_var_i.fill_(1)
+        if self.norm_type == 'batch':
+            self.running_mean.zero_()
+            self.running_var.fill_(1)
         if self.affine:
             # initialize to .1 as advocated in the paper
             self.weight.data = torch.ones(self.num_features) * .1
             
-    def _check_input_dim(self, input_):
-        if input_.size(1) != self.running_mean_0.nelement():
+    def _check_input_dim(self, input_, dim=1):
+        if input_.size(dim) != self.num_features:
             raise ValueError('got {}-feature tensor, expected {}'
-                             .format(input_.size(1), self.num_features))
+                             .format(input_.size(dim), self.num_features))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the statistics were stacked have one buffer per timestep
+        for name in ['running_mean', 'running_var']:
+            old_keys = ['{}{}_{}'.format(prefix, name, i) for i in range(self.max_length)]
+            if all(key in state_dict for key in old_keys):
+                state_dict[prefix + name] = torch.stack([state_dict.pop(key) for key in old_keys])
+        super(RecurrentNorm2d, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, input_, time):
+        """
+        Args:
+          input_ - (tensor) [batch x num_features x rows x cols]
+          time - (int) timestep of input_, timesteps past max_length share the last statistics
+        """
         self._check_input_dim(input_)
+        if self.norm_type != 'batch':
+            return functional.group_norm(input_, self.num_groups, self.weight, self.bias, self.eps)
+
         if time >= self.max_length:
             time = self.max_length - 1
-        running_mean = getattr(self, 'running_mean_{}'.format(time))
-        running_var = getattr(self, 'running_var_{}'.format(time))
         return functional.batch_norm(
-            input=input_, running_mean=running_mean, running_var=running_var,
+            input=input_, running_mean=self.running_mean[time], running_var=self.running_var[time],
             weight=self.weight, bias=self.bias, training=self.training,
             momentum=self.momentum, eps=self.eps)
 
+    def forward_all(self, input_, batch_sizes=None):
+        """ Normalizes every timestep in one call, with the same statistics as calling
+            forward once per timestep.
+
+        Args:
+          input_ - (tensor) [batch x timesteps x num_features x rows x cols]
+          batch_sizes - (list of ints) if not None, only the first batch_sizes[t] samples of 
+                        timestep t are normalized and the rest is zero, see modelling.util.sort_by_length
+        """
+        self._check_input_dim(input_, dim=2)
+        batch, timesteps = input_.shape[:2]
+        if batch_sizes is not None:
+            if self.norm_type != 'batch':
+                return apply_running(lambda frames: functional.group_norm(frames, self.num_groups, self.weight, self.bias, self.eps),
+                                     input_, batch_sizes)
+            # batch statistics only over the running samples of each timestep
+            return torch.stack([torch.cat([self.forward(input_[:n, t], t), input_.new_zeros((batch - n,) + input_.shape[2:])])
+                                if n > 0 else input_.new_zeros((batch,) + input_.shape[2:])
+                                for t, n in enumerate(batch_sizes)], dim=1)
+        if self.norm_type != 'batch':
+            output = functional.group_norm(input_.contiguous().view(batch * timesteps, *input_.shape[2:]),
+                                           self.num_groups, self.weight, self.bias, self.eps)
+            return output.view(input_.shape)
+
+        if timesteps > self.max_length:
+            return torch.stack([self.forward(input_[:, t], t) for t in range(timesteps)], dim=1)
+        # timesteps become channels, so each (timestep, channel) pair gets its own statistics
+        output = functional.batch_norm(
+            input=input_.contiguous().view(batch, timesteps * self.num_features, *input_.shape[3:]),
+            running_mean=self.running_mean[:timesteps].view(-1), running_var=self.running_var[:timesteps].view(-1),
+            weight=self.weight.repeat(timesteps) if self.affine else None, bias=None, training=self.training,
+            momentum=self.momentum, eps=self.eps)
+        return output.view(input_.shape)
+
     def __repr__(self):
         return ('{name}({num_features}, eps={eps}, momentum={momentum},'
-                ' max_length={max_length}, affine={affine})'
+                ' max_length={max_length}, affine={affine}, norm_type={norm_type})'
                 .format(name=self.__class__.__name__, **self.__dict__))
 
 
@@ -107,8 +107,6 @@ class UNet_Encode(nn.Module):
     def forward(self, x, hres):
 
         # ENCODE
-        x = x.cuda()
-        if hres is not None: hres = hres.cuda()
         if (self.use_planet and self.resize_planet) or (not self.use_planet):
             enc3 = self.enc3(x)
         else:
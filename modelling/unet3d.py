@@ -59,7 +59,6 @@ class UNet3D(nn.Module):
         self.dropout = nn.Dropout(p=dropout, inplace=True)
         
     def forward(self, x):
-        x = x.cuda()
         en3 = self.en3(x)
         pool_3 = self.pool_3(en3)
         en4 = self.en4(pool_3)
@@ -1,5 +1,8 @@
+import contextlib
+import inspect
 import torch 
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 from constants import *
 
@@ -45,6 +48,212 @@ def get_num_bands(kwargs):
     num_bands['all'] = num_bands['s1'] + num_bands['s2'] + num_bands['planet'] 
     return num_bands
 
+def get_crnn_opts(kwargs):
+    """ Options of the CLSTM / CGRU recurrence, passed down from get_model like attn_dims
+
+    Args:
+      kwargs - (dict) training args
+    Returns:
+      (dict) with
+        precompute_inputs - (bool) if True, run the input convs of all timesteps before the time loop
+        norm_type - (str) normalization of the cells, 'batch', 'layer' or 'group'
+        norm_groups - (int) number of groups used by group norm
+        fused_bidirectional - (bool) if True, run both directions of a bidirectional CLSTM in one time loop
+        checkpoint_segment - (int) timesteps per gradient checkpointed segment of the time loop, 0 to not checkpoint
+        tbptt_steps - (int) timesteps between truncations of backprop through time, 0 for full backprop;
+                      only shortens the gradient paths, the graphs of all windows are kept for the one backward
+    """
+    return { 'precompute_inputs': kwargs.get('crnn_precompute_inputs', True),
+             'norm_type': kwargs.get('crnn_norm', 'batch'),
+             'norm_groups': kwargs.get('crnn_norm_groups', 4),
+             'fused_bidirectional': kwargs.get('crnn_fused_bidirectional', True),
+             'checkpoint_segment': kwargs.get('crnn_checkpoint_segment', 0),
+             'tbptt_steps': kwargs.get('crnn_tbptt_steps', 0) }
+
+def get_encoder_opts(kwargs):
+    """ Options of the UNet encoding of single timestep frames, passed down from get_model like crnn_opts
+
+    Args:
+      kwargs - (dict) training args
+    Returns:
+      (dict) with
+        chunk_frames - (int) frames encoded at a time, 0 for all frames at once
+        checkpoint - (bool) if True, recompute the activations of each chunk in backward
+    """
+    return { 'chunk_frames': kwargs.get('encoder_chunk_frames') or 0,
+             'checkpoint': kwargs.get('encoder_checkpoint', False) }
+
+def run_in_chunks(fn, inputs, chunk_frames=0, checkpointed=False):
+    """ Runs fn on slices of at most chunk_frames frames and concatenates its outputs.
+
+    Activation memory is bounded by chunk_frames instead of the number of frames. The
+    outputs are unchanged as long as fn treats frames independently, which batch norm
+    does not while training.
+
+    Args:
+      fn - (function) takes the inputs, returns a tuple / list of [frames x ...] tensors or Nones
+      inputs - (list) [frames x ...] tensors sliced along the first dim, Nones are passed as is
+      chunk_frames - (int) frames per slice, all frames at once if 0
+      checkpointed - (bool) if True, the activations of each slice are recomputed in backward
+    Returns:
+      (list) outputs of fn concatenated over the slices, None where fn returns None
+    """
+    num_frames = [x for x in inputs if x is not None][0].shape[0]
+    if chunk_frames <= 0:
+        chunk_frames = num_frames
+
+    chunk_outputs = []
+    for start in range(0, num_frames, chunk_frames):
+        chunk = [x[start:start+chunk_frames] if x is not None else None for x in inputs]
+        chunk_outputs.append(checkpoint_frames(fn, chunk) if checkpointed else list(fn(*chunk)))
+
+    if len(chunk_outputs) == 1:
+        return chunk_outputs[0]
+    return [torch.cat(outputs, dim=0) if outputs[0] is not None else None for outputs in zip(*chunk_outputs)]
+
+def checkpoint_frames(fn, inputs):
+    """ Runs fn on inputs under gradient checkpointing, see run_in_chunks.
+    """
+    tensors = [x for x in inputs if x is not None]
+    # checkpointed chunks only backprop into the weights if an input requires grad
+    if not any(x.requires_grad for x in tensors):
+        tensors = [x.detach().requires_grad_() for x in tensors]
+    # checkpoint only passes tensors, Nones are put back around the call
+    returned_none = []
+
+    def run(*tensors):
+        tensors = iter(tensors)
+        outputs = fn(*[next(tensors) if x is not None else None for x in inputs])
+        returned_none[:] = [output is None for output in outputs]
+        return tuple(output for output in outputs if output is not None)
+
+    # the UNet encoders normalize by group norm, they have no running statistics to protect
+    outputs = iter(checkpoint_module(run, None, *tensors))
+    return [None if is_none else next(outputs) for is_none in returned_none]
+
+def checkpoint_module(fn, module, *args):
+    """ Runs fn on args under reentrant gradient checkpointing, the only mode of torch 0.4.
+
+    fn is run a second time in backward to recompute its activations. The running
+    statistics of the batch norms in module, the module fn runs, are only updated by
+    the first run.
+
+    Args:
+      fn - (function) takes args, returns a tensor or a tuple of tensors
+      module - (nn.Module) module run by fn, None if it has no batch norms
+      args - (tensors) inputs of fn
+    """
+    runs = []
+
+    def run(*args):
+        runs.append(fn)
+        if len(runs) == 1 or module is None:
+            return fn(*args)
+        with frozen_running_stats(module):
+            return fn(*args)
+
+    # torch 2.x warns if the mode is not given
+    if 'use_reentrant' in inspect.signature(checkpoint).parameters:
+        return checkpoint(run, *args, use_reentrant=True)
+    return checkpoint(run, *args)
+
+@contextlib.contextmanager
+def frozen_running_stats(module):
+    """ Sets the momentum of the batch norms in module to 0, so that while training they still
+        normalize by batch statistics but leave their running statistics as they are.
+    """
+    norms = [norm for norm in module.modules() 
+             if getattr(norm, 'running_mean', None) is not None and getattr(norm, 'momentum', None) is not None]
+    momentums = [norm.momentum for norm in norms]
+    for norm in norms:
+        norm.momentum = 0.
+    try:
+        yield
+    finally:
+        for norm, momentum in zip(norms, momentums):
+            norm.momentum = momentum
+
+def get_time_segments(seq_len, checkpoint_segment=0, tbptt_steps=0):
+    """ Splits the time loop of a recurrent layer at every checkpoint segment and truncation.
+
+    Args:
+      seq_len - (int) number of timesteps
+      checkpoint_segment - (int) timesteps per checkpointed segment, 0 to not split for checkpointing
+      tbptt_steps - (int) timesteps between truncations of backprop through time, 0 to not truncate
+    Returns:
+      (list of tuples) (start, end, truncate) per segment, the state is detached before
+                       segments with truncate True
+    """
+    starts = {0}
+    if checkpoint_segment > 0:
+        starts.update(range(0, seq_len, checkpoint_segment))
+    if tbptt_steps > 0:
+        starts.update(range(0, seq_len, tbptt_steps))
+    starts = sorted(starts)
+    ends = starts[1:] + [seq_len]
+    return [(start, end, tbptt_steps > 0 and start > 0 and start % tbptt_steps == 0) for start, end in zip(starts, ends)]
+
+def reverse_padded(inputs, lengths=None):
+    """ Reverses the non-padded prefix of each sequence in time, the padding stays at the end.
+
+    Args:
+      inputs - (tensor) [batch x timesteps x ...] sequences padded at the end
+      lengths - (tensor) [batch] number of non-padded timesteps, all timesteps if None
+    Returns:
+      (tensor) inputs with each sequence reversed, reversing twice gives back inputs
+    """
+    if lengths is None:
+        return torch.flip(inputs, dims=[1])
+    steps = torch.arange(inputs.shape[1], dtype=torch.long).unsqueeze(0)
+    lengths = torch.as_tensor(lengths, dtype=torch.long).cpu().unsqueeze(1)
+    index = torch.where(steps < lengths, lengths - 1 - steps, steps)
+    index = index.view(index.shape + (1,) * (inputs.dim() - 2)).expand_as(inputs)
+    return torch.gather(inputs, 1, index.to(inputs.device))
+
+def get_length_mask(lengths, max_len, device=None):
+    """ Returns the [batch x max_len] mask of non-padded timesteps, as the comparison dtype of torch.
+
+    Args:
+      lengths - (tensor) [batch] number of non-padded timesteps
+      max_len - (int) padded number of timesteps
+      device - (torch.device) device of the mask, the cpu if None
+    """
+    steps = torch.arange(max_len, dtype=torch.long).unsqueeze(0)
+    mask = steps < torch.as_tensor(lengths, dtype=torch.long).cpu().unsqueeze(1)
+    return mask.to(device) if device is not None else mask
+
+def sort_by_length(lengths, seq_len):
+    """ Orders a batch by decreasing length, so that the sequences still running at
+        any timestep are a prefix of the batch, like packed sequences.
+
+    Args:
+      lengths - (tensor) [batch] non-padded timesteps of each sequence
+      seq_len - (int) padded number of timesteps
+    Returns:
+      order - (LongTensor) batch indices by decreasing length
+      restore - (LongTensor) indices that undo order
+      batch_sizes - (list of ints) number of sequences still running at each timestep
+    """
+    lengths = torch.as_tensor(lengths, dtype=torch.long).cpu()
+    sorted_lengths, order = torch.sort(lengths, descending=True)
+    restore = torch.sort(order)[1]
+    batch_sizes = [int((sorted_lengths > t).sum()) for t in range(seq_len)]
+    return order, restore, batch_sizes
+
+def apply_running(fn, inputs, batch_sizes):
+    """ Applies a per-frame fn in one call to the timesteps of the sequences still running, zeros elsewhere.
+
+    Args:
+      fn - (function) maps [frames x ...] to [frames x ...]
+      inputs - (tensor) [batch x timesteps x ...], in the order of sort_by_length
+      batch_sizes - (list of ints) from sort_by_length
+    """
+    running = torch.arange(inputs.shape[0], dtype=torch.long).unsqueeze(1) < torch.tensor(batch_sizes, dtype=torch.long).unsqueeze(0)
+    running = running.to(inputs.device)
+    packed = fn(inputs[running])
+    outputs = packed.new_zeros(inputs.shape[:2] + packed.shape[1:])
+    outputs[running] = packed
+    return outputs
 
 def get_upsampling_weight(in_channels, out_channels, kernel_size):
     """Make a 2D bilinear kernel suitable for upsampling for FCN"""
@@ -27,7 +27,7 @@ from modelling.clstm_cell import ConvLSTMCell
 from modelling.clstm import CLSTM
 from modelling.cgru_segmenter import CGRUSegmenter
 from modelling.clstm_segmenter import CLSTMSegmenter
-from modelling.util import initialize_weights, get_num_bands, get_upsampling_weight, set_parameter_requires_grad
+from modelling.util import initialize_weights, get_num_bands, get_crnn_opts, get_encoder_opts, get_upsampling_weight, set_parameter_requires_grad, run_in_chunks
 from modelling.fcn8 import FCN8
 from modelling.unet import UNet, UNet_Encode, UNet_Decode
 from modelling.unet3d import UNet3D
@@ -41,7 +41,7 @@ class FCN_CRNN(nn.Module):
                  hidden_dims, lstm_kernel_sizes, conv_kernel_size, lstm_num_layers, avg_hidden_states, 
                  num_classes, bidirectional, pretrained, early_feats, use_planet, resize_planet, 
                  num_bands_dict, main_crnn, main_attn_type, attn_dims, 
-                 enc_crnn, enc_attn, enc_attn_type):
+                 enc_crnn, enc_attn, enc_attn_type, crnn_opts=None, cached_feats=False, encoder_opts=None):
         super(FCN_CRNN, self).__init__()
 
         self.fcn_input_size = fcn_input_size
@@ -59,6 +59,12 @@ class FCN_CRNN(nn.Module):
         self.num_bands_dict = num_bands_dict       
         self.main_attn_type = main_attn_type
         self.attn_dims = attn_dims
+        self.crnn_opts = crnn_opts
+        # inputs hold the encoder features written by cache_features.py instead of the grids
+        self.cached_feats = cached_feats
+        if cached_feats and not early_feats:
+            raise ValueError('Only the encoder features of --early_feats can be cached')
+        self.encoder_opts = encoder_opts if encoder_opts is not None else {}
         self.main_crnn = main_crnn
         self.enc_crnn = enc_crnn
         self.enc_attn = enc_attn
@@ -76,10 +82,12 @@ class FCN_CRNN(nn.Module):
         if crnn_model_name == "gru":
             if self.early_feats:
                 self.crnn = CGRUSegmenter(crnn_input_size, hidden_dims, lstm_kernel_sizes, 
-                                      conv_kernel_size, lstm_num_layers, crnn_input_size[1], bidirectional, avg_hidden_states)
+                                      conv_kernel_size, lstm_num_layers, crnn_input_size[1], bidirectional, avg_hidden_states,
+                                      crnn_opts=crnn_opts)
             else:
                 self.crnn = CGRUSegmenter(crnn_input_size, hidden_dims, lstm_kernel_sizes, 
-                                      conv_kernel_size, lstm_num_layers, num_classes, bidirectional, avg_hidden_states)
+                                      conv_kernel_size, lstm_num_layers, num_classes, bidirectional, avg_hidden_states,
+                                      crnn_opts=crnn_opts)
         
         elif crnn_model_name == "clstm":
             self.attns = self.get_attns()
@@ -88,23 +96,50 @@ class FCN_CRNN(nn.Module):
 
         self.logsoftmax = nn.LogSoftmax(dim=1)
 
+    def encode(self, frames, hres_frames=None):
+        """ Runs the encoder on single timestep frames.
+
+        Args:
+          frames - (tensor) [frames x bands x rows x cols]
+          hres_frames - (tensor) [frames x bands x rows x cols] high-res planet frames, or None
+        Returns:
+          (list of tensors) [frames x ...] features, center1, enc4, enc3, enc2 and enc1 with early_feats,
+                            else the UNet output; enc2 and enc1 are None without high-res planet
+        """
+        chunk_frames = self.encoder_opts.get('chunk_frames', 0)
+        checkpointed = self.encoder_opts.get('checkpoint', False) and self.training and torch.is_grad_enabled()
+        if self.early_feats:
+            return run_in_chunks(self.fcn_enc, [frames, hres_frames], chunk_frames, checkpointed)
+
+        enc_feats = run_in_chunks(self.fcn.unet_encode, [frames, hres_frames], chunk_frames, checkpointed)
+        # the batch norms of the decoder use the statistics of all frames while training
+        return run_in_chunks(lambda *feats: [self.fcn.unet_decode(*feats)], enc_feats, 
+                             0 if self.training else chunk_frames)
+
     def forward(self, input_tensor, hres_inputs=None):
-        batch, timestamps, bands, rows, cols = input_tensor.size()
-        fcn_input = input_tensor.view(batch * timestamps, bands, rows, cols)
+        if self.cached_feats:
+            # [batch x timestamps x ...] features of the one sensor, the first one in place of the grids
+            sat = [sat for sat in ['s1', 's2', 'planet'] if sat in input_tensor][0]
+            feats = [input_tensor[sat].float()] + [input_tensor[sat + '_' + name].float() for name in CACHED_FEATS[1:]]
+        else:
+            batch, timestamps, bands, rows, cols = input_tensor.size()
+            fcn_input = input_tensor.view(batch * timestamps, bands, rows, cols)
 
-        if len(hres_inputs.shape) > 1:
-            _, _, hbands, hrows, hcols = hres_inputs.size()
-            fcn_input_hres = hres_inputs.view(batch * timestamps, hbands, hrows, hcols)  
-        else: fcn_input_hres = None 
+            if len(hres_inputs.shape) > 1:
+                _, _, hbands, hrows, hcols = hres_inputs.size()
+                fcn_input_hres = hres_inputs.view(batch * timestamps, hbands, hrows, hcols)  
+            else: fcn_input_hres = None 
 
-        if self.early_feats:
-            # Encode features
-            center1_feats, enc4_feats, enc3_feats, enc2_feats, enc1_feats = self.fcn_enc(fcn_input, fcn_input_hres)
+            # Encode features and separate batch and timestamps
+            feats = [cur_feats.view(batch, timestamps, *cur_feats.shape[1:]) if cur_feats is not None else None
+                     for cur_feats in self.encode(fcn_input, fcn_input_hres)]
 
-            for cur_feats, cur_enc in zip([center1_feats, enc4_feats, enc3_feats, enc2_feats, enc1_feats], self.crnns):
+        if self.early_feats:
+            # without enc2 and enc1 in the cache
+            feats += [None] * (len(self.crnns) - len(feats))
+            for cur_feats, cur_enc in zip(feats, self.crnns):
                 if cur_feats is not None:
                     # Apply CRNN
-                    cur_feats = cur_feats.view(batch, timestamps, -1, cur_feats.shape[-2], cur_feats.shape[-1])
                     if self.crnns[cur_enc] is not None:
                         cur_feats_fwd, cur_feats_rev = self.crnns[cur_enc](cur_feats) 
                     else:
@@ -122,12 +157,9 @@ class FCN_CRNN(nn.Module):
                                                                self.processed_feats['enc2'], self.processed_feats['enc1'])
         
         else:
-            # Encode and decode features
-            fcn_output = self.fcn(fcn_input, fcn_input_hres)
-            
             # Apply CRNN
-            crnn_input = fcn_output.view(batch, timestamps, -1, fcn_output.shape[-2], fcn_output.shape[-1])
-            if self.crnn_main(crnn_input) is not None:
+            crnn_input = feats[0]
+            if self.crnn_main is not None:
                 crnn_output_fwd, crnn_output_rev = self.crnn_main(crnn_input)
             else:
                 crnn_output_fwd = crnn_input
@@ -147,21 +179,21 @@ class FCN_CRNN(nn.Module):
         if self.early_feats:
             if self.main_crnn:
                 self.crnn_main = CLSTMSegmenter(self.crnn_input_size, self.hidden_dims, self.lstm_kernel_sizes, 
-                                   self.conv_kernel_size, self.lstm_num_layers, self.crnn_input_size[1], self.bidirectional) 
+                                   self.conv_kernel_size, self.lstm_num_layers, self.crnn_input_size[1], self.bidirectional, crnn_opts=self.crnn_opts) 
             if self.enc_crnn:
                 crnn_input0, crnn_input1, crnn_input2, crnn_input3 = self.crnn_input_size
                 self.crnn_enc4 = CLSTMSegmenter([crnn_input0, crnn_input1//2, crnn_input2*2, crnn_input3*2], self.hidden_dims, self.lstm_kernel_sizes, 
-                                   self.conv_kernel_size, self.lstm_num_layers, self.crnn_input_size[1]//2, self.bidirectional)
+                                   self.conv_kernel_size, self.lstm_num_layers, self.crnn_input_size[1]//2, self.bidirectional, crnn_opts=self.crnn_opts)
                 self.crnn_enc3 = CLSTMSegmenter([crnn_input0, crnn_input1//4, crnn_input2*4, crnn_input3*4], self.hidden_dims, self.lstm_kernel_sizes, 
-                                   self.conv_kernel_size, self.lstm_num_layers, self.crnn_input_size[1]//4, self.bidirectional)
+                                   self.conv_kernel_size, self.lstm_num_layers, self.crnn_input_size[1]//4, self.bidirectional, crnn_opts=self.crnn_opts)
                 if self.use_planet and not self.resize_planet:
                     self.crnn_enc2 = CLSTMSegmenter([crnn_input0, crnn_input1//8, crnn_input2*8, crnn_input3*8], self.hidden_dims, self.lstm_kernel_sizes, 
-                                       self.conv_kernel_size, self.lstm_num_layers, self.crnn_input_size[1]//8, self.bidirectional)
+                                       self.conv_kernel_size, self.lstm_num_layers, self.crnn_input_size[1]//8, self.bidirectional, crnn_opts=self.crnn_opts)
                     self.crnn_enc1 = CLSTMSegmenter([crnn_input0, crnn_input1//16, crnn_input2*16, crnn_input3*16], self.hidden_dims, self.lstm_kernel_sizes, 
-                                       self.conv_kernel_size, self.lstm_num_layers, self.crnn_input_size[1]//16, self.bidirectional)
+                                       self.conv_kernel_size, self.lstm_num_layers, self.crnn_input_size[1]//16, self.bidirectional, crnn_opts=self.crnn_opts)
         else:
             self.crnn_main = CLSTMSegmenter(self.crnn_input_size, self.hidden_dims, self.lstm_kernel_sizes, 
-                                   self.conv_kernel_size, self.lstm_num_layers, self.num_classes, self.bidirectional)
+                                   self.conv_kernel_size, self.lstm_num_layers, self.num_classes, self.bidirectional, crnn_opts=self.crnn_opts)
         self.crnns = { 'main': self.crnn_main, 'enc4': self.crnn_enc4, 'enc3': self.crnn_enc3, 'enc2': self.crnn_enc2, 'enc1': self.crnn_enc1 }
         return self.crnns
 
@@ -209,7 +241,12 @@ def make_MI_CLSTM_model(num_bands,
                         resize_planet,
                         grid_size,
                         main_attn_type,
-                        attn_dims): 
+                        attn_dims,
+                        crnn_opts=None,
+                        cached_feats=False,
+                        encoder_opts=None,
+                        parallel_branches=False,
+                        time_branches=False): 
 
     model = MI_CLSTM(num_bands,
                      unet_out_channels,
@@ -227,19 +264,24 @@ def make_MI_CLSTM_model(num_bands,
                      resize_planet,
                      grid_size,
                      main_attn_type,
-                     attn_dims)
+                     attn_dims,
+                     crnn_opts,
+                     cached_feats,
+                     encoder_opts,
+                     parallel_branches,
+                     time_branches)
     return model
 
 def make_MI_only_CLSTM_model(num_bands, crnn_input_size, hidden_dims, lstm_kernel_sizes, conv_kernel_size, 
                              lstm_num_layers, avg_hidden_states, num_classes, bidirectional, max_timesteps,
-                             satellites, main_attn_type, attn_dims):
+                             satellites, main_attn_type, attn_dims, crnn_opts=None):
 
     model = ONLY_CLSTM_MI(num_bands, crnn_input_size, hidden_dims, lstm_kernel_sizes, conv_kernel_size,
                           lstm_num_layers, avg_hidden_states, num_classes, bidirectional, max_timesteps,
-                          satellites, main_attn_type, attn_dims)
+                          satellites, main_attn_type, attn_dims, crnn_opts)
     return model
 
-def make_bidir_clstm_model(input_size, hidden_dims, lstm_kernel_sizes, conv_kernel_size, lstm_num_layers, num_classes, bidirectional, avg_hidden_states, main_attn_type, attn_dims):
+def make_bidir_clstm_model(input_size, hidden_dims, lstm_kernel_sizes, conv_kernel_size, lstm_num_layers, num_classes, bidirectional, avg_hidden_states, main_attn_type, attn_dims, crnn_opts=None):
     """ Defines a (bidirectional) CLSTM model 
     Args:
         input_size - (tuple) size of input dimensions 
@@ -250,12 +292,14 @@ def make_bidir_clstm_model(input_size, hidden_dims, lstm_kernel_sizes, conv_kern
         num_classes - (int) number of classes to predict
         bidirectional - (bool) if True, include reverse inputs and concatenate output features from forward and reverse models
                                if False, use only forward inputs and features
+        crnn_opts - (dict) options of the CLSTM recurrence, see modelling.util.get_crnn_opts
     
     Returns:
       returns the model! 
     """
     model = CLSTMSegmenter(input_size, hidden_dims, lstm_kernel_sizes, conv_kernel_size, lstm_num_layers, num_classes, bidirectional, 
-                           with_pred=True, avg_hidden_states=avg_hidden_states, attn_type=main_attn_type, attn_dims=attn_dims) 
+                           with_pred=True, avg_hidden_states=avg_hidden_states, attn_type=main_attn_type, attn_dims=attn_dims,
+                           crnn_opts=crnn_opts) 
     return model
 
 
@@ -309,7 +353,6 @@ def make_UNet_model(n_class, num_bands_dict, late_feats_for_fcn=False, pretraine
         model.unet_encode.enc4.encode[3] = pre_trained_features[7] # 128 in, 128 out
         model.unet_encode.center[0] = pre_trained_features[10]     # 128 in, 256 out
         
-    model = model.cuda()
     return model
 
 def make_UNetEncoder_model(num_bands_dict, use_planet=True, resize_planet=False, pretrained=True):
@@ -325,19 +368,17 @@ def make_UNetEncoder_model(num_bands_dict, use_planet=True, resize_planet=False,
         model.enc4.encode[3] = pre_trained_features[7] # 128 in, 128 out
         model.center[0] = pre_trained_features[10]     # 128 in, 256 out
 
-    model = model.cuda()
     return model
 
 def make_UNetDecoder_model(n_class, late_feats_for_fcn, use_planet, resize_planet):
     model = UNet_Decode(n_class, late_feats_for_fcn, use_planet, resize_planet)
-    model = model.cuda()
     return model
 
 def make_fcn_clstm_model(country, fcn_input_size, crnn_input_size, crnn_model_name, 
                          hidden_dims, lstm_kernel_sizes, conv_kernel_size, lstm_num_layers, avg_hidden_states,
                          num_classes, bidirectional, pretrained, early_feats, use_planet, resize_planet,
                          num_bands_dict, main_crnn, main_attn_type, attn_dims,
-                         enc_crnn, enc_attn, enc_attn_type):
+                         enc_crnn, enc_attn, enc_attn_type, crnn_opts=None, cached_feats=False, encoder_opts=None):
     """ Defines a fully-convolutional-network + CLSTM model
     Args:
       fcn_input_size - (tuple) input dimensions for FCN model
@@ -352,6 +393,9 @@ def make_fcn_clstm_model(country, fcn_input_size, crnn_input_size, crnn_model_na
       bidirectional - (bool) if True, include reverse inputs and concatenate output features from forward and reverse models
                                if False, use only forward inputs and features
       pretrained - (bool) whether to use pre-trained weights
+      crnn_opts - (dict) options of the CLSTM / CGRU recurrence, see modelling.util.get_crnn_opts
+      cached_feats - (bool) whether inputs are the encoder features written by cache_features.py
+      encoder_opts - (dict) chunking of the frames fed to the UNet, see modelling.util.get_encoder_opts
 
     Returns: 
       returns the model!
@@ -364,11 +408,31 @@ def make_fcn_clstm_model(country, fcn_input_size, crnn_input_size, crnn_model_na
     model = FCN_CRNN(fcn_input_size, crnn_input_size, crnn_model_name, hidden_dims, lstm_kernel_sizes, 
                      conv_kernel_size, lstm_num_layers, avg_hidden_states, num_classes, bidirectional, pretrained, 
                      early_feats, use_planet, resize_planet, num_bands_dict, main_crnn, main_attn_type, attn_dims, 
-                     enc_crnn, enc_attn, enc_attn_type)
-    model = model.cuda()
+                     enc_crnn, enc_attn, enc_attn_type, crnn_opts, cached_feats, encoder_opts)
 
     return model
 
+def load_pretrained_weights(model, pretrained_model_path, dont_set=[]):
+    """ Copies the weights of a saved state dict into the parameters and buffers of model with the same name.
+
+    Args:
+      model - (nn.Module) model to update in place
+      pretrained_model_path - (str) path of the saved state dict
+      dont_set - (list of str) keys to leave as they are
+    Returns:
+      (list of str) keys that were updated
+    """
+    pre_trained_model = torch.load(pretrained_model_path, map_location='cpu')
+    updated_keys = []
+    with torch.no_grad():
+        for key, value in model.state_dict().items():
+            if key in dont_set: continue
+            elif key in pre_trained_model and pre_trained_model[key].shape == value.shape:
+                updated_keys.append(key)
+                # state_dict() shares storage with the model, so copy in place
+                value.copy_(pre_trained_model[key])
+    return updated_keys
+
 def make_UNet3D_model(n_class, n_channel, timesteps, dropout):
     """ Defined a 3d U-Net model
     Args: 
@@ -380,7 +444,6 @@ def make_UNet3D_model(n_class, n_channel, timesteps, dropout):
     """
 
     model = UNet3D(n_channel, n_class, timesteps, dropout)
-    model = model.cuda()
     return model
 
 def get_model(model_name, **kwargs):
@@ -422,7 +485,9 @@ def get_model(model_name, **kwargs):
                                        avg_hidden_states=kwargs.get('avg_hidden_states'),
                                        main_attn_type=kwargs.get('main_attn_type'),
                                        attn_dims = {'d': kwargs.get('d_attn_dim'), 'r': kwargs.get('r_attn_dim'),
-                                                    'dk': kwargs.get('dk_attn_dim'), 'dv': kwargs.get('dv_attn_dim')})
+                                                    'dk': kwargs.get('dk_attn_dim'), 'dv': kwargs.get('dv_attn_dim'),
+                                                    'chunk': kwargs.get('self_attn_chunk')},
+                                       crnn_opts=get_crnn_opts(kwargs))
 
     elif model_name == 'fcn':
         num_bands = get_num_bands(kwargs)['all']
@@ -462,24 +527,20 @@ def get_model(model_name, **kwargs):
                                      main_crnn=kwargs.get('main_crnn'),
                                      main_attn_type=kwargs.get('main_attn_type'),
                                      attn_dims = {'d': kwargs.get('d_attn_dim'), 'r': kwargs.get('r_attn_dim'),
-                                                  'dk': kwargs.get('dk_attn_dim'), 'dv': kwargs.get('dv_attn_dim')},
+                                                  'dk': kwargs.get('dk_attn_dim'), 'dv': kwargs.get('dv_attn_dim'),
+                                                  'chunk': kwargs.get('self_attn_chunk')},
                                      enc_crnn=kwargs.get('enc_crnn'),
                                      enc_attn=kwargs.get('enc_attn'),
-                                     enc_attn_type=kwargs.get('enc_attn_type'))
+                                     enc_attn_type=kwargs.get('enc_attn_type'),
+                                     crnn_opts=get_crnn_opts(kwargs),
+                                     cached_feats=kwargs.get('feature_cache'),
+                                     encoder_opts=get_encoder_opts(kwargs))
 
         if (pretrained_model_path is not None) and (kwargs.get('pretrained') == True):
-            pre_trained_model=torch.load(pretrained_model_path)
-       
             # don't set pretrained weights for weights and bias before predictions 
             #  because number of classes do not agree (i.e. germany has 17 classes)
-            dont_set = ['fcn_dec.final.6.weight', 'fcn_dec.final.6.bias']
-            updated_keys = []
-            for key, value in model.state_dict().items():
-                if key in dont_set: continue
-                elif key in pre_trained_model:
-                    updated_keys.append(key) 
-                    weights = pre_trained_model[key]   
-                    model.state_dict()[key] = weights
+            updated_keys = load_pretrained_weights(model, pretrained_model_path, 
+                                                   dont_set=['fcn_dec.final.6.weight', 'fcn_dec.final.6.bias'])
 
             for name, param in model.named_parameters():
                 if name in updated_keys:
@@ -520,7 +581,13 @@ def get_model(model_name, **kwargs):
                                     grid_size=GRID_SIZE[country], 
                                     main_attn_type=kwargs.get('main_attn_type'), 
                                     attn_dims={'d': kwargs.get('d_attn_dim'), 'r': kwargs.get('r_attn_dim'), 
-                                               'dv': kwargs.get('dv_attn_dim'), 'dk':kwargs.get('dk_attn_dim')})
+                                               'dv': kwargs.get('dv_attn_dim'), 'dk':kwargs.get('dk_attn_dim'),
+                                               'chunk': kwargs.get('self_attn_chunk')},
+                                    crnn_opts=get_crnn_opts(kwargs),
+                                    cached_feats=kwargs.get('feature_cache'),
+                                    encoder_opts=get_encoder_opts(kwargs),
+                                    parallel_branches=kwargs.get('parallel_branches'),
+                                    time_branches=kwargs.get('time_branches'))
     elif model_name == 'only_clstm_mi':
         satellites = {'s1': kwargs.get('use_s1'), 's2': kwargs.get('use_s2'), 'planet': kwargs.get('use_planet')}
    
@@ -545,11 +612,15 @@ def get_model(model_name, **kwargs):
                                          satellites=satellites,
                                          main_attn_type=kwargs.get('main_attn_type'), 
                                          attn_dims={'d': kwargs.get('d_attn_dim'), 'r': kwargs.get('r_attn_dim'), 
-                                                    'dv': kwargs.get('dv_attn_dim'), 'dk':kwargs.get('dk_attn_dim')})
+                                                    'dv': kwargs.get('dv_attn_dim'), 'dk':kwargs.get('dk_attn_dim'),
+                                                    'chunk': kwargs.get('self_attn_chunk')},
+                                         crnn_opts=get_crnn_opts(kwargs))
 
     else:
         raise ValueError(f"Model {model_name} unsupported, check `model_name` arg") 
         
+    if model_name in DL_MODELS:
+        model = model.to(kwargs.get('device', 'cpu'))
 
     return model
 
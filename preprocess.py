@@ -63,9 +63,9 @@ def maskForLoss(y_pred, y_true):
       y_pred - (torch tensor) torch.Size([batch_size*img_height*img_width, num_classes])
                 tensor of predicted crop classes
     """
-    loss_mask = torch.sum(y_true, dim=1).type(torch.LongTensor)
+    loss_mask = torch.sum(y_true, dim=1).long()
 
-    loss_mask_repeat = loss_mask.unsqueeze(1).repeat(1,y_pred.shape[1]).type(torch.FloatTensor).cuda()
+    loss_mask_repeat = loss_mask.unsqueeze(1).repeat(1,y_pred.shape[1]).to(y_pred.device, torch.float32)
     y_pred = y_pred * loss_mask_repeat
    
     # take argmax to get true values from one-hot encoding 
@@ -92,16 +92,73 @@ def maskForMetric(y_pred, y_true):
                 tensor of predicted crop classes, argmaxed
     """
     # Create mask for valid pixel locations
-    loss_mask = torch.sum(y_true, dim=1).type(torch.LongTensor)
+    loss_mask = torch.sum(y_true, dim=1).long()
     # Take argmax for labels and targets
     _, y_true = torch.max(y_true, dim=1)
     _, y_pred = torch.max(y_pred, dim=1)
 
     # Get only valid locations
     y_true = y_true[loss_mask == 1]
-    y_pred = y_pred[loss_mask == 1]
+    y_pred = y_pred[(loss_mask == 1).to(y_pred.device)]
     return y_pred, y_true
 
+def maskIndexForMetric(y_pred, y_true):
+    """
+    Same as maskForMetric for integer labels.
+
+    Args:
+      y_true - (torch tensor) torch.Size([batch_size, img_height, img_width])
+                uint8 class maps of ground truth crop classes, 0 for unlabeled pixels
+      y_pred - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width])
+                tensor of predicted crop classes
+
+    Returns:
+      y_true - (torch tensor) torch.Size([valid_pixel_locations])
+                tensor of ground truth crop classes, starting at 0
+      y_pred - (torch tensor) torch.Size([valid_pixel_locations])
+                tensor of predicted crop classes, argmaxed
+    """
+    valid = y_true > 0
+    _, y_pred = torch.max(y_pred, dim=1)
+    y_pred = y_pred[valid.to(y_pred.device)]
+    y_true = y_true[valid].long() - 1
+    return y_pred, y_true
+
+def indexLabelsForLoss(y_true):
+    """
+    Flattens integer labels into the targets of an NLL loss with ignore_index=LABEL_IGNORE_INDEX.
+
+    Args:
+      y_true - (torch tensor) torch.Size([batch_size, img_height, img_width])
+                uint8 class maps of ground truth crop classes, 0 for unlabeled pixels
+
+    Returns:
+      y_true - (LongTensor) torch.Size([batch_size*img_height*img_width]) crop classes
+                starting at 0, LABEL_IGNORE_INDEX for unlabeled pixels
+    """
+    y_true = y_true.contiguous().view(-1).long() - 1
+    return y_true.masked_fill_(y_true < 0, LABEL_IGNORE_INDEX)
+
+def remap_labels(mask, num_classes):
+    """
+    Maps the crop labels of a grid to the classes used for training.
+
+    Args:
+      mask - (np array) mask for grid that contains crop labels according
+             to '/home/data/crop_dict.npy'
+      num_classes - (int) number of classes, see onehot_mask
+
+    Returns:
+      Returns a copy of the mask with classes 1 to num_classes and 0 for unlabeled pixels.
+    """
+    mask = np.array(mask)
+    if num_classes == 2:
+        # TODO: why do we treat this as a separate case?
+        mask[(mask != 2) & (mask > 0)] = 1
+    else:
+        mask[mask > num_classes] = 0
+    return mask
+
 def onehot_mask(mask, num_classes):
     """
     Return a one-hot version of the mask for a grid
@@ -119,12 +176,7 @@ def onehot_mask(mask, num_classes):
       Returns a mask of size [64 x 64 x num_classes]. If a pixel was unlabeled, 
       it has 0's in all channels of the one hot mask at that pixel location.
     """
-    if num_classes == 2:
-        # TODO: why do we treat this as a separate case?
-        mask[(mask != 2) & (mask > 0)] = 1
-    else:
-        mask[mask > num_classes] = 0
-    return np.eye(num_classes+1)[mask][:, :, 1:] 
+    return np.eye(num_classes+1)[remap_labels(mask, num_classes)][:, :, 1:] 
 
 def doy2stack(doy_vec, in_shp):
     """ Creates input bands for day of year values
@@ -180,8 +232,7 @@ def retrieve_best_s2_grid(grid_name, country):
 def get_least_cloudy_idx(cloud_stack):
     """ Get index of least cloudy image from a stack of cloud masks
     """
-    cloud_stack = remap_cloud_stack(cloud_stack)
-    cloudiness = np.mean(cloud_stack, axis=(0, 1))
+    cloudiness = get_cloud_scores(cloud_stack)
     least_cloudy_idx = np.argmax(cloudiness)
     return least_cloudy_idx
 
@@ -218,7 +269,7 @@ def preprocess_clouds(clouds, model_name, time_slice=None, transform=False, rot=
     
     raise ValueError(f'Model: {model_name} unsupported')
 
-def preprocess_label(label, model_name, num_classes=None, transform=False, rot=None):
+def preprocess_label(label, model_name, num_classes=None, transform=False, rot=None, onehot=True):
     """ Returns a preprocess version of the label based on the model.
 
     Usually this just means converting to a one hot representation and 
@@ -227,26 +278,30 @@ def preprocess_label(label, model_name, num_classes=None, transform=False, rot=N
     Args:
         label - (npy arr) categorical labels for each pixel
         model_name - (str) name of the model
+        onehot - (bool) if false, keep the labels as a uint8 class map with 0 for unlabeled pixels
     Returns:
-        (npy arr) [num_classes x 64 x 64]
+        (npy arr) [num_classes x 64 x 64], or [64 x 64] if not onehot
     """
     # TODO: make this into a constant somewhere so we don't have to keep adding models
     if model_name in ["bidir_clstm", "fcn", "fcn_crnn", "unet", "unet3d", "random_forest", "mi_clstm", "only_clstm_mi"]:
         assert not num_classes is None
-        return preprocessLabel(label, num_classes, transform, rot)
+        return preprocessLabel(label, num_classes, transform, rot, onehot)
     
     raise ValueError(f'Model: {model_name} unsupported')
     
-def preprocessLabel(label, num_classes, transform, rot):
+def preprocessLabel(label, num_classes, transform, rot, onehot=True):
     """ Converts to onehot encoding and shifts channels to be first dim.
 
     Args:
         label - (npy arr) [64x64] categorical labels for each pixel
         num_classes - (npy arr) number of classes 
+        onehot - (bool) if false, return the uint8 [64x64] class map instead
     """
     if transform:
         label = np.fliplr(label)
         label = np.rot90(label, k=rot)
+    if not onehot:
+        return torch.tensor(remap_labels(label, num_classes), dtype=torch.uint8)
     label = onehot_mask(label, num_classes)
     label = np.transpose(label, [2, 0, 1])
     label = torch.tensor(label.copy(), dtype=torch.float32)
@@ -291,6 +346,76 @@ def preprocessClouds(clouds):
     clouds = (clouds - 1.5)/1.5
     return clouds
 
+def dihedral_transform(x, transform, dims):
+    """ Applies one of the 8 dihedral transforms to the square spatial dims of a tensor.
+
+    Same as preprocessGrid / preprocessLabel: flips the columns if transform >= 4,
+    then rotates by transform % 4 quarter turns like np.rot90.
+
+    Args:
+      x - (tensor) tensor with square spatial dims
+      transform - (int) 0 to 7, 0 is the identity
+      dims - (tuple of ints) rows and cols dims of x
+    """
+    rows, cols = dims
+    if transform >= 4:
+        x = x.flip(cols)
+    k = transform % 4
+    if k == 1:
+        x = x.flip(cols).transpose(rows, cols)
+    elif k == 2:
+        x = x.flip(rows).flip(cols)
+    elif k == 3:
+        x = x.transpose(rows, cols).flip(cols)
+    return x
+
+def augment_batch(inputs, targets, cloudmasks=None, hres_inputs=None):
+    """ Applies a random dihedral transform to each sample of a collated batch.
+
+    Samples are grouped by transform so that each group is one gather, one tensor op
+    and one scatter per tensor, on whichever device the batch is on. A sample's
+    inputs, labels, cloudmasks and high-res grid get the same transform.
+
+    Args:
+      inputs - (tensor or dict) [batch x ... x rows x cols] grids, or with var_length
+               a dict with one such tensor per sensor, the _lengths / _mask entries are left as is
+      targets - (tensor) [batch x classes x rows x cols] labels
+      cloudmasks - (tensor) [batch x 1 x rows x cols x timestamps] cloudmasks, left as is if there are none
+      hres_inputs - (tensor) [batch x ... x rows x cols] high-res planet grids, left as is if there are none
+    Returns:
+      inputs, targets, cloudmasks, hres_inputs transformed
+    """
+    tensors = {}
+    if isinstance(inputs, dict):
+        for key in inputs:
+            if not key.endswith('_lengths') and not key.endswith('_mask'):
+                tensors[key] = (inputs[key], (-2, -1))
+    else:
+        tensors['inputs'] = (inputs, (-2, -1))
+    tensors['targets'] = (targets, (-2, -1))
+    # without clouds / planet the collated placeholders are not grids
+    if torch.is_tensor(cloudmasks) and cloudmasks.dim() == 5:
+        tensors['cloudmasks'] = (cloudmasks, (2, 3))
+    if torch.is_tensor(hres_inputs) and hres_inputs.dim() >= 4:
+        tensors['hres_inputs'] = (hres_inputs, (-2, -1))
+
+    transforms = torch.randint(0, 8, (targets.shape[0],), dtype=torch.long)
+    outs = { key: torch.empty_like(x) for key, (x, _) in tensors.items() }
+    for transform in range(8):
+        idxs = (transforms == transform).nonzero().view(-1)
+        if idxs.numel() == 0: continue
+        for key, (x, dims) in tensors.items():
+            sample_idxs = idxs.to(x.device)
+            outs[key][sample_idxs] = dihedral_transform(x.index_select(0, sample_idxs), transform, dims)
+
+    if isinstance(inputs, dict):
+        inputs = dict(inputs)
+        inputs.update({ key: out for key, out in outs.items() if key in inputs })
+    else:
+        inputs = outs['inputs']
+    return (inputs, outs['targets'], outs.get('cloudmasks', cloudmasks),
+            outs.get('hres_inputs', hres_inputs))
+
 def moveTimeToStart(arr):
     """ Moves time axis to the first dim.
         
@@ -410,6 +535,61 @@ def remap_cloud_stack(cloud_stack):
     return remapped_cloud_stack
 
 
+def compute_cloud_scores(cloud_stack):
+    """ Summarizes each timestamp of a cloud mask stack, as stored in the cloud_scores groups.
+
+    Args:
+      cloud_stack - (numpy array) [rows x cols x timestamps] cloud masks with
+                     clear = 0, clouds = 1, shadows = 2, haze = 3
+
+    Returns:
+      scores - (numpy array) [len(CLOUD_SCORE_COLUMNS) x timestamps] mean remapped class
+                and fraction of clear, cloud, shadow and haze pixels of each timestamp
+    """
+    fractions = np.stack([np.mean(cloud_stack == cloud_class, axis=(0, 1)) for cloud_class in range(4)])
+    # same as averaging remap_cloud_stack, without remapping every pixel
+    score = 3 * fractions[0] + 2 * fractions[2] + fractions[3]
+    return np.concatenate((score[np.newaxis], fractions), axis=0)
+
+def get_cloud_scores(cloud_stack, remapped=False):
+    """ Scores each timestamp by its mean remapped cloud class, higher is clearer.
+
+    Args:
+      cloud_stack - (numpy array) [rows x cols x timestamps] cloud masks
+      remapped - (boolean) whether cloud_stack was already remapped with remap_cloud_stack
+
+    Returns:
+      scores - (numpy array) [timestamps] score of each timestamp
+    """
+    if remapped:
+        return np.mean(cloud_stack, axis=(0, 1))
+    return compute_cloud_scores(cloud_stack)[CLOUD_SCORE_COLUMNS.index('score')]
+
+def sample_timestep_idxs(timestamps, num_samples, scores=None, reverse=False, least_cloudy=False, all_samples=False):
+    """ Picks the timestamps kept by sample_timeseries without touching the data.
+
+    Args:
+      timestamps - (int) number of timestamps in the series
+      num_samples - (int) number of timestamps to keep
+      scores - (numpy array) [timestamps] remapped cloud score of each timestamp, uniform if None
+      reverse, least_cloudy, all_samples - as in sample_timeseries
+
+    Returns:
+      samples - (numpy array) sorted indices of the kept timestamps, None if all are kept
+    """
+    if timestamps < num_samples or all_samples:
+        return None
+    if scores is None:
+        scores = np.ones((timestamps,))
+    if reverse:
+        scores = 3 - scores
+    if least_cloudy:
+        samples = scores.argsort()[-num_samples:]
+    else:
+        samples = np.random.choice(timestamps, size=num_samples, replace=False, p=softmax(scores))
+    samples.sort()
+    return samples
+
 def sample_timeseries(img_stack, num_samples, dates=None, cloud_stack=None, remap_clouds=True, reverse=False, verbose=False, timestamps_first=False, least_cloudy=False, sample_w_clouds=True, all_samples=False):
     """
     Args:
@@ -456,32 +636,19 @@ def sample_timeseries(img_stack, num_samples, dates=None, cloud_stack=None, rema
             return img_stack, dates, None 
         
     # Given a stack of cloud masks, remap it and use to compute scores
+    scores = None
     if isinstance(cloud_stack,np.ndarray):
         remapped_cloud_stack = remap_cloud_stack(cloud_stack)
     if isinstance(cloud_stack,np.ndarray) and sample_w_clouds:
-        scores = np.mean(remapped_cloud_stack, axis=(0, 1))
-    else:
-        if verbose:
-            print('NO INPUT CLOUD MASKS. USING RANDOM SAMPLING!')
-        scores = np.ones((timestamps,))
-
-    if reverse:
-        scores = 3 - scores
-    if least_cloudy:
-        samples = scores.argsort()[-num_samples:]
-    else:
-        # Compute probabilities of scores with softmax
-        probabilities = softmax(scores)
+        scores = get_cloud_scores(remapped_cloud_stack, remapped=True)
+    elif verbose:
+        print('NO INPUT CLOUD MASKS. USING RANDOM SAMPLING!')
 
-        if not all_samples:
-            # Sample from timestamp indices according to probabilities
-            samples = np.random.choice(timestamps, size=num_samples, replace=False, p=probabilities)
-        else:
-            # Take all indices as samples
-            samples = list(range(timestamps))   
- 
-    # Sort samples to maintain sequential ordering
-    samples.sort()
+    samples = sample_timestep_idxs(timestamps, num_samples, scores, reverse=reverse, 
+                                   least_cloudy=least_cloudy, all_samples=all_samples)
+    if samples is None:
+        # all timestamps are kept
+        samples = slice(None)
 
     # Use sampled indices to sample image and cloud stacks
     if timestamps_first:
@@ -494,26 +661,13 @@ def sample_timeseries(img_stack, num_samples, dates=None, cloud_stack=None, rema
     if dates is not None:
         sampled_dates = dates[samples] 
 
+    sampled_cloud_stack = None
     if isinstance(cloud_stack, np.ndarray):
         if remap_clouds:
-            if all_samples:
-                sampled_cloud_stack = remapped_cloud_stack
-            else: 
-                sampled_cloud_stack = remapped_cloud_stack[:, :, samples]
-        else:
-            if all_samples:
-                sampled_cloud_stack = cloud_stack
-            else:
-                sampled_cloud_stack = cloud_stack[:, :, samples]
-        if all_samples:
-            return img_stack, dates, sampled_cloud_stack
-        else:
-            return sampled_img_stack, sampled_dates, sampled_cloud_stack
-    else:
-        if all_samples:
-            return img_stack, dates, None
+            sampled_cloud_stack = remapped_cloud_stack[:, :, samples]
         else:
-            return sampled_img_stack, sampled_dates, None    
+            sampled_cloud_stack = cloud_stack[:, :, samples]
+    return sampled_img_stack, sampled_dates, sampled_cloud_stack
 
     
 def vectorize(home, country, data_set, satellite, ylabel_dir, band_order= 'bytime', random_sample = True, num_timestamp = 25, reverse = False, seed = 0):
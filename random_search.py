@@ -158,11 +158,11 @@ if __name__ ==  "__main__":
                                               '--env_name', search_range.env_name,
                                               '--country', search_range.country])
         generate_hps(train_args, search_range) 
+        train_args.device = util.get_device(train_args.device)
         train_args.epochs = search_range.epochs
         dataloaders = datasets.get_dataloaders(train_args.country, train_args.dataset, train_args)
         
         model = models.get_model(**vars(train_args))
-        model.to(train_args.device)
         experiment_name = f"model:{train_args.model_name}_dataset:{train_args.dataset}_epochs:{search_range.epochs}_sample_no:{sample_no}"
 
         train_args.name = experiment_name
@@ -175,9 +175,9 @@ if __name__ ==  "__main__":
             print("FINISHED TRAINING") 
             for state_dict_name in os.listdir(train_args.save_dir):
                 if (experiment_name + "_best") in state_dict_name:
-                    model.load_state_dict(torch.load(os.path.join(train_args.save_dir, state_dict_name)))
-                    train_loss, train_f1, train_acc = train.evaluate_split(model, train_args.model_name, dataloaders['train'], train_args.device, train_args.loss_weight, train_args.weight_scale, train_args.gamma, NUM_CLASSES[train_args.country], train_args.country, train_args.var_length)
-                    val_loss, val_f1, val_acc = train.evaluate_split(model, train_args.model_name, dataloaders['val'], train_args.device, train_args.loss_weight, train_args.weight_scale, train_args.gamma, NUM_CLASSES[train_args.country], train_args.country, train_args.var_length)
+                    model.load_state_dict(torch.load(os.path.join(train_args.save_dir, state_dict_name), map_location=train_args.device))
+                    train_loss, train_f1, train_acc = train.evaluate_split(model, train_args.model_name, dataloaders['train'], train_args.device, train_args.loss_weight, train_args.weight_scale, train_args.gamma, NUM_CLASSES[train_args.country], train_args.country, train_args.var_length, train_args.prefetch_batches)
+                    val_loss, val_f1, val_acc = train.evaluate_split(model, train_args.model_name, dataloaders['val'], train_args.device, train_args.loss_weight, train_args.weight_scale, train_args.gamma, NUM_CLASSES[train_args.country], train_args.country, train_args.var_length, train_args.prefetch_batches)
                     print(f"Best Performance (val): \n\t loss: {val_loss} \n\t f1: {val_f1}\n\t acc: {val_acc}")
                     print(f"Corresponding Train Performance: \n\t loss: {train_loss} \n\t f1: {train_f1}\n\t acc: {train_acc}")
 
@@ -193,7 +193,8 @@ if __name__ ==  "__main__":
             print("CRASHED!")
             print(e)
 
-        torch.cuda.empty_cache()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
         
         with open(search_range.hp_dict_name, "wb") as f:
             pickle.dump(hps, f)
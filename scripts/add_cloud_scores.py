@@ -0,0 +1,55 @@
+"""
+Run
+
+`python scripts/add_cloud_scores.py --country=X`
+
+to add the cloud_scores of every grid to a country's hdf5 file built before
+create_hdf5.py and make_32x32_grids.py wrote them. Works on both the per-grid
+and the packed layout, and skips grids that already have scores.
+
+"""
+import h5py
+import argparse
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import preprocess
+from constants import *
+from storage import PACKED_LAYOUT
+from tqdm import tqdm
+
+def add_grid_cloud_scores(hdf5_file):
+    """ Writes cloud_scores/<grid> next to every cloudmasks/<grid> of a per-grid layout file.
+    """
+    scores_group = hdf5_file.require_group('cloud_scores')
+    for grid in tqdm(hdf5_file['cloudmasks'].keys()):
+        if grid in scores_group: continue
+        scores = preprocess.compute_cloud_scores(hdf5_file['cloudmasks'][grid][()])
+        scores_group.create_dataset(grid, data=scores, dtype='f4')
+
+def add_packed_cloud_scores(hdf5_file, chunk_timesteps=4096):
+    """ Writes the [total s2 timestamps x len(CLOUD_SCORE_COLUMNS)] cloud_scores dataset of a packed file.
+    """
+    if 'cloud_scores' in hdf5_file: return
+    cloudmasks = hdf5_file['cloudmasks']
+    total = cloudmasks.shape[0]
+    scores = hdf5_file.create_dataset('cloud_scores', shape=(total, len(CLOUD_SCORE_COLUMNS)), dtype='f4')
+    for start in tqdm(range(0, total, chunk_timesteps)):
+        # packed cloudmasks are time first, compute_cloud_scores expects time last
+        stack = np.moveaxis(cloudmasks[start:start+chunk_timesteps], 0, -1)
+        scores[start:start+chunk_timesteps] = preprocess.compute_cloud_scores(stack).T
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--country', type=str, choices=['ghana', 'southsudan', 'tanzania', 'germany'],
+                        help='country to work on')
+    parser.add_argument('--hdf5_path', type=str, default=None,
+                        help='hdf5 file to add cloud scores to, defaults to HDF5_PATH of the country')
+    args = parser.parse_args()
+    hdf5_path = args.hdf5_path if args.hdf5_path is not None else HDF5_PATH[args.country]
+    with h5py.File(hdf5_path, 'a') as f:
+        if f.attrs.get('layout') == PACKED_LAYOUT:
+            add_packed_cloud_scores(f)
+        else:
+            add_grid_cloud_scores(f)
@@ -14,6 +14,7 @@ import pickle
 
 sys.path.insert(0, '../')
 import util
+import preprocess
 from pprint import pprint
 from tqdm import tqdm
 from skimage.transform import resize as imresize
@@ -85,6 +86,8 @@ def create_hdf5(args, groups=None):
     for group_name in groups:
         if group_name not in hdf5_file:
             hdf5_file.create_group(f'/{group_name}')
+        if group_name == 'cloudmasks' and 'cloud_scores' not in hdf5_file:
+            hdf5_file.create_group('/cloud_scores')
 
         actual_dir_name = None
         if group_name in ['s1', 's1_dates']:
@@ -140,6 +143,9 @@ def create_hdf5(args, groups=None):
                         if new_grid_name in all_new_grids:
                             print(f"Processed {os.path.join(group_name, filepath)} as {hdf5_filename} with dtype: {dtype}")
                             hdf5_file.create_dataset(hdf5_filename, data=data, dtype=dtype, chunks=True) 
+                            if group_name == 'cloudmasks':
+                                # per timestep scores let the datasets sample without reading the masks
+                                hdf5_file.create_dataset(f'/cloud_scores/{new_grid_name}', data=preprocess.compute_cloud_scores(data), dtype='f4')
                             if group_name in ['s1', 's2', 'planet']:
                                 _, _, _, l = sub_grid.shape
                                 length_group = group_name + "_length"
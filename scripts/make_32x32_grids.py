@@ -13,6 +13,7 @@ import os
 import sys
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 
+import preprocess
 from constants import *
 from skimage.transform import resize as imresize
 from tqdm import tqdm
@@ -58,7 +59,7 @@ def split_grids(country, num_pixels=32):
     new_splits = {'train': [], 'val': [], 'test': []}
     old_splits = {'train': train, 'val': val, 'test': test}
     NUM_PLANET_PIXELS = 128
-    groups = ['s1', 's2', 'labels', 'cloudmasks', 's1_dates', 's2_dates', 'planet', 'planet_dates']
+    groups = ['s1', 's2', 'labels', 'cloudmasks', 'cloud_scores', 's1_dates', 's2_dates', 'planet', 'planet_dates']
     hdf5_file = h5py.File(HDF5_PATH[country]+  "_32", 'a')
     for group_name in groups:
         if group_name not in hdf5_file:
@@ -116,6 +117,7 @@ def split_grids(country, num_pixels=32):
                     new_splits[split_name].append(sub_grid_name)
                     hdf5_file.create_dataset("labels/{}".format(sub_grid_name), data=label_sub_grids[i], dtype='i2', chunks=True)
                     hdf5_file.create_dataset("cloudmasks/{}".format(sub_grid_name), data=cloudmasks_sub_grids[i], dtype='i2', chunks=True)
+                    hdf5_file.create_dataset("cloud_scores/{}".format(sub_grid_name), data=preprocess.compute_cloud_scores(cloudmasks_sub_grids[i]), dtype='f4')
                     hdf5_file.create_dataset("s1_lengths/{}".format(sub_grid_name), data=s1_grid.shape[-1], dtype='i2')
                     hdf5_file.create_dataset("s2_lengths/{}".format(sub_grid_name), data=s2_grid.shape[-1], dtype='i2')
                     hdf5_file.create_dataset("s1_dates/{}".format(sub_grid_name), data=s1_dates_grid, dtype='i2')
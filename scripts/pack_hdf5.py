@@ -0,0 +1,88 @@
+"""
+Run
+
+`python scripts/pack_hdf5.py --country=X`
+
+to write a packed copy of the country's hdf5 file, then point HDF5_PATH in constants
+to the packed file. The datasets read either layout.
+
+The per-grid layout keeps one small dataset per grid in every group, which adds up
+to tens of thousands of objects. The packed layout has one dataset per group: sensors,
+their dates and the cloudmasks are concatenated along time and indexed by
+<sensor>_offsets / <sensor>_lengths, labels are stacked along a grid axis and
+`grids` holds the grid ids in index order.
+
+"""
+import h5py
+import argparse
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+from constants import *
+from storage import PACKED_LAYOUT, SERIES_GROUPS, TIME_GROUPS
+from tqdm import tqdm
+
+def pack_group(src, dst, group, grids, offsets, lengths, chunk_timesteps):
+    """ Concatenates the per-grid datasets of a group along time into one time first dataset.
+
+    Args:
+      src - (h5py File) per-grid layout file
+      dst - (h5py File) packed file being written
+      group - (str) group to pack, a sensor or one of TIME_GROUPS
+      grids - (list of str) grid ids in index order
+      offsets - (np array) start of each grid along the packed time axis
+      lengths - (np array) number of timestamps of each grid, 0 if the grid is missing
+      chunk_timesteps - (int) number of timestamps per hdf5 chunk
+    """
+    first = src[group][grids[int(lengths.argmax())]]
+    total = int(lengths.sum())
+    shape = first.shape[:-1]
+    packed = dst.create_dataset(group, shape=(total,) + shape, dtype=first.dtype,
+                                chunks=(max(1, min(chunk_timesteps, total)),) + shape)
+    for i, grid in enumerate(tqdm(grids, desc=group)):
+        if lengths[i] == 0: continue
+        arr = src[group][grid][()]
+        if arr.shape[-1] != lengths[i]:
+            raise ValueError(f'{group}/{grid} has {arr.shape[-1]} timestamps, its sensor has {lengths[i]}')
+        packed[offsets[i]:offsets[i]+lengths[i]] = np.moveaxis(arr, -1, 0)
+
+def pack_hdf5(src_path, dst_path, chunk_timesteps=8):
+    """ Writes the packed layout of a per-grid layout hdf5 file.
+
+    Args:
+      src_path - (str) path to the per-grid layout hdf5 file
+      dst_path - (str) path to write the packed file to
+      chunk_timesteps - (int) number of timestamps per hdf5 chunk
+    """
+    with h5py.File(src_path, 'r') as src, h5py.File(dst_path, 'w') as dst:
+        grids = sorted(src['labels'].keys())
+        dst.create_dataset('grids', data=np.array(grids, dtype='S'))
+        dst.create_dataset('labels', data=np.stack([src['labels'][grid][()] for grid in tqdm(grids, desc='labels')]))
+
+        for sat in SERIES_GROUPS:
+            if sat not in src: continue
+            lengths = np.array([src[sat][grid].shape[-1] if grid in src[sat] else 0 for grid in grids])
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            dst.create_dataset(f'{sat}_lengths', data=lengths)
+            dst.create_dataset(f'{sat}_offsets', data=offsets)
+            pack_group(src, dst, sat, grids, offsets, lengths, chunk_timesteps)
+
+        for group, sat in TIME_GROUPS.items():
+            if group not in src or sat not in dst: continue
+            pack_group(src, dst, group, grids, dst[f'{sat}_offsets'][()], dst[f'{sat}_lengths'][()], chunk_timesteps)
+
+        # readers only treat the file as packed once everything is written
+        dst.attrs['layout'] = PACKED_LAYOUT
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--country', type=str, choices=['ghana', 'southsudan', 'tanzania', 'germany'],
+                        help='country to work on')
+    parser.add_argument('--out_path', type=str, default=None,
+                        help='path to write the packed file to, defaults to HDF5_PATH with a _packed suffix')
+    parser.add_argument('--chunk_timesteps', type=int, default=8,
+                        help='number of timestamps per hdf5 chunk')
+    args = parser.parse_args()
+    out_path = args.out_path if args.out_path is not None else HDF5_PATH[args.country] + '_packed'
+    pack_hdf5(HDF5_PATH[args.country], out_path, args.chunk_timesteps)
@@ -0,0 +1,507 @@
+"""
+
+File that houses the on-disk storage helpers used by the dataset wrappers.
+
+"""
+import os
+import h5py
+import itertools
+import warnings
+import numpy as np
+
+from multiprocessing.util import Finalize
+
+# Process-local pool of open hdf5 handles, keyed by (path, raw chunk cache size)
+_HDF5_POOL = {}
+# Readers over the pooled handles, same keys
+_READER_POOL = {}
+# Process-local GridMetadata, keyed by hdf5 path
+_METADATA_CACHE = {}
+_HDF5_POOL_PID = None
+
+
+def get_hdf5(hdf5_filepath, rdcc_nbytes=None):
+    """ Returns a read-only h5py handle for hdf5_filepath from a process-local pool.
+
+    Handles are opened lazily on first use in each process, so DataLoader workers
+    forked from the main process never read through a handle inherited from their
+    parent. All handles of a process are closed when it shuts down.
+
+    Args:
+      hdf5_filepath - (str) path to the hdf5 file
+      rdcc_nbytes - (int) size in bytes of the h5py raw chunk cache, h5py default if None
+
+    Returns:
+      handle - (h5py File) open, read-only hdf5 file
+    """
+    global _HDF5_POOL_PID
+    pid = os.getpid()
+    if _HDF5_POOL_PID != pid:
+        # Handles copied over by fork share state with the parent's, drop them
+        _HDF5_POOL.clear()
+        _READER_POOL.clear()
+        _HDF5_POOL_PID = pid
+        # Finalizers with an exitpriority also run in multiprocessing children,
+        #  which exit through os._exit and so skip atexit handlers
+        Finalize(None, close_hdf5_pool, exitpriority=10)
+
+    key = (hdf5_filepath, rdcc_nbytes)
+    handle = _HDF5_POOL.get(key)
+    if handle is None or not handle.id.valid:
+        kwargs = {} if rdcc_nbytes is None else {'rdcc_nbytes': rdcc_nbytes}
+        handle = h5py.File(hdf5_filepath, 'r', **kwargs)
+        _HDF5_POOL[key] = handle
+    return handle
+
+
+def get_grid_reader(hdf5_filepath, rdcc_nbytes=None):
+    """ Returns a reader over the pooled handle of hdf5_filepath that matches the file's layout.
+
+    Args:
+      hdf5_filepath - (str) path to the hdf5 file, either layout
+      rdcc_nbytes - (int) size in bytes of the h5py raw chunk cache, h5py default if None
+
+    Returns:
+      reader - (GridReader or PackedGridReader) reader over the file
+    """
+    handle = get_hdf5(hdf5_filepath, rdcc_nbytes)
+    key = (hdf5_filepath, rdcc_nbytes)
+    reader = _READER_POOL.get(key)
+    if reader is None or reader.handle is not handle:
+        if handle.attrs.get('layout') == PACKED_LAYOUT:
+            reader = PackedGridReader(handle)
+        else:
+            reader = GridReader(handle)
+        _READER_POOL[key] = reader
+    return reader
+
+
+def close_hdf5_pool():
+    """ Closes every pooled hdf5 handle opened by the current process.
+    """
+    if _HDF5_POOL_PID != os.getpid():
+        return
+    for handle in _HDF5_POOL.values():
+        if handle.id.valid:
+            handle.close()
+    _HDF5_POOL.clear()
+    _READER_POOL.clear()
+
+
+def hdf5_worker_init(worker_id):
+    """ DataLoader worker_init_fn that resets the hdf5 pool in a new worker.
+
+    Any handle inherited from the parent process is dropped here so that the
+    worker opens its own on first read.
+    """
+    global _HDF5_POOL_PID
+    _HDF5_POOL.clear()
+    _READER_POOL.clear()
+    _HDF5_POOL_PID = None
+
+
+# Value of the 'layout' attr of files written by scripts/pack_hdf5.py
+PACKED_LAYOUT = 'packed'
+# Groups holding one [bands x rows x cols x timestamps] series per grid
+SERIES_GROUPS = ['s1', 's2', 'planet']
+# Groups indexed along time like a sensor, and the sensor whose index they share
+TIME_GROUPS = { 's1_dates': 's1', 's2_dates': 's2', 'planet_dates': 'planet', 'cloudmasks': 's2', 'cloud_scores': 's2' }
+
+
+def index_ranges(idxs):
+    """ Coalesces sorted, unique indices into [start, stop) ranges of adjacent indices.
+
+    Args:
+      idxs - (list / np array) sorted, unique indices
+
+    Returns:
+      ranges - (list of tuples) (start, stop) of each run, ie. [0, 1, 2, 6] -> [(0, 3), (6, 7)]
+    """
+    idxs = np.asarray(idxs, dtype=int)
+    if len(idxs) == 0:
+        return []
+    breaks = np.nonzero(np.diff(idxs) != 1)[0] + 1
+    starts = idxs[np.concatenate(([0], breaks))]
+    stops = idxs[np.concatenate((breaks - 1, [len(idxs) - 1]))] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def read_selection(dataset, selection):
+    """ Reads a subset of an h5py dataset in a single read.
+
+    Every axis is selected by None (all of it), a contiguous slice or sorted,
+    unique indices. Indices are coalesced into ranges and the union of the
+    resulting hyperslabs is read at once, instead of h5py reading the whole
+    dataset or one hyperslab per index.
+
+    Args:
+      dataset - (h5py dataset) dataset to read from
+      selection - (tuple) per axis selection, missing trailing axes are read whole
+
+    Returns:
+      arr - (np array) the selected subset, axes in the dataset's order
+    """
+    axis_ranges = []
+    for axis, size in enumerate(dataset.shape):
+        sel = selection[axis] if axis < len(selection) else None
+        if sel is None:
+            axis_ranges.append([(0, size)])
+        elif isinstance(sel, slice):
+            start, stop, step = sel.indices(size)
+            if step != 1:
+                raise ValueError('Only contiguous slices can be read as hyperslabs')
+            axis_ranges.append([(start, stop)])
+        else:
+            axis_ranges.append(index_ranges(sel))
+
+    shape = tuple(sum(stop - start for start, stop in ranges) for ranges in axis_ranges)
+    arr = np.empty(shape, dtype=dataset.dtype)
+    if arr.size == 0:
+        return arr
+
+    fspace = dataset.id.get_space()
+    fspace.select_none()
+    # blocks are visited in row-major order, as hdf5 iterates a union selection
+    for block in itertools.product(*axis_ranges):
+        fspace.select_hyperslab(tuple(start for start, _ in block), 
+                                tuple(stop - start for start, stop in block), 
+                                op=h5py.h5s.SELECT_OR)
+    mspace = h5py.h5s.create_simple(shape)
+    dataset.id.read(mspace, fspace, arr)
+    return arr
+
+
+class GridReader:
+    """
+        Reads grids from the per-grid layout written by scripts/create_hdf5.py,
+        where every grid is its own dataset in each group, ie. s2/<grid>.
+    """
+    def __init__(self, handle):
+        """
+        Args:
+          handle - (h5py File) open hdf5 file
+        """
+        self.handle = handle
+
+    def has(self, group):
+        """ Whether the file has group, ie. cloud_scores are missing from files built before they existed.
+        """
+        return group in self.handle
+
+    def grids(self, group):
+        """ Returns the ids of the grids stored in group.
+        """
+        return list(self.handle[group].keys())
+
+    def length(self, group, grid):
+        """ Returns the number of timestamps of a grid in a sensor group, from metadata only.
+        """
+        return self.handle[group][grid].shape[-1]
+
+    def read(self, group, grid, bands=None, times=None):
+        """ Reads a grid from group, only the requested bands and timestamps.
+
+        Args:
+          group - (str) group to read from, ie. 's2', 's2_dates', 'cloudmasks' or 'labels'
+          grid - (str) grid id
+          bands - (list / slice) sorted bands to read from sensor groups, all if None
+          times - (list / np array) sorted timestamps to read from sensor and time groups, all if None
+
+        Returns:
+          arr - (np array) [bands x rows x cols x timestamps] for sensors, [rows x cols x timestamps]
+                 for cloudmasks, [len(CLOUD_SCORE_COLUMNS) x timestamps] for cloud_scores,
+                 [timestamps] for dates and [rows x cols] for labels
+        """
+        dataset = self.handle[group][grid]
+        if bands is None and times is None:
+            return dataset[()]
+        selection = [None] * dataset.ndim
+        if group in SERIES_GROUPS:
+            selection[0] = bands
+        if group in SERIES_GROUPS or group in TIME_GROUPS:
+            selection[-1] = times
+        return read_selection(dataset, selection)
+
+
+class PackedGridReader:
+    """
+        Reads grids from the packed layout written by scripts/pack_hdf5.py.
+
+        Each sensor is a single [total timestamps x bands x rows x cols] dataset
+        with every grid's timestamps concatenated, indexed by <sensor>_offsets and
+        <sensor>_lengths. Dates and cloudmasks are packed along the same time axis
+        as their sensor and labels are one [grids x rows x cols] dataset, so a grid
+        is one hyperslab read in every group.
+    """
+    def __init__(self, handle):
+        """
+        Args:
+          handle - (h5py File) open hdf5 file with the packed layout
+        """
+        self.handle = handle
+        grids = [grid.decode() for grid in handle['grids'][()]]
+        self.grid_idxs = { grid: i for i, grid in enumerate(grids) }
+        self.offsets = {}
+        self.lengths = {}
+        for sat in SERIES_GROUPS:
+            if sat in handle:
+                self.offsets[sat] = handle[f'{sat}_offsets'][()]
+                self.lengths[sat] = handle[f'{sat}_lengths'][()]
+
+    def has(self, group):
+        return group in self.handle
+
+    def grids(self, group):
+        if group in self.lengths:
+            return [grid for grid, i in self.grid_idxs.items() if self.lengths[group][i] > 0]
+        return list(self.grid_idxs.keys())
+
+    def length(self, group, grid):
+        return int(self.lengths[group][self.grid_idxs[grid]])
+
+    def read(self, group, grid, bands=None, times=None):
+        idx = self.grid_idxs[grid]
+        if group not in SERIES_GROUPS and group not in TIME_GROUPS:
+            return self.handle[group][idx]
+
+        sat = TIME_GROUPS.get(group, group)
+        start = int(self.offsets[sat][idx])
+        if times is None:
+            selection = [slice(start, start + int(self.lengths[sat][idx]))]
+        else:
+            selection = [start + np.asarray(times, dtype=int)]
+        if group in SERIES_GROUPS:
+            selection.append(bands)
+        arr = read_selection(self.handle[group], selection)
+        # time goes last, as in the per-grid layout
+        return np.moveaxis(arr, 0, -1)
+
+
+def source_stamp(filepath):
+    """ Returns the (mtime in ns, size in bytes) of a file, used to detect stale caches.
+    """
+    stat = os.stat(filepath)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def is_fresh(cache_filepath, source_filepath):
+    """ Whether a sidecar hdf5 file exists, was fully written and matches its source file.
+    """
+    if not os.path.exists(cache_filepath):
+        return False
+    mtime, size = source_stamp(source_filepath)
+    with h5py.File(cache_filepath, 'r') as f:
+        return (f.attrs.get('complete', False) and
+                f.attrs.get('source_mtime') == mtime and
+                f.attrs.get('source_size') == size)
+
+
+class CompositeStore:
+    """
+        Sidecar hdf5 file holding precomputed temporal composites of one sensor
+        for one aggregation setting, stored as a single [grids x bands x rows x cols x bins]
+        dataset so that a grid's composite is one hyperslab read.
+
+        The file sits next to the source hdf5 file and is rebuilt when the
+        source's mtime or size changes.
+    """
+    def __init__(self, hdf5_filepath, sat, agg_days, reduction, num_bands, suffix=''):
+        """
+        Args:
+          hdf5_filepath - (str) path to the source hdf5 file
+          sat - (str) 's1', 's2' or 'planet'
+          agg_days - (int) number of days aggregated into each bin
+          reduction - (str) reduction used within each bin
+          num_bands - (int) number of bands kept before aggregation
+          suffix - (str) appended to the key for settings beyond the ones above
+        """
+        self.source_filepath = hdf5_filepath
+        self.key = f'{sat}_agg{agg_days}_{reduction}_b{num_bands}{suffix}'
+        self.filepath = f'{hdf5_filepath}_composites_{self.key}'
+        self.grid_idxs = None
+        self.doys = None
+
+    def is_stale(self):
+        return not is_fresh(self.filepath, self.source_filepath)
+
+    def build(self, grids, compute_fn, chunk_size=64):
+        """ Computes the composites of all grids and writes them to the sidecar file.
+
+        The file is written under a temporary name and moved into place once
+        complete, so concurrent readers never see a partial file.
+
+        Args:
+          grids - (list of str) grid ids to precompute
+          compute_fn - (function) maps a list of grid ids to (composites, doys), where
+                        composites is a [len(grids) x bands x rows x cols x bins] array
+          chunk_size - (int) number of grids composited per call to compute_fn
+        """
+        mtime, size = source_stamp(self.source_filepath)
+        tmp_filepath = f'{self.filepath}.tmp{os.getpid()}'
+        with h5py.File(tmp_filepath, 'w') as f:
+            f.create_dataset('grids', data=np.array(grids, dtype='S'))
+            composites = None
+            for start in range(0, len(grids), chunk_size):
+                chunk, doys = compute_fn(grids[start:start+chunk_size])
+                if composites is None:
+                    composites = f.create_dataset('composites', shape=(len(grids),) + chunk.shape[1:], dtype='f4')
+                    f.create_dataset('doys', data=doys)
+                composites[start:start+len(chunk)] = chunk
+            f.attrs['source_mtime'] = mtime
+            f.attrs['source_size'] = size
+            f.attrs['complete'] = True
+        os.replace(tmp_filepath, self.filepath)
+
+    def load_index(self):
+        """ Loads the grid id index and bin doys of the sidecar file.
+        """
+        with h5py.File(self.filepath, 'r') as f:
+            grids = [grid.decode() for grid in f['grids'][()]]
+            self.doys = f['doys'][()]
+        self.grid_idxs = {grid: i for i, grid in enumerate(grids)}
+
+    def read(self, grid, rdcc_nbytes=None):
+        """ Returns the [bands x rows x cols x bins] composite of a grid.
+        """
+        return get_hdf5(self.filepath, rdcc_nbytes)['composites'][self.grid_idxs[grid]]
+
+
+class GridMetadata:
+    """
+        Sidecar hdf5 file with a compact per-grid table of an hdf5 file, so that
+        datasets don't have to look up thousands of small datasets on startup.
+
+        The table holds, in the order of `grids`:
+          <sensor>_length - number of timestamps, 0 if the grid lacks the sensor
+          <sensor>_first_doy, <sensor>_last_doy - date range, -1 if the grid lacks the sensor
+          label_counts - [grids x classes] number of pixels of each label value
+          cloud_scores - s2 cloud scores of every grid concatenated, if the file has cloud_scores
+
+        It is rebuilt when the source file's mtime or size changes.
+    """
+    def __init__(self, hdf5_filepath):
+        """
+        Args:
+          hdf5_filepath - (str) path to the source hdf5 file
+        """
+        self.source_filepath = hdf5_filepath
+        self.filepath = f'{hdf5_filepath}_metadata'
+        self.stamp = None
+        self.table = None
+        self.grid_idxs = None
+        self.score_offsets = None
+
+    def is_stale(self):
+        return not is_fresh(self.filepath, self.source_filepath)
+
+    def build(self, reader):
+        """ Computes the table from the source file and writes it to the sidecar file.
+
+        The table is kept in memory even if the sidecar file can't be written.
+
+        Args:
+          reader - (GridReader or PackedGridReader) reader over the source file
+        """
+        mtime, size = source_stamp(self.source_filepath)
+        grids = sorted(reader.grids('labels'))
+        table = { 'grids': np.array(grids, dtype='S') }
+        for sat in SERIES_GROUPS:
+            if not reader.has(sat): continue
+            sat_grids = set(reader.grids(sat))
+            lengths = np.zeros(len(grids), dtype=np.int32)
+            first_doys = np.full(len(grids), -1, dtype=np.int32)
+            last_doys = np.full(len(grids), -1, dtype=np.int32)
+            for i, grid in enumerate(grids):
+                if grid not in sat_grids: continue
+                lengths[i] = reader.length(sat, grid)
+                if reader.has(f'{sat}_dates') and lengths[i] > 0:
+                    dates = reader.read(f'{sat}_dates', grid)
+                    first_doys[i], last_doys[i] = dates.min(), dates.max()
+            table[f'{sat}_length'] = lengths
+            table[f'{sat}_first_doy'] = first_doys
+            table[f'{sat}_last_doy'] = last_doys
+
+        label_counts = [np.bincount(reader.read('labels', grid).ravel().astype(int)) for grid in grids]
+        num_values = max(len(counts) for counts in label_counts)
+        table['label_counts'] = np.stack([np.pad(counts, (0, num_values - len(counts))) for counts in label_counts])
+
+        if reader.has('cloud_scores') and 's2_length' in table:
+            score_row = 0 # mean remapped cloud class, first of CLOUD_SCORE_COLUMNS
+            table['cloud_scores'] = np.concatenate([reader.read('cloud_scores', grid)[score_row] if length > 0 else np.zeros(0)
+                                                    for grid, length in zip(grids, table['s2_length'])]).astype(np.float32)
+        self.set_table(table, (mtime, size))
+
+        tmp_filepath = f'{self.filepath}.tmp{os.getpid()}'
+        try:
+            with h5py.File(tmp_filepath, 'w') as f:
+                for name, values in table.items():
+                    f.create_dataset(name, data=values)
+                f.attrs['source_mtime'] = mtime
+                f.attrs['source_size'] = size
+                f.attrs['complete'] = True
+            os.replace(tmp_filepath, self.filepath)
+        except OSError as e:
+            warnings.warn(f'Could not write grid metadata to {self.filepath}, it will be rebuilt next time: {e}')
+
+    def load(self):
+        """ Loads the table from the sidecar file.
+        """
+        with h5py.File(self.filepath, 'r') as f:
+            table = { name: f[name][()] for name in f }
+            stamp = (f.attrs['source_mtime'], f.attrs['source_size'])
+        self.set_table(table, stamp)
+
+    def set_table(self, table, stamp):
+        self.table = table
+        self.stamp = stamp
+        self.grid_idxs = { grid.decode(): i for i, grid in enumerate(table['grids']) }
+        if 'cloud_scores' in table:
+            self.score_offsets = np.concatenate(([0], np.cumsum(table['s2_length'])[:-1]))
+
+    def length(self, sat, grid):
+        """ Returns the number of timestamps of a grid's sensor.
+        """
+        return int(self.table[f'{sat}_length'][self.grid_idxs[grid]])
+
+    def date_range(self, sat, grid):
+        """ Returns the (first, last) day of year of a grid's sensor, (-1, -1) if the grid lacks it.
+        """
+        i = self.grid_idxs[grid]
+        return int(self.table[f'{sat}_first_doy'][i]), int(self.table[f'{sat}_last_doy'][i])
+
+    def label_counts(self, grid):
+        """ Returns the number of pixels of each label value of a grid.
+        """
+        return self.table['label_counts'][self.grid_idxs[grid]]
+
+    def cloud_scores(self, grid):
+        """ Returns the cloud score of each s2 timestamp of a grid, None if the file has no cloud_scores.
+        """
+        if self.score_offsets is None:
+            return None
+        i = self.grid_idxs[grid]
+        start = self.score_offsets[i]
+        return self.table['cloud_scores'][start:start+self.table['s2_length'][i]]
+
+
+def get_grid_metadata(hdf5_filepath, reader):
+    """ Returns the GridMetadata of an hdf5 file, loaded once per process and built when missing or stale.
+
+    Args:
+      hdf5_filepath - (str) path to the hdf5 file
+      reader - (GridReader or PackedGridReader) reader over the file, used if the table has to be built
+
+    Returns:
+      metadata - (GridMetadata) the file's table
+    """
+    stamp = source_stamp(hdf5_filepath)
+    metadata = _METADATA_CACHE.get(hdf5_filepath)
+    if metadata is None or metadata.stamp != stamp:
+        metadata = GridMetadata(hdf5_filepath)
+        if metadata.is_stale():
+            print(f'Building grid metadata {metadata.filepath}')
+            metadata.build(reader)
+        else:
+            metadata.load()
+        _METADATA_CACHE[hdf5_filepath] = metadata
+    return metadata
@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from modelling.attention import ApplyAtt, attn_or_avg
+
+ATTN_DIMS = { 'd': 8, 'r': 1, 'dk': 4, 'dv': 6, 'chunk': 5 }
+
+@pytest.mark.parametrize('attn_type', ['vector', 'temporal', 'self', 'None'])
+@pytest.mark.parametrize('bidirectional', [False, True])
+def test_attn_or_avg_ignores_padding(attn_type, bidirectional):
+    torch.manual_seed(0)
+    hidden_dim = ATTN_DIMS['dv'] if attn_type == 'self' else 6
+    attention = ApplyAtt(attn_type, hidden_dim, ATTN_DIMS)
+    outputs = torch.randn(2, 3, hidden_dim, 4, 4)
+    rev_outputs = torch.randn(2, 3, hidden_dim, 4, 4) if bidirectional else None
+    lengths = torch.tensor([3, 2])
+
+    # padded timesteps hold arbitrary values, they must not change the result
+    padded = torch.cat([outputs, torch.randn(2, 4, hidden_dim, 4, 4)], dim=1)
+    rev_padded = torch.cat([rev_outputs, torch.randn(2, 4, hidden_dim, 4, 4)], dim=1) if bidirectional else None
+    padded[1, 2:] = torch.randn(5, hidden_dim, 4, 4)
+    if bidirectional:
+        rev_padded[1, 2:] = torch.randn(5, hidden_dim, 4, 4)
+
+    with torch.no_grad():
+        expected = attn_or_avg(attention, True, outputs, rev_outputs, bidirectional, lengths)
+        reduced = attn_or_avg(attention, True, padded, rev_padded, bidirectional, lengths)
+    assert torch.allclose(reduced, expected, atol=1e-5)
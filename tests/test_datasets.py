@@ -0,0 +1,27 @@
+import torch
+
+from datasets import collate_var_length
+
+def test_collate_var_length_keeps_cached_features_float16():
+    label = torch.zeros(4, 4)
+    batch = [({ 's2': torch.randn(length, 8, 2, 2).half(), 's2_enc4': torch.randn(length, 16, 1, 1).half() },
+              label, False, False) for length in [3, 2]]
+
+    inputs, _, _, _ = collate_var_length(batch)
+
+    assert sorted(inputs) == ['s2', 's2_enc4', 's2_lengths', 's2_mask']
+    assert inputs['s2'].dtype == torch.float16
+    assert inputs['s2_enc4'].dtype == torch.float16
+    assert inputs['s2_enc4'].shape == (2, 3, 16, 1, 1)
+    assert inputs['s2_lengths'].tolist() == [3, 2]
+    assert (inputs['s2_enc4'][1, 2] == 0).all()
+
+
+def test_collate_var_length_pads_raw_grids_to_float32():
+    label = torch.zeros(4, 4)
+    batch = [({ 's1': torch.randn(length, 3, 2, 2).double() }, label, False, False) for length in [1, 2]]
+
+    inputs, _, _, _ = collate_var_length(batch)
+
+    assert inputs['s1'].dtype == torch.float32
+    assert inputs['s1_mask'].tolist() == [[True, False], [True, True]]
@@ -10,6 +10,7 @@ import datetime
 import torch
 import datasets
 import metrics
+import preprocess
 import util
 import numpy as np
 import pickle 
@@ -21,34 +22,32 @@ from tqdm import tqdm
 from torch import autograd
 import visualize
 
-def evaluate_split(model, model_name, split_loader, device, loss_weight, weight_scale, gamma, num_classes, country, var_length):
+def get_batches(dl, device, prefetch_batches):
+    """ Returns the batches of a loader, moved to device ahead of time if prefetch_batches > 0
+    """
+    if prefetch_batches > 0:
+        return datasets.DevicePrefetcher(dl, device, prefetch_batches)
+    return dl
+
+def evaluate_split(model, model_name, split_loader, device, loss_weight, weight_scale, gamma, num_classes, country, var_length, prefetch_batches=2):
     total_loss = 0
-    total_pixels = 0
-    total_cm = np.zeros((num_classes, num_classes)).astype(int) 
+    total_cm = metrics.StreamingConfusionMatrix(num_classes)
     loss_fn = loss_fns.get_loss_fn(model_name)
-    for inputs, targets, cloudmasks, hres_inputs in split_loader:
+    for inputs, targets, cloudmasks, hres_inputs in get_batches(split_loader, device, prefetch_batches):
         with torch.set_grad_enabled(False):
-            if not var_length:
-                inputs.to(device)
-            else:
-                for sat in inputs:
-                    if "length" not in sat:
-                        inputs[sat].to(device)
-            targets.to(device)
-            hres_inputs.to(device)
-            if hres_inputs is not None: hres_inputs.to(device)
+            # no-op for prefetched batches
+            inputs, targets, hres_inputs = datasets.batch_to_device((inputs, targets, hres_inputs), device)
 
             preds = model(inputs, hres_inputs) if model_name in MULTI_RES_MODELS else model(inputs)   
-            batch_loss, batch_cm, _, num_pixels, confidence = evaluate(model_name, preds, targets, country, loss_fn=loss_fn, reduction="sum", loss_weight=loss_weight, weight_scale=weight_scale, gamma=gamma)
-            total_loss += batch_loss.item()
-            total_pixels += num_pixels
-            total_cm += batch_cm
+            batch_loss, _, _, _, confidence = evaluate(model_name, preds, targets, country, loss_fn=loss_fn, reduction="sum", loss_weight=loss_weight, weight_scale=weight_scale, gamma=gamma, streaming_cm=total_cm)
+            if batch_loss is not None:
+                total_loss += batch_loss.detach()
 
-    f1_avg = metrics.get_f1score(total_cm, avg=True)
-    acc_avg = sum([total_cm[i][i] for i in range(num_classes)]) / np.sum(total_cm) 
-    return total_loss / total_pixels, f1_avg, acc_avg 
+    f1_avg = total_cm.f1score(avg=True)
+    acc_avg = total_cm.accuracy()
+    return float(total_loss) / total_cm.num_pixels(), f1_avg, acc_avg 
 
-def evaluate(model_name, preds, labels, country, loss_fn=None, reduction=None, loss_weight=None, weight_scale=None, gamma=None):
+def evaluate(model_name, preds, labels, country, loss_fn=None, reduction=None, loss_weight=None, weight_scale=None, gamma=None, streaming_cm=None):
     """ Evalautes loss and metrics for predictions vs labels.
 
     Args:
@@ -58,6 +57,8 @@ def evaluate(model_name, preds, labels, country, loss_fn=None, reduction=None, l
         reduction - (str) "avg" or "sum", where "avg" calculates the average accuracy for each batch
                                           where "sum" tracks total correct and total pixels separately
         loss_weight - (bool) whether we use weighted loss function or not
+        streaming_cm - (metrics.StreamingConfusionMatrix) if given with "sum" reduction, preds and labels are
+                        added to it on their device, and cm and total_correct are returned as None
 
     Returns:
         loss - (float) the loss the model incurs
@@ -66,6 +67,11 @@ def evaluate(model_name, preds, labels, country, loss_fn=None, reduction=None, l
         total_correct - (int) given "sum" reduction, gives total correct pixels
         num_pixels - (int) given "sum" reduction, gives total number of valid pixels
     """
+    if model_name in DL_MODELS and reduction == "sum" and streaming_cm is not None:
+        loss, confidence, num_pixels = loss_fn(labels, preds, reduction, country, loss_weight, weight_scale)
+        streaming_cm.update(preds, labels)
+        return loss, None, None, num_pixels, confidence
+
     cm = metrics.get_cm(preds, labels, country, model_name)
     
     if model_name in NON_DL_MODELS:
@@ -138,19 +144,16 @@ def train_dl_model(model, model_name, dataloaders, args):
             dl = dataloaders[split]
             model.train() if split == ['train'] else model.eval()
             # TODO: figure out how to pack inputs from dataloader together in the case of variable length sequences
-            for inputs, targets, cloudmasks, hres_inputs in tqdm(dl):
+            for inputs, targets, cloudmasks, hres_inputs in tqdm(get_batches(dl, args.device, args.prefetch_batches)):
+                # no-op for prefetched batches
+                inputs, targets, hres_inputs = datasets.batch_to_device((inputs, targets, hres_inputs), args.device)
+                if split == 'train' and args.apply_transforms and args.batch_transforms:
+                    inputs, targets, cloudmasks, hres_inputs = preprocess.augment_batch(inputs, targets, cloudmasks, hres_inputs)
                 with torch.set_grad_enabled(True):
-                    if not args.var_length:
-                        inputs.to(args.device)
-                        if hres_inputs is not None: hres_inputs.to(args.device)
-                    else:
-                        for sat in inputs:
-                            if "length" not in sat:
-                                inputs[sat].to(args.device)
-                    targets.to(args.device)
                     preds = model(inputs, hres_inputs) if model_name in MULTI_RES_MODELS else model(inputs)
-                    loss, cm_cur, total_correct, num_pixels, confidence = evaluate(model_name, preds, targets, args.country, loss_fn=loss_fn, 
-                                              reduction="sum", loss_weight=args.loss_weight, weight_scale=args.weight_scale, gamma=args.gamma)
+                    loss, _, _, _, confidence = evaluate(model_name, preds, targets, args.country, loss_fn=loss_fn, 
+                                              reduction="sum", loss_weight=args.loss_weight, weight_scale=args.weight_scale, gamma=args.gamma,
+                                              streaming_cm=vis_logger.epoch_cms[split])
  
                     if split == 'train' and loss is not None:         # TODO: not sure if we need this check?
                         # If there are valid pixels, update weights
@@ -172,14 +175,19 @@ def train_dl_model(model, model_name, dataloaders, args):
 
                         vis_logger.update_progress('train', 'gradnorm', gradnorm)
                     
-                    if cm_cur is not None: # TODO: not sure if we need this check?
+                    if loss is not None:
                         # If there are valid pixels, update metrics
-                        vis_logger.update_epoch_all(split, cm_cur, loss, total_correct, num_pixels)
+                        vis_logger.update_epoch_all(split, loss)
                 
                 vis_logger.record_batch(inputs, cloudmasks, targets, preds, confidence, 
                                         NUM_CLASSES[args.country], split, 
                                         args.include_doy, args.use_s1, args.use_s2, 
-                                        model_name, args.time_slice, var_length=args.var_length)
+                                        model_name, args.time_slice, var_length=args.var_length or args.feature_cache)
+
+            if args.var_length:
+                print('{} padded timesteps: {:.1%}'.format(split, dl.batch_sampler.padded_fraction))
+            if args.time_branches and hasattr(model, 'pop_branch_times'):
+                print('{} seconds per batch of each sensor branch: {}'.format(split, model.pop_branch_times()))
 
             if split in ['test']:
                 vis_logger.record_epoch(split, i, args.country, save=False, save_dir=os.path.join(args.save_dir, args.name + "_best_dir"))
@@ -198,7 +206,7 @@ def train_dl_model(model, model_name, dataloaders, args):
                         vis_logger.record_batch(inputs, cloudmasks, targets, preds, confidence, 
                                                 NUM_CLASSES[args.country], split, 
                                                 args.include_doy, args.use_s1, args.use_s2, 
-                                                model_name, args.time_slice, save=True, var_length=args.var_length, 
+                                                model_name, args.time_slice, save=True, var_length=args.var_length or args.feature_cache, 
                                                 save_dir=os.path.join(args.save_dir, args.name + "_best_dir"))
 
                         vis_logger.record_epoch(split, i, args.country, save=True, 
@@ -236,13 +244,10 @@ if __name__ == "__main__":
     parser = util.get_train_parser()
 
     args = parser.parse_args()
+    args.device = util.get_device(args.device)
 
     if args.seed is not None:
-        if args.device == 'cuda':
-            use_cuda=True
-        elif args.device == 'cpu':
-            use_cuda=False
-        util.random_seed(seed_value=args.seed, use_cuda=use_cuda)
+        util.random_seed(seed_value=args.seed, use_cuda=args.device.startswith('cuda'))
 
     # load in data generator
     dataloaders = datasets.get_dataloaders(args.country, args.dataset, args)
@@ -252,10 +257,7 @@ if __name__ == "__main__":
         print('Total trainable model parameters: {}'.format(sum(p.numel() for p in model.parameters() if p.requires_grad)))
 
     if args.model_path is not None:
-        model.load_state_dict(torch.load(args.model_path))
-
-    if args.model_name in DL_MODELS and args.device == 'cuda' and torch.cuda.is_available():
-        model.to(args.device)
+        model.load_state_dict(torch.load(args.model_path, map_location=args.device))
 
     if args.name is None:
         args.name = str(datetime.datetime.now()) + "_" + args.model_name
@@ -28,6 +28,14 @@ def random_seed(seed_value, use_cuda):
             torch.backends.cudnn.deterministic = True  #needed
             torch.backends.cudnn.benchmark = False
 
+def get_device(device):
+    """ Returns the device to run on, cpu if cuda is asked for but not available
+    """
+    if device.startswith('cuda') and not torch.cuda.is_available():
+        print('WARNING: cuda is not available, running on cpu')
+        return 'cpu'
+    return device
+
 def dates2doy(dates):
     """ Transforms list of dates in YYYY-MM-DD format to a vector of days of year
     """
@@ -335,12 +343,33 @@ def get_train_parser():
     parser.add_argument('--agg_days', type=int,
                         help="Number of days to aggregate in each time bin",
                         default=15)
+    parser.add_argument('--max_batch_timesteps', type=int,
+                        help="With --var_length, caps the padded timesteps of a batch summed over sensors; batches are only capped by batch_size if unset",
+                        default=None)
+    parser.add_argument('--composite_cache', type=str2bool,
+                        help="Read aggregated timeseries from precomputed composite files built next to the hdf5 file",
+                        default=False)
+    parser.add_argument('--shard_dir', type=str,
+                        help="Directory of training shards written by compile_dataset.py; reads from the hdf5 file if unset",
+                        default=None)
+    parser.add_argument('--shard_dtype', type=str,
+                        help="Dtype compile_dataset.py writes shards in, float16 or float32. float16 expects --normalize True",
+                        default='float16')
+    parser.add_argument('--feature_cache', type=str2bool,
+                        help="With --shard_dir and --early_feats, read the frozen encoder features written by cache_features.py instead of the shards, so only the CRNN, attention and decoder run",
+                        default=False)
     parser.add_argument('--num_workers', type=int,
                         help="Number of workers to use for pulling data",
                         default=8)
+    parser.add_argument('--prefetch_batches', type=int,
+                        help="Number of batches moved to the device ahead of the model by a background thread, 0 to load batches in the training loop",
+                        default=2)
+    parser.add_argument('--hdf5_chunk_cache_mb', type=float,
+                        help="Size in MB of the h5py raw chunk cache for each worker's hdf5 handle, h5py default if unset",
+                        default=None)
     # TODO: find correct string name
     parser.add_argument('--device', type=str,
-                        help="Cuda or CPU",
+                        help="Device to train and evaluate on, e.g. cuda, cuda:1 or cpu. Falls back to cpu if cuda is not available",
                         default='cuda')
     parser.add_argument('--save_dir', type=str,
                         help="Directory to save the models in. If unspecified, saves the model to ./runs.",
@@ -372,6 +401,12 @@ def get_train_parser():
     parser.add_argument('--apply_transforms', type=str2bool,
                         help="Apply horizontal flipping / rotation",
                         default=True)
+    parser.add_argument('--int_labels', type=str2bool,
+                        help="Keep labels as uint8 [rows x cols] class maps with 0 for unlabeled pixels instead of one-hot, losses and metrics ignore the unlabeled pixels",
+                        default=False)
+    parser.add_argument('--batch_transforms', type=str2bool,
+                        help="Apply the flips / rotations of apply_transforms to whole train batches after collation, with one of the 8 dihedral transforms per sample, instead of per sample in the dataset",
+                        default=False)
     parser.add_argument('--normalize', type=str2bool,
                         help="Apply normalization to input based on overall band means and stds",
                         default=True)
@@ -405,6 +440,27 @@ def get_train_parser():
     parser.add_argument('--crnn_num_layers', type=int,
                         help="Number of convolutional RNN cells to stack",
                         default=1)
+    parser.add_argument('--crnn_precompute_inputs', type=str2bool,
+                        help="Run the input convolutions of a recurrent cell for all timesteps at once, before the time loop",
+                        default=True)
+    parser.add_argument('--crnn_norm', type=str, choices=['batch', 'layer', 'group'],
+                        help="Normalization within a recurrent cell. layer and group do not use batch statistics, so they also work for batch size 1 inference",
+                        default='batch')
+    parser.add_argument('--crnn_norm_groups', type=int,
+                        help="Number of channel groups used by --crnn_norm group, has to divide the hidden dims",
+                        default=4)
+    parser.add_argument('--crnn_fused_bidirectional', type=str2bool,
+                        help="Run both directions of a bidirectional CLSTM in one time loop",
+                        default=True)
+    parser.add_argument('--crnn_checkpoint_segment', type=int,
+                        help="Timesteps per gradient checkpointed segment of the recurrent time loop, 0 to keep the whole graph. " +
+                             "Segments are recomputed in the backward pass, which lowers peak memory",
+                        default=0)
+    parser.add_argument('--crnn_tbptt_steps', type=int,
+                        help="Truncate backprop through time of the recurrent layers every this many timesteps, 0 for full backprop. " +
+                             "Only shortens the gradient paths, peak memory is not lowered since there is still one backward per batch; " +
+                             "use --crnn_checkpoint_segment for that",
+                        default=0)
     parser.add_argument('--bidirectional', type=str2bool,
                         help='Use bidirectional?',
                         default=False)
@@ -418,6 +474,14 @@ def get_train_parser():
                          help="Use early features in the CLSTM from center after encoder")
     parser.add_argument('--fcn_out_feats', type=int, default=256,
                          help="Number of output features from fcn to be fed into CLSTM")
+    parser.add_argument('--encoder_chunk_frames', type=int, default=0,
+                         help="Run the UNet of fcn_crnn / mi_clstm on at most this many frames at a time, 0 for all batch x timestamps frames at once")
+    parser.add_argument('--encoder_checkpoint', type=str2bool, default=False,
+                         help="Recompute the activations of each encoder chunk in backward instead of keeping them")
+    parser.add_argument('--parallel_branches', type=str2bool, default=False,
+                         help="Run the sensor branches of mi_clstm at the same time, in threads and on their own cuda streams")
+    parser.add_argument('--time_branches', type=str2bool, default=False,
+                         help="Print the mean seconds per batch of each sensor branch of mi_clstm every epoch, timed by cuda events on the gpu")
     #parser.add_argument('--fcn_model_name', type=str, default='unet', 
     #                     help="Model to use for fcn part of fcn + crnn")
     parser.add_argument('--crnn_model_name', type=str, default='clstm',
@@ -452,7 +516,7 @@ def get_train_parser():
     parser.add_argument('--main_attn_type', type=str, default='None',
                          help="Attention type to use for main clstm layer, must be 'None', 'temporal', 'self', or 'vector'")
     parser.add_argument('--enc_attn_type', type=str, default='None',
-                         help="Attention type to use for encoder layers, must be 'None', 'temporal', 'self', or 'vector', self may use up too much memory")
+                         help="Attention type to use for encoder layers, must be 'None', 'temporal', 'self', or 'vector'")
     parser.add_argument('--d_attn_dim', type=int, default=32,
                          help="Number of features in w_s1 output for temporal attention")
     parser.add_argument('--r_attn_dim', type=int, default=1,
@@ -461,6 +525,8 @@ def get_train_parser():
                          help="Number of dk features for self attention")
     parser.add_argument('--dv_attn_dim', type=int, default=256,
                          help="Number of dv features for self attention")
+    parser.add_argument('--self_attn_chunk', type=int, default=4096,
+                         help="Number of pixels self attention attends over time at once, bounds its memory to chunk * timesteps^2 scores")
     parser.add_argument('--enc_crnn', type=str2bool, default=False,
                          help="Use crnn for encoder layers in addition to the main encodings")
     parser.add_argument('--enc_attn', type=str2bool, default=False,
@@ -47,30 +47,39 @@ class VisdomLogger:
             self.epoch_data[f'{split}_correct'] = 0
             self.epoch_data[f'{split}_pix'] = 0
             self.epoch_data[f'{split}_cm'] = np.zeros((NUM_CLASSES[self.country], NUM_CLASSES[self.country])).astype(int)
+        # confusion matrices filled on the device during the epoch, see sync_epoch_data
+        self.epoch_cms = { split: metrics.StreamingConfusionMatrix(NUM_CLASSES[self.country]) for split in self.splits }
             
     def update_progress(self, split, metric_name, value):
         self.progress_data[f'{split}_{metric_name}'].append(value)
     
-    def update_epoch_all(self, split, cm_cur, loss, total_correct, num_pixels):
-        self.epoch_data[f'{split}_cm'] += cm_cur
-        self.epoch_data[f'{split}_loss'] += loss.item()
-        self.epoch_data[f'{split}_correct'] += total_correct
-        self.epoch_data[f'{split}_pix'] += num_pixels
+    def update_epoch_all(self, split, loss):
+        """ Adds a batch loss to the epoch. The batch predictions go into
+            epoch_cms[split], which holds the rest of the epoch metrics.
+        """
+        self.epoch_data[f'{split}_loss'] += loss.detach()
+
+    def sync_epoch_data(self, split):
+        """ Copies the loss and metrics accumulated on the device to epoch_data
+        """
+        cm = self.epoch_cms[split]
+        self.epoch_data[f'{split}_loss'] = float(self.epoch_data[f'{split}_loss'])
+        self.epoch_data[f'{split}_cm'] = cm.confusion_matrix()
+        self.epoch_data[f'{split}_correct'] = cm.num_correct()
+        self.epoch_data[f'{split}_pix'] = cm.num_pixels()
     
     def reset_epoch_data(self):
-        self.epoch_data = {}
-        for split in self.splits:
-            self.epoch_data[f'{split}_loss'] = 0
-            self.epoch_data[f'{split}_correct'] = 0
-            self.epoch_data[f'{split}_pix'] = 0
-            self.epoch_data[f'{split}_cm'] = np.zeros((NUM_CLASSES[self.country], NUM_CLASSES[self.country])).astype(int)
+        self._init_epoch_data()
     
     def record_batch(self, inputs, clouds, targets, preds, confidence, 
                      num_classes, split, include_doy, use_s1, use_s2, 
                      model_name, time_slice, 
                      save=False, save_dir=None, show_visdom=True, show_matplot=False, var_length=False):
         
-        label_mask = np.sum(targets.numpy(), axis=1)
+        targets = targets.cpu().numpy()
+        # integer labels are [batch x rows x cols] class maps with 0 for unlabeled pixels
+        int_labels = targets.ndim == 3
+        label_mask = (targets > 0).astype(np.float32) if int_labels else np.sum(targets, axis=1)
         label_mask = np.expand_dims(label_mask, axis=1)
         if show_visdom:
             visdom_plot_images(self.vis, label_mask, 'Label Masks')
@@ -79,7 +88,7 @@ class VisdomLogger:
         # TODO: not sure if this is doing anything (since best is set tp zeros_like)
         # Show best inputs judging from cloud masks
         if clouds is not None and torch.sum(clouds) != 0 and len(clouds.shape) > 1: 
-            best = np.argmax(np.mean(np.mean(clouds.numpy()[:, 0, :, :, :], axis=1), axis=1), axis=1)
+            best = np.argmax(np.mean(np.mean(clouds.cpu().numpy()[:, 0, :, :, :], axis=1), axis=1), axis=1)
         else:
             if var_length and 's2' in inputs:
                 best = np.random.randint(0, high=inputs['s2'].shape[1], size=(inputs['s2'].shape[0],))
@@ -119,13 +128,16 @@ class VisdomLogger:
             raise ValueError(f"Model {model_name} unsupported! check --model_name args")
 
         # Clip and show input bands of interest
-        boi = clip_boi(boi)
+        boi = clip_boi(boi.detach().cpu())
         if show_visdom:
             visdom_plot_images(self.vis, boi, 'Input Images') 
 
         # Show targets (labels)
-        disp_targets = np.concatenate((np.zeros_like(label_mask), targets.numpy()), axis=1)
-        disp_targets = np.argmax(disp_targets, axis=1)
+        if int_labels:
+            disp_targets = targets.astype(np.int64)
+        else:
+            disp_targets = np.concatenate((np.zeros_like(label_mask), targets), axis=1)
+            disp_targets = np.argmax(disp_targets, axis=1)
         disp_targets = np.expand_dims(disp_targets, axis=1)
         disp_targets = visualize_rgb(disp_targets, num_classes)
         if show_visdom:
@@ -176,6 +188,7 @@ class VisdomLogger:
         else:
             raise ValueError(f"Country {country} not supported in visualize.py, record_epoch")
 
+        self.sync_epoch_data(split)
         if self.epoch_data[f'{split}_loss'] is not None: 
             loss_epoch = self.epoch_data[f'{split}_loss'] / self.epoch_data[f'{split}_pix']
         if self.epoch_data[f'{split}_correct'] is not None: 